@@ -1,8 +1,3002 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
+from tkinter import ttk, messagebox, filedialog, simpledialog
 import openpyxl
 import os
+import io
+import re
+import sys
+import csv
+import socket
+import getpass
+import hashlib
+import zipfile
+import zlib
+import json
+import math
+import time
+import queue
+import threading
+import functools
+import bisect
+import heapq
+import struct
+from array import array
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from xml.etree import ElementTree
+
+# Étapes du chargement en arrière-plan, dans l'ordre où elles sont publiées
+LOAD_STAGES = ("catalogue", "historique", "commandes", "agregats")
+
+# Onglets concernés par chaque étape: ils deviennent interactifs à la fin de l'étape
+STAGE_TABS = {
+    "catalogue": ("consommation", "stock", "alertes", "rapports", "auxiliaires"),
+    "historique": ("consommation", "stock", "alertes"),
+    "commandes": ("commandes",),
+    "agregats": ("indicateurs",),
+}
+
+
+class Instrumentation:
+    """Mesure le temps d'exécution et le nombre d'appels des opérations (désactivée par défaut)"""
+
+    def __init__(self, enabled=False, size=5000):
+        self.enabled = enabled
+        self.records = deque(maxlen=size)  # Tampon circulaire des dernières mesures
+        self.stats = {}  # nom -> (appels, durée totale, durée max)
+        self.lock = threading.Lock()
+
+    def record(self, name, started, duration):
+        """Enregistre une mesure (peut être appelé depuis n'importe quel thread)"""
+        with self.lock:
+            self.records.append((started, name, duration, threading.current_thread().name))
+            count, total, worst = self.stats.get(name, (0, 0.0, 0.0))
+            self.stats[name] = (count + 1, total + duration, max(worst, duration))
+
+    @contextmanager
+    def _measure(self, name):
+        started = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started, time.perf_counter() - t0)
+
+    def measure(self, name):
+        """Contexte mesurant le bloc qu'il entoure"""
+        return self._measure(name) if self.enabled else nullcontext()
+
+    def timed(self, name):
+        """Décorateur mesurant chaque appel de la fonction"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._measure(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        """Retourne (nom, appels, total, moyenne, max) trié par durée totale décroissante"""
+        with self.lock:
+            stats = list(self.stats.items())
+        rows = [(name, count, total, total / count, worst) for name, (count, total, worst) in stats]
+        return sorted(rows, key=lambda r: r[2], reverse=True)
+
+    def snapshot(self):
+        """Copie des mesures du tampon circulaire, de la plus ancienne à la plus récente"""
+        with self.lock:
+            return list(self.records)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.stats.clear()
+
+    def dump_json(self, path):
+        """Exporte les mesures et le résumé au format JSON"""
+        data = {
+            'records': [
+                {'start': datetime.fromtimestamp(started).isoformat(), 'name': name,
+                 'duration_ms': duration * 1000, 'thread': thread}
+                for started, name, duration, thread in self.snapshot()
+            ],
+            'summary': [
+                {'name': name, 'calls': count, 'total_ms': total * 1000,
+                 'mean_ms': mean * 1000, 'max_ms': worst * 1000}
+                for name, count, total, mean, worst in self.summary()
+            ],
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+    def dump_csv(self, path):
+        """Exporte les mesures du tampon circulaire au format CSV"""
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["start", "name", "duration_ms", "thread"])
+            for started, name, duration, thread in self.snapshot():
+                writer.writerow([datetime.fromtimestamp(started).isoformat(), name,
+                                 f"{duration * 1000:.3f}", thread])
+
+
+# Instrumentation activée par STOCKMASTER_PROFILE=1 ou l'option --profile
+PROFILER = Instrumentation(enabled=os.environ.get("STOCKMASTER_PROFILE", "") not in ("", "0"))
+
+
+def build_template_workbook():
+    """Construit un classeur vide avec la structure attendue par l'application"""
+    wb = openpyxl.Workbook()
+    
+    # Feuille 1: Groupe compta. Stock
+    sheet1 = wb.active
+    sheet1.title = "Groupe compta. Stock"
+    sheet1.append(["Liste des articles"])
+    sheet1.append(["Groupe compta. Stock"])
+    for _ in range(5): sheet1.append([])
+    sheet1.append(["", "LES COMMANDES", "CONSOMMATION"])
+    for _ in range(2): sheet1.append([])
+    sheet1.append(["", "N° total de cmd traitée", "=MAX(Consommation!D2:D143)"])
+    sheet1.append(["", "=COUNTIF(commandes!G2:G162,\"traitée\")", "=MIN(Consommation!D2:D136)"])
+    for _ in range(2): sheet1.append([])
+    sheet1.append(["", "taux des comandes", ""])
+    sheet1.append(["", "=B10/B16", ""])
+    for _ in range(2): sheet1.append([])
+    sheet1.append(["", "N total de commandes", ""])
+    sheet1.append(["", "=COUNTA(commandes!A2:A148)", ""])
+    
+    # Feuille 2: Liste des articles2
+    sheet2 = wb.create_sheet("Liste des articles2")
+    headers = [
+        "ID COLORANTS", "NOM DE COLORANT", "Stock", "STOCK MIN", 
+        "CONSOMMATION", "STOCK REEL", "DATE D'ENTRE", "ALERTE DE STOCK"
+    ]
+    sheet2.append(headers)
+    
+    # Feuille 3: Consommation
+    sheet3 = wb.create_sheet("Consommation")
+    sheet3.append(["ID COLORANTS/NOM DE COLORANT", "DATE", "CONSOMMATION (jours)", "CONSOMMATION ( semaine)"])
+    
+    # Feuille 4: Consommation total par colorant
+    sheet4 = wb.create_sheet("Consommation total par colorant")
+    sheet4.append(["ID COLORANT", "CONSOMMATION TOTAL (mois)"])
+    
+    # Feuille 5: commandes
+    sheet5 = wb.create_sheet("commandes")
+    headers = [
+        "LES COMMANDES", "CODE COULEUR", "DATE D'ENTRE", "DATE SORTIE", 
+        "delai (jours)", "delai de traitement", "Statut", "observation"
+    ]
+    sheet5.append(headers)
+    
+    # Feuille 6: Feuil2
+    sheet6 = wb.create_sheet("Feuil2")
+    sheet6.append(["statut"])
+    sheet6.append(["traité"])
+    sheet6.append(["non traité"])
+    
+    # Feuille 7: Produits auxiliaires
+    sheet7 = wb.create_sheet("Produits auxiliaires")
+    headers = [
+        "ID PRODUIT", "NOM", "Stock", "STOCK MIN", 
+        "CONSOMMATION", "STOCK REEL", "DATE D'ENTRE", "ALERTE DE STOCK"
+    ]
+    sheet7.append(headers)
+    
+    # Feuille 8: Réceptions (bons de réception, lots)
+    sheet8 = wb.create_sheet(RECEPTION_SHEET)
+    sheet8.append([header for _, _, header in RECEPTION_COLUMNS])
+    
+    # Feuille 9: Recettes (composants par code couleur)
+    sheet9 = wb.create_sheet(RECIPE_SHEET)
+    sheet9.append([header for _, _, header in RECIPE_COLUMNS])
+    
+    # Feuille 10: Délais (délai maximal de traitement par code couleur ou statut)
+    sheet10 = wb.create_sheet(SLA_SHEET)
+    sheet10.append([header for _, _, header in SLA_COLUMNS])
+    
+    # Feuille 11: Unités (unité de saisie et d'affichage, densité des produits liquides)
+    sheet11 = wb.create_sheet(UNIT_SHEET)
+    sheet11.append([header for _, _, header in UNIT_COLUMNS])
+    
+    # Feuille 12: Emplacements (lieux de stockage et stock minimal de chaque produit par lieu)
+    sheet12 = wb.create_sheet(LOCATION_SHEET)
+    sheet12.append([header for _, _, header in LOCATION_COLUMNS])
+    
+    # Feuille 13: Transferts (mouvements de stock entre emplacements)
+    sheet13 = wb.create_sheet(TRANSFER_SHEET)
+    sheet13.append([header for _, _, header in TRANSFER_COLUMNS])
+    
+    return wb
+
+
+def to_float(value):
+    """Convertit une valeur de cellule en float (0.0 si vide ou invalide)"""
+    try:
+        return float(value) if value is not None else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+XLSX_MAIN = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+SHARED_STRINGS = "xl/sharedStrings.xml"
+
+# Formats numériques intégrés d'Excel qui affichent une date ou une heure
+BUILTIN_DATE_FORMATS = set(range(14, 23)) | {45, 46, 47}
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+# Dernière table de chaînes partagées lue, indexée par (CRC, taille) de sa partie
+_shared_strings_cache = {}
+
+
+def sheet_part_paths(archive):
+    """Chemin de la partie XML de chaque feuille d'une archive xlsx, dans l'ordre du classeur"""
+    workbook = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+    rels = ElementTree.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    targets = {rel.get("Id"): rel.get("Target", "") for rel in rels}
+    
+    paths = {}
+    for sheet in workbook.iter(XLSX_MAIN + "sheet"):
+        target = targets.get(sheet.get(XLSX_REL + "id"), "")
+        paths[sheet.get("name")] = target.lstrip("/") if target.startswith("/") else "xl/" + target
+    return paths
+
+
+def is_date_format(code):
+    """Indique si un format numérique personnalisé affiche une date ou une heure"""
+    code = code.split(";")[0]
+    visible = []
+    quoted = escaped = bracket = False
+    for char in code:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "[":
+            bracket = True
+        elif char == "]":
+            bracket = False
+        elif not bracket:
+            visible.append(char.lower())
+    return any(char in "dmyhs" for char in visible)
+
+
+@functools.lru_cache(maxsize=256)
+def column_index(ref):
+    """Numéro de colonne (à partir de 1) d'une référence de cellule comme "AB12" """
+    index = 0
+    for char in ref:
+        if char.isdigit():
+            break
+        index = index * 26 + ord(char.upper()) - 64
+    return index
+
+
+class XlsxReader:
+    """Lecteur xlsx rapide en lecture seule.
+    
+    Ouvre l'archive zip et n'analyse, en flux, que les feuilles effectivement
+    parcourues; la table des chaînes partagées et les styles de date ne sont
+    lus qu'une fois. Expose la même interface que openpyxl en lecture seule
+    pour les fonctions read_*: `sheetnames` et `reader[nom].iter_rows(...)`.
+    """
+
+    def __init__(self, source):
+        self.archive = zipfile.ZipFile(io.BytesIO(source) if isinstance(source, bytes) else source)
+        self.paths = sheet_part_paths(self.archive)
+        self.sheetnames = list(self.paths)
+        self._strings = None
+        self._date_styles = None
+
+    def __getitem__(self, name):
+        return XlsxSheet(self, self.paths[name])
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @property
+    def shared_strings(self):
+        if self._strings is None:
+            try:
+                info = self.archive.getinfo(SHARED_STRINGS)
+            except KeyError:
+                self._strings = []
+                return self._strings
+            
+            key = (info.CRC, info.file_size)
+            strings = _shared_strings_cache.get(key)
+            if strings is None:
+                with PROFILER.measure("xlsx:chaînes partagées"):
+                    strings = self._read_shared_strings(info)
+                _shared_strings_cache.clear()
+                _shared_strings_cache[key] = strings
+            self._strings = strings
+        return self._strings
+
+    def _read_shared_strings(self, info):
+        strings = []
+        text_tag, run_tag = XLSX_MAIN + "t", XLSX_MAIN + "r"
+        with self.archive.open(info) as f:
+            for _, elem in ElementTree.iterparse(f):
+                if elem.tag != XLSX_MAIN + "si":
+                    continue
+                text = elem.find(text_tag)
+                if text is not None:
+                    strings.append(text.text or "")
+                else:
+                    # Texte enrichi: concaténation des segments (sans les annotations phonétiques)
+                    strings.append("".join(run.findtext(text_tag) or "" for run in elem.iter(run_tag)))
+                elem.clear()
+        return strings
+
+    @property
+    def date_styles(self):
+        """Indices des styles de cellule dont le format numérique est une date"""
+        if self._date_styles is None:
+            self._date_styles = set()
+            try:
+                styles = ElementTree.fromstring(self.archive.read("xl/styles.xml"))
+            except KeyError:
+                return self._date_styles
+            
+            date_formats = set(BUILTIN_DATE_FORMATS)
+            for fmt in styles.iter(XLSX_MAIN + "numFmt"):
+                if is_date_format(fmt.get("formatCode", "")):
+                    date_formats.add(int(fmt.get("numFmtId")))
+            
+            cell_xfs = styles.find(XLSX_MAIN + "cellXfs")
+            for index, xf in enumerate(cell_xfs if cell_xfs is not None else ()):
+                if int(xf.get("numFmtId", 0)) in date_formats:
+                    self._date_styles.add(str(index))
+        return self._date_styles
+
+
+class XlsxSheet:
+    """Feuille d'un XlsxReader, lue en flux à chaque parcours"""
+
+    def __init__(self, reader, path):
+        self.reader = reader
+        self.path = path
+
+    def iter_rows(self, min_row=1, max_row=None, min_col=1, max_col=None, values_only=True):
+        """Valeurs des lignes, comme openpyxl en lecture seule: lignes vides incluses, complétées par None"""
+        row_tag, cell_tag = XLSX_MAIN + "row", XLSX_MAIN + "c"
+        value_tag, text_tag = XLSX_MAIN + "v", XLSX_MAIN + "t"
+        dimension_tag, inline_tag = XLSX_MAIN + "dimension", XLSX_MAIN + "is"
+        strings = None
+        date_styles = self.reader.date_styles
+        width = max_col
+        last_row = None
+        expected = 1
+        
+        with self.reader.archive.open(self.path) as f:
+            for _, elem in ElementTree.iterparse(f):
+                tag = elem.tag
+                if tag == dimension_tag:
+                    end = elem.get("ref", "A1").split(":")[-1]
+                    last_row = int(end.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ") or 1)
+                    if width is None:
+                        width = column_index(end)
+                    continue
+                if tag != row_tag:
+                    continue
+                
+                row = int(elem.get("r") or expected)
+                if max_row is not None and row > max_row:
+                    break
+                if row < min_row or (last_row is not None and row > last_row and not len(elem)):
+                    # Ligne hors plage, ou ligne de mise en forme seule après la dernière donnée
+                    elem.clear()
+                    expected = row + 1
+                    continue
+                
+                # Lignes absentes du XML (entièrement vides)
+                for _ in range(max(expected, min_row), row):
+                    yield (None,) * max((width or 0) - min_col + 1, 0)
+                expected = row + 1
+                
+                values = [None] * (width or 0)
+                col = 0
+                for cell in elem.iter(cell_tag):
+                    ref = cell.get("r")
+                    col = column_index(ref) if ref else col + 1
+                    if max_col is not None and col > max_col:
+                        break
+                    if col < min_col:
+                        continue
+                    
+                    kind = cell.get("t")
+                    if kind == "inlineStr":
+                        inline = cell.find(inline_tag)
+                        value = "".join(t.text or "" for t in inline.iter(text_tag)) if inline is not None else None
+                    else:
+                        text = cell.findtext(value_tag)
+                        if text is None or (not text and kind != "str"):
+                            continue
+                        if kind == "s":
+                            if strings is None:
+                                strings = self.reader.shared_strings
+                            value = strings[int(text)]
+                        elif kind in ("str", "e"):
+                            value = text
+                        elif kind == "b":
+                            value = text == "1"
+                        else:
+                            value = float(text) if "." in text or "E" in text or "e" in text else int(text)
+                            if cell.get("s") in date_styles:
+                                value = EXCEL_EPOCH + timedelta(days=value)
+                    
+                    if col > len(values):
+                        values.extend([None] * (col - len(values)))
+                    values[col - 1] = value
+                
+                elem.clear()
+                yield tuple(values[min_col - 1:])
+
+
+def is_formula(value):
+    """Indique si une valeur de cellule est une formule"""
+    return isinstance(value, str) and value.startswith("=")
+
+
+class FormulaError(Exception):
+    """Erreur d'évaluation, propagée comme une valeur d'erreur Excel (#DIV/0!, #NAME?...)"""
+
+
+FORMULA_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<string>"(?:[^"]|"")*")
+      | (?P<ref>(?:(?:'(?:[^']|'')+'|[A-Za-z_][\w.]*)!)?
+                (?:\$?[A-Za-z]{1,3}\$?\d+(?::\$?[A-Za-z]{1,3}\$?\d+)?|\$?[A-Za-z]{1,3}:\$?[A-Za-z]{1,3}))
+      | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+)
+      | (?P<name>[A-Za-z_][\w.]*)
+      | (?P<op><>|<=|>=|[-+*/&=<>(),:])
+    )""", re.VERBOSE)
+
+CELL_REF = re.compile(r"\$?([A-Za-z]{1,3})\$?(\d*)")
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_formula(formula):
+    """Analyse une formule ("=...") en arbre de tuples; les arbres sont partagés via le cache"""
+    tokens = []
+    position = 0
+    text = formula[1:]
+    while position < len(text):
+        match = FORMULA_TOKEN.match(text, position)
+        if not match or match.end() == position:
+            if text[position:].strip():
+                raise FormulaError("#NAME?")
+            break
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    tokens.append(("end", None))
+
+    index = 0
+
+    def peek():
+        return tokens[index]
+
+    def take(expected=None):
+        nonlocal index
+        token = tokens[index]
+        if expected is not None and token[1] != expected:
+            raise FormulaError("#NAME?")
+        index += 1
+        return token
+
+    def comparison():
+        node = concatenation()
+        while peek()[0] == "op" and peek()[1] in ("=", "<>", "<", ">", "<=", ">="):
+            op = take()[1]
+            node = ("op", op, node, concatenation())
+        return node
+
+    def concatenation():
+        node = additive()
+        while peek() == ("op", "&"):
+            take()
+            node = ("op", "&", node, additive())
+        return node
+
+    def additive():
+        node = multiplicative()
+        while peek()[0] == "op" and peek()[1] in ("+", "-"):
+            op = take()[1]
+            node = ("op", op, node, multiplicative())
+        return node
+
+    def multiplicative():
+        node = unary()
+        while peek()[0] == "op" and peek()[1] in ("*", "/"):
+            op = take()[1]
+            node = ("op", op, node, unary())
+        return node
+
+    def unary():
+        if peek()[0] == "op" and peek()[1] in ("-", "+"):
+            op = take()[1]
+            operand = unary()
+            return ("neg", operand) if op == "-" else operand
+        return primary()
+
+    def primary():
+        kind, value = take()
+        if kind == "number":
+            return ("const", float(value))
+        if kind == "string":
+            return ("const", value[1:-1].replace('""', '"'))
+        if kind == "ref":
+            return parse_reference(value)
+        if kind == "name":
+            name = value.upper()
+            if peek() == ("op", "("):
+                take("(")
+                args = []
+                if peek() != ("op", ")"):
+                    args.append(comparison())
+                    while peek() == ("op", ","):
+                        take()
+                        args.append(comparison())
+                take(")")
+                return ("call", name, tuple(args))
+            if name in ("TRUE", "FALSE"):
+                return ("const", name == "TRUE")
+        if (kind, value) == ("op", "("):
+            node = comparison()
+            take(")")
+            return node
+        raise FormulaError("#NAME?")
+
+    node = comparison()
+    if peek()[0] != "end":
+        raise FormulaError("#NAME?")
+    return node
+
+
+def parse_reference(text):
+    """Référence de cellule ou de plage: ("cell", feuille, ligne, col) ou ("range", feuille, c1, r1, c2, r2)"""
+    sheet = None
+    if "!" in text:
+        sheet, text = text.rsplit("!", 1)
+        if sheet.startswith("'"):
+            sheet = sheet[1:-1].replace("''", "'")
+
+    bounds = []
+    for part in text.split(":"):
+        letters, digits = CELL_REF.fullmatch(part).groups()
+        bounds.append((column_index(letters.upper()), int(digits) if digits else None))
+
+    if len(bounds) == 1:
+        col, row = bounds[0]
+        return ("cell", sheet, row, col)
+    (c1, r1), (c2, r2) = bounds
+    # Colonne entière (A:A): de la ligne 1 à la dernière ligne de la feuille
+    return ("range", sheet, min(c1, c2), r1 or 1, max(c1, c2), r2)
+
+
+class CellRange:
+    """Plage rectangulaire passée en argument d'une fonction"""
+
+    def __init__(self, sheet, c1, r1, c2, r2):
+        self.sheet, self.c1, self.r1, self.c2, self.r2 = sheet, c1, r1, c2, r2
+
+    def key(self):
+        return (self.sheet, self.c1, self.r1, self.c2, self.r2)
+
+
+def criterion_key(value):
+    """Clé de comparaison d'un critère SUMIF/COUNTIF (texte insensible à la casse)"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value.lower()
+    return value
+
+
+class FormulaEvaluator:
+    """Évalue dans l'application les formules écrites par StockMaster Pro.
+
+    Fonctions prises en charge: SUMIF, COUNTIF, COUNTA, SUM, MAX, MIN, IF,
+    références et plages (y compris entre feuilles et colonnes entières),
+    opérateurs arithmétiques et de comparaison.
+
+    Les valeurs sont mises en cache avec leurs dépendances: modifier une
+    cellule (invalidate) n'invalide que les formules qui en dépendent,
+    directement ou par une plage. SUMIF/COUNTIF s'appuient sur un index
+    {critère: total} par plage, construit une fois puis réutilisé par toutes
+    les lignes qui interrogent la même plage.
+    """
+
+    def __init__(self, wb):
+        self.wb = wb
+        self.clear()
+
+    def clear(self):
+        """Oublie toutes les valeurs calculées (après suppression de lignes, par exemple)"""
+        self.cache = {}
+        self.dependents = {}
+        self.range_dependents = {}
+        self.indexes = {}
+        self.in_progress = set()
+
+    def raw(self, sheet, row, col):
+        return self.wb[sheet].cell(row=row, column=col).value
+
+    def value(self, sheet, row, col):
+        """Valeur d'une cellule, en évaluant sa formule si nécessaire"""
+        key = (sheet, row, col)
+        if key in self.cache:
+            return self.cache[key]
+
+        raw = self.raw(sheet, row, col)
+        if not is_formula(raw):
+            return raw
+        if key in self.in_progress:
+            return "#CIRC!"  # Référence circulaire
+
+        self.in_progress.add(key)
+        try:
+            result = self.evaluate(parse_formula(raw), sheet, key)
+            if isinstance(result, CellRange):
+                raise FormulaError("#VALUE!")
+        except FormulaError as e:
+            result = str(e)
+        except (ArithmeticError, ValueError, TypeError):
+            result = "#VALUE!"
+        finally:
+            self.in_progress.discard(key)
+
+        self.cache[key] = result
+        return result
+
+    def invalidate(self, sheet, row, col):
+        """Signale la modification d'une cellule: les formules qui en dépendent seront recalculées"""
+        pending = [(sheet, row, col)]
+        while pending:
+            key = pending.pop()
+            self.cache.pop(key, None)
+            pending.extend(self.dependents.pop(key, ()))
+
+            sheet_name, r, c = key
+            for range_key in list(self.range_dependents.get(sheet_name, {})):
+                _, c1, r1, c2, r2 = range_key
+                if c1 <= c <= c2 and r >= r1 and (r2 is None or r <= r2):
+                    pending.extend(self.range_dependents[sheet_name].pop(range_key))
+                    for index_key in [k for k in self.indexes if k[0] == range_key or k[1] == range_key]:
+                        del self.indexes[index_key]
+
+    def invalidate_sheet(self, sheet):
+        """Signale une réécriture complète d'une feuille"""
+        for key in [k for k in self.cache if k[0] == sheet]:
+            self.invalidate(*key)
+        ranges = self.range_dependents.pop(sheet, {})
+        self.indexes = {k: v for k, v in self.indexes.items()
+                        if k[0][0] != sheet and (k[1] is None or k[1][0] != sheet)}
+        for dependents in ranges.values():
+            for key in dependents:
+                self.invalidate(*key)
+
+    # -- Évaluation ------------------------------------------------------------
+
+    def evaluate(self, node, sheet, owner):
+        kind = node[0]
+        if kind == "const":
+            return node[1]
+        if kind == "cell":
+            _, ref_sheet, row, col = node
+            ref_sheet = ref_sheet or sheet
+            self.dependents.setdefault((ref_sheet, row, col), set()).add(owner)
+            value = self.value(ref_sheet, row, col)
+            if isinstance(value, str) and value.startswith("#"):
+                raise FormulaError(value)
+            return value
+        if kind == "range":
+            _, ref_sheet, c1, r1, c2, r2 = node
+            cell_range = CellRange(ref_sheet or sheet, c1, r1, c2, r2)
+            self.range_dependents.setdefault(cell_range.sheet, {}).setdefault(cell_range.key(), set()).add(owner)
+            return cell_range
+        if kind == "neg":
+            return -self.number(self.evaluate(node[1], sheet, owner))
+        if kind == "op":
+            return self.operate(node[1], self.evaluate(node[2], sheet, owner), self.evaluate(node[3], sheet, owner))
+        if kind == "call":
+            function = getattr(self, "fn_" + node[1].lower(), None)
+            if function is None:
+                raise FormulaError("#NAME?")
+            return function([self.evaluate(arg, sheet, owner) for arg in node[2]])
+        raise FormulaError("#NAME?")
+
+    @staticmethod
+    def number(value):
+        if value is None or value == "":
+            return 0.0
+        if isinstance(value, bool):
+            return float(value)
+        if isinstance(value, (int, float)):
+            return value
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise FormulaError("#VALUE!")
+
+    def operate(self, op, left, right):
+        if op == "&":
+            return f"{'' if left is None else left}{'' if right is None else right}"
+        if op in ("+", "-", "*", "/"):
+            left, right = self.number(left), self.number(right)
+            if op == "+":
+                return left + right
+            if op == "-":
+                return left - right
+            if op == "*":
+                return left * right
+            if right == 0:
+                raise FormulaError("#DIV/0!")
+            return left / right
+
+        left, right = criterion_key(left if left is not None else 0), criterion_key(right if right is not None else 0)
+        if type(left) is not type(right):
+            left, right = str(left), str(right)
+        return {"=": left == right, "<>": left != right, "<": left < right,
+                ">": left > right, "<=": left <= right, ">=": left >= right}[op]
+
+    def cells(self, cell_range):
+        """Valeurs d'une plage, ligne par ligne (une colonne entière s'arrête à la dernière ligne)"""
+        ws = self.wb[cell_range.sheet]
+        last = cell_range.r2 if cell_range.r2 is not None else ws.max_row
+        for row in range(cell_range.r1, min(last, ws.max_row) + 1):
+            for col in range(cell_range.c1, cell_range.c2 + 1):
+                yield self.value(cell_range.sheet, row, col)
+
+    def flatten(self, args):
+        for arg in args:
+            if isinstance(arg, CellRange):
+                yield from self.cells(arg)
+            else:
+                yield arg
+
+    def fn_if(self, args):
+        if len(args) < 2:
+            raise FormulaError("#VALUE!")
+        condition = args[0]
+        if isinstance(condition, str):
+            condition = condition.lower() == "true"
+        return args[1] if condition else (args[2] if len(args) > 2 else False)
+
+    def fn_sum(self, args):
+        return sum(v for v in self.flatten(args) if isinstance(v, (int, float)) and not isinstance(v, bool))
+
+    def fn_max(self, args):
+        values = [v for v in self.flatten(args) if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        return max(values) if values else 0
+
+    def fn_min(self, args):
+        values = [v for v in self.flatten(args) if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        return min(values) if values else 0
+
+    def fn_counta(self, args):
+        return sum(1 for v in self.flatten(args) if v is not None and v != "")
+
+    def fn_sumif(self, args):
+        if len(args) not in (2, 3) or not isinstance(args[0], CellRange):
+            raise FormulaError("#VALUE!")
+        sum_range = args[2] if len(args) == 3 else args[0]
+        if not isinstance(sum_range, CellRange):
+            raise FormulaError("#VALUE!")
+        return self.conditional(args[0], args[1], sum_range)
+
+    def fn_countif(self, args):
+        if len(args) != 2 or not isinstance(args[0], CellRange):
+            raise FormulaError("#VALUE!")
+        return self.conditional(args[0], args[1], None)
+
+    def conditional(self, criteria_range, criterion, sum_range):
+        """SUMIF/COUNTIF: égalité via l'index de la plage, autres opérateurs par parcours"""
+        op, target = "=", criterion
+        if isinstance(criterion, str):
+            for prefix in ("<>", "<=", ">=", "<", ">", "="):
+                if criterion.startswith(prefix):
+                    op, target = prefix, criterion[len(prefix):]
+                    break
+
+        if op == "=":
+            return self.index(criteria_range, sum_range).get(criterion_key(target), 0)
+
+        total = 0
+        for key, value in self.pairs(criteria_range, sum_range):
+            if self.operate(op, key, target):
+                total += value
+        return total
+
+    def pairs(self, criteria_range, sum_range):
+        """(valeur du critère, valeur sommée) pour chaque cellule de la plage de critères.
+
+        Comme Excel, la plage sommée prend la forme de la plage de critères à
+        partir de sa cellule en haut à gauche.
+        """
+        ws = self.wb[criteria_range.sheet]
+        last = criteria_range.r2 if criteria_range.r2 is not None else ws.max_row
+        for row in range(criteria_range.r1, min(last, ws.max_row) + 1):
+            for offset in range(criteria_range.c2 - criteria_range.c1 + 1):
+                key = self.value(criteria_range.sheet, row, criteria_range.c1 + offset)
+                if sum_range is None:
+                    yield key, 1
+                    continue
+                value = self.value(sum_range.sheet, sum_range.r1 + row - criteria_range.r1, sum_range.c1 + offset)
+                yield key, value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+    def index(self, criteria_range, sum_range):
+        """Index {critère: total} d'une plage, conservé jusqu'à la modification d'une de ses cellules"""
+        # La plage sommée effective a la forme de la plage de critères
+        if sum_range is not None:
+            rows = None if criteria_range.r2 is None else criteria_range.r2 - criteria_range.r1
+            sum_range = CellRange(sum_range.sheet, sum_range.c1, sum_range.r1,
+                                  sum_range.c1 + criteria_range.c2 - criteria_range.c1,
+                                  None if rows is None else sum_range.r1 + rows)
+            self.range_dependents.setdefault(sum_range.sheet, {}).setdefault(sum_range.key(), set())
+
+        key = (criteria_range.key(), sum_range.key() if sum_range is not None else None)
+        index = self.indexes.get(key)
+        if index is None:
+            index = {}
+            for criterion, value in self.pairs(criteria_range, sum_range):
+                if criterion is None or criterion == "":
+                    continue
+                criterion = criterion_key(criterion)
+                index[criterion] = index.get(criterion, 0) + value
+            self.indexes[key] = index
+        return index
+
+
+
+def read_catalog(wb, sheets=None):
+    """Lit les colorants et les produits auxiliaires (ou seulement les feuilles de `sheets`)"""
+    catalog = {
+        'colorants': [], 'colorant_names': {}, 'stock_min': {}, 'stocks': {}, 'stock_initial': {},
+        'auxiliaires': [], 'aux_names': {}, 'aux_stock_min': {}, 'aux_stocks': {}, 'aux_stock_initial': {},
+    }
+    
+    # Colorants (Liste des articles2)
+    if sheets is None or 'Liste des articles2' in sheets:
+        with PROFILER.measure("load_data:Liste des articles2"):
+            for values in wb['Liste des articles2'].iter_rows(min_row=2, max_col=6, values_only=True):
+                ref = values[0] if values else None
+                if ref:
+                    ref = str(ref)
+                    catalog['colorants'].append(ref)
+                    catalog['colorant_names'][ref] = values[1] if values[1] else ref
+                    catalog['stock_initial'][ref] = to_float(values[2])
+                    catalog['stock_min'][ref] = to_float(values[3])
+                    catalog['stocks'][ref] = to_float(values[5])
+    
+    # Produits auxiliaires
+    if "Produits auxiliaires" in wb.sheetnames and (sheets is None or "Produits auxiliaires" in sheets):
+        with PROFILER.measure("load_data:Produits auxiliaires"):
+            for values in wb["Produits auxiliaires"].iter_rows(min_row=2, max_col=6, values_only=True):
+                ref = values[0] if values else None
+                if ref:
+                    ref = str(ref)
+                    catalog['auxiliaires'].append(ref)
+                    catalog['aux_names'][ref] = values[1] or ref
+                    catalog['aux_stock_initial'][ref] = to_float(values[2])
+                    catalog['aux_stock_min'][ref] = to_float(values[3])
+                    catalog['aux_stocks'][ref] = to_float(values[5])
+    
+    return catalog
+
+
+# Colonne masquée des identifiants permanents (feuilles Consommation et commandes)
+ID_COLUMN = 10
+ID_HEADER = "ID"
+
+
+def to_id(value):
+    """Identifiant lu dans la colonne masquée (None si absent ou invalide)"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return value
+    return None
+
+
+def allocate_ids(sheet, items):
+    """Attribue un identifiant aux lignes qui n'en ont pas (ou dont l'identifiant est en double).
+    
+    Les identifiants ne sont jamais réutilisés: une ligne vidée par une
+    suppression garde le sien, qui compte pour le calcul du suivant. `sheet`
+    peut être en lecture seule (XlsxReader): l'attribution se fait en mémoire,
+    write_ids l'écrit ensuite dans la colonne masquée. Retourne (prochain
+    identifiant, éléments auxquels un identifiant a été attribué).
+    """
+    next_id = 1
+    for (value,) in sheet.iter_rows(min_row=2, min_col=ID_COLUMN, max_col=ID_COLUMN, values_only=True):
+        value = to_id(value)
+        if value is not None and value >= next_id:
+            next_id = value + 1
+    
+    seen = set()
+    assigned = []
+    for item in items:
+        if item['id'] is None or item['id'] in seen:
+            item['id'] = next_id
+            next_id += 1
+            assigned.append(item)
+        seen.add(item['id'])
+    return next_id, assigned
+
+
+def write_ids(sheet, items):
+    """Écrit dans la colonne masquée les identifiants attribués par allocate_ids"""
+    for item in items:
+        sheet.cell(row=item['row'], column=ID_COLUMN, value=item['id'])
+    if items:
+        sheet.cell(row=1, column=ID_COLUMN, value=ID_HEADER)
+    sheet.column_dimensions[openpyxl.utils.get_column_letter(ID_COLUMN)].hidden = True
+
+
+@PROFILER.timed("load_data:Consommation")
+def read_consumption_history(wb):
+    """Lit l'historique des consommations"""
+    history = []
+    rows = wb['Consommation'].iter_rows(min_row=2, max_col=LOCATION_COLUMN, values_only=True)
+    for row, values in enumerate(rows, start=2):
+        values = tuple(values) + (None,) * (LOCATION_COLUMN - len(values))
+        ref, date_val, qty = values[:3]
+        if ref and date_val and qty:
+            try:
+                if isinstance(date_val, datetime):
+                    date_str = date_val.strftime('%Y-%m-%d')
+                else:
+                    date_str = str(date_val)
+                
+                history.append({
+                    'ref': str(ref),
+                    'date': date_str,
+                    'qty': float(qty),
+                    'id': to_id(values[ID_COLUMN - 1]),  # Identifiant permanent (colonne masquée)
+                    'row': row,
+                    'lots': decode_draws(values[LOT_COLUMN - 1]),
+                    'commande': str(values[COMMANDE_LINK_COLUMN - 1]) if values[COMMANDE_LINK_COLUMN - 1] else None,
+                    'emplacement': location_name(values[LOCATION_COLUMN - 1])
+                })
+            except (TypeError, ValueError):
+                continue
+    return history
+
+
+@PROFILER.timed("load_data:commandes")
+def read_commandes(wb):
+    """Lit la liste des commandes"""
+    commandes = []
+    rows = wb['commandes'].iter_rows(min_row=2, max_col=ID_COLUMN, values_only=True)
+    for row, values in enumerate(rows, start=2):
+        values = tuple(values) + (None,) * (ID_COLUMN - len(values))
+        if values[0]:
+            commandes.append({
+                'ref': values[0],
+                'code': values[1],
+                'date_entree': values[2],
+                'date_sortie': values[3],
+                'delai': values[4],
+                'statut': values[6],
+                'observation': values[7],
+                'id': to_id(values[ID_COLUMN - 1]),  # Identifiant permanent (colonne masquée)
+                'row': row
+            })
+    return commandes
+
+
+# Feuille des réceptions de marchandises: une ligne par ligne de bon, lot et péremption compris
+RECEPTION_SHEET = "Réceptions"
+RECEPTION_COLUMNS = (
+    (1, 'date', "DATE"), (2, 'document', "BON DE RECEPTION"), (3, 'ref', "REFERENCE"),
+    (4, 'qty', "QUANTITE"), (5, 'lot', "LOT"), (6, 'peremption', "PEREMPTION"), (7, 'prix', "PRIX UNITAIRE"),
+    (8, 'emplacement', "EMPLACEMENT"),
+)
+
+
+@PROFILER.timed("load_data:Réceptions")
+def read_receptions(wb):
+    """Lit les lignes des bons de réception (aucune si la feuille n'existe pas encore)"""
+    receptions = []
+    if RECEPTION_SHEET not in wb.sheetnames:
+        return receptions
+    rows = wb[RECEPTION_SHEET].iter_rows(min_row=2, max_col=len(RECEPTION_COLUMNS), values_only=True)
+    for row, values in enumerate(rows, start=2):
+        values = tuple(values) + (None,) * (len(RECEPTION_COLUMNS) - len(values))
+        date_val, document, ref, qty, lot, expiry, price, location = values
+        if not ref or not qty:
+            continue
+        try:
+            qty = float(qty)
+        except (TypeError, ValueError):
+            continue
+        receptions.append({
+            'date': str(to_date(date_val) or ""),
+            'document': str(document or ""),
+            'ref': str(ref),
+            'qty': qty,
+            'lot': str(lot or ""),
+            'peremption': str(to_date(expiry) or ""),
+            'prix': to_float(price),
+            'emplacement': location_name(location),
+            'row': row
+        })
+    return receptions
+
+
+def reception_key(item):
+    """Identité d'une ligne de réception"""
+    return item['document'], item['ref'], item['lot'], item['qty']
+
+
+# Ordre de sortie des lots: "FEFO" (premier périmé, premier sorti) ou "FIFO" (premier reçu, premier sorti)
+LOT_POLICY = "FEFO"
+# Alerte de péremption: lots qui expirent dans moins de LOT_EXPIRY_WARNING jours
+LOT_EXPIRY_WARNING = 30
+# Colonne masquée de la feuille Consommation: lots prélevés par la consommation ("L1:2.5;L2:0.5")
+LOT_COLUMN = ID_COLUMN + 1
+LOT_HEADER = "LOTS"
+# Colonne masquée de la feuille Consommation: commande dont la recette a produit la consommation
+COMMANDE_LINK_COLUMN = LOT_COLUMN + 1
+COMMANDE_LINK_HEADER = "COMMANDE"
+
+
+def encode_draws(draws):
+    """Prélèvements [(lot, quantité)] sous forme compacte pour la colonne masquée"""
+    return ";".join(f"{lot}:{qty:g}" for lot, qty in draws) or None
+
+
+def decode_draws(value):
+    """Prélèvements lus dans la colonne masquée (None si la consommation n'a pas été affectée à des lots)"""
+    if not value:
+        return None
+    draws = []
+    for part in str(value).split(";"):
+        lot, _, qty = part.rpartition(":")
+        try:
+            draws.append((lot, float(qty)))
+        except ValueError:
+            continue
+    return draws
+
+
+class LotStore:
+    """Stock par lot des produits reçus.
+    
+    Un enregistrement par (produit, lot): quantité reçue, reste, date de
+    réception et de péremption. Par produit, deux files de priorité (tas):
+    - l'ordre de sortie (FEFO ou FIFO), pour qu'un prélèvement coûte
+      O(log lots) au lieu d'un parcours;
+    - l'ordre de péremption, dont le sommet donne en temps constant le
+      prochain lot à expirer (alertes).
+    Les lots épuisés ou retirés sont éliminés des tas au moment où ils en
+    atteignent le sommet. La part de stock qui n'appartient à aucun lot
+    (stock saisi avant le suivi par lot) n'est pas suivie ici.
+    
+    Chaque lot porte son prix d'achat (moyenne de ses lignes de réception):
+    la valeur des lots restants de chaque produit est tenue à jour à chaque
+    mouvement, et un prélèvement coûte le prix des lots réellement sortis.
+    """
+
+    EPSILON = 1e-9
+
+    def __init__(self, policy=LOT_POLICY):
+        self.policy = policy
+        self.lots = {}
+        self.draw_heaps = {}
+        self.expiry_heaps = {}
+        self.values = {}
+        self.sequence = 0
+
+    @classmethod
+    def build(cls, receptions, history, policy=LOT_POLICY):
+        """Lots reçus, diminués des prélèvements enregistrés sur les consommations"""
+        store = cls(policy)
+        for item in receptions:
+            store.receive(item)
+        for item in history:
+            if item.get('lots'):
+                store.take(item['ref'], item['lots'])
+        return store
+
+    def draw_key(self, lot):
+        if self.policy == "FIFO":
+            return lot['date'], lot['lot']
+        return lot['peremption'] or "9999-12-31", lot['date'], lot['lot']
+
+    def push(self, ref, lot):
+        """Place un lot disponible dans les tas de son produit (une seule fois par tas)"""
+        if lot['reste'] <= self.EPSILON:
+            return
+        self.sequence += 1
+        if not lot['in_draw']:
+            heapq.heappush(self.draw_heaps.setdefault(ref, []), (self.draw_key(lot), self.sequence, lot))
+            lot['in_draw'] = True
+        if lot['peremption'] and not lot['in_expiry']:
+            heapq.heappush(self.expiry_heaps.setdefault(ref, []), (lot['peremption'], self.sequence, lot))
+            lot['in_expiry'] = True
+
+    def top(self, heaps, flag, ref):
+        """Premier lot valide d'un tas (les entrées épuisées ou retirées sont éliminées au passage)"""
+        heap = heaps.get(ref)
+        while heap:
+            lot = heap[0][2]
+            if lot['reste'] > self.EPSILON and self.lots.get(ref, {}).get(lot['lot']) is lot:
+                return lot
+            heapq.heappop(heap)
+            lot[flag] = False
+        return None
+
+    def receive(self, item, sign=1):
+        """Reporte une ligne de réception sur son lot (sign=-1 pour la retirer)"""
+        by_lot = self.lots.setdefault(item['ref'], {})
+        lot = by_lot.get(item['lot'])
+        if lot is None:
+            lot = by_lot[item['lot']] = {'lot': item['lot'], 'peremption': item['peremption'],
+                                         'date': item['date'], 'qty': 0.0, 'reste': 0.0,
+                                         'prix': 0.0, 'montant': 0.0,
+                                         'in_draw': False, 'in_expiry': False}
+        before = lot['reste'] * lot['prix']
+        lot['qty'] += sign * item['qty']
+        lot['reste'] += sign * item['qty']
+        lot['montant'] += sign * item['qty'] * (item.get('prix') or 0.0)
+        lot['prix'] = lot['montant'] / lot['qty'] if lot['qty'] > self.EPSILON else 0.0
+        self.add_value(item['ref'], lot['reste'] * lot['prix'] - before)
+        if sign < 0 and lot['qty'] <= self.EPSILON:
+            del by_lot[item['lot']]
+            if not by_lot:
+                del self.lots[item['ref']]
+        else:
+            self.push(item['ref'], lot)
+
+    def draw(self, ref, qty):
+        """Prélève `qty` dans les lots du produit, dans l'ordre de sortie; retourne [(lot, quantité)].
+        
+        Si les lots ne suffisent pas, le reste est pris sur le stock hors lot.
+        """
+        draws = []
+        while qty > self.EPSILON:
+            lot = self.top(self.draw_heaps, 'in_draw', ref)
+            if lot is None:
+                break
+            taken = min(qty, lot['reste'])
+            lot['reste'] -= taken
+            self.add_value(ref, -taken * lot['prix'])
+            qty -= taken
+            draws.append((lot['lot'], taken))
+        return draws
+
+    def take(self, ref, draws):
+        """Rejoue des prélèvements connus (chargement, rétablissement)"""
+        for lot_name, qty in draws:
+            lot = self.lots.get(ref, {}).get(lot_name)
+            if lot is not None:
+                lot['reste'] -= qty
+                self.add_value(ref, -qty * lot['prix'])
+
+    def give_back(self, ref, draws):
+        """Annule des prélèvements: les quantités reviennent dans leurs lots"""
+        for lot_name, qty in draws:
+            lot = self.lots.get(ref, {}).get(lot_name)
+            if lot is not None:
+                lot['reste'] += qty
+                self.add_value(ref, qty * lot['prix'])
+                self.push(ref, lot)
+
+    def add_value(self, ref, amount):
+        value = self.values.get(ref, 0.0) + amount
+        if abs(value) > self.EPSILON:
+            self.values[ref] = value
+        else:
+            self.values.pop(ref, None)
+
+    def value(self, ref):
+        """Valeur des lots restants du produit, à leur prix d'achat"""
+        return self.values.get(ref, 0.0)
+
+    def draw_cost(self, ref, draws):
+        """Coût d'achat de prélèvements [(lot, quantité)]"""
+        by_lot = self.lots.get(ref, {})
+        return sum(qty * by_lot[lot_name]['prix'] for lot_name, qty in draws if lot_name in by_lot)
+
+    def available(self, ref):
+        """Lots du produit ayant encore du stock, dans l'ordre de sortie"""
+        return sorted((lot for lot in self.lots.get(ref, {}).values() if lot['reste'] > self.EPSILON),
+                      key=self.draw_key)
+
+    def next_expiry(self, ref):
+        """Prochain lot du produit à expirer (None si aucun lot daté en stock)"""
+        return self.top(self.expiry_heaps, 'in_expiry', ref)
+
+    def expiring(self, limit):
+        """(produit, prochain lot à expirer) des produits dont ce lot expire au plus tard à la date `limit`"""
+        for ref in list(self.expiry_heaps):
+            lot = self.next_expiry(ref)
+            if lot is not None and lot['peremption'] <= limit:
+                yield ref, lot
+
+
+class StockValuation:
+    """Valorisation du stock au coût moyen pondéré (CMP), tenue à jour avec les mouvements.
+    
+    Par produit: quantité valorisée (reçue avec un prix, moins les sorties)
+    et sa valeur. Une réception avec prix recalcule le CMP; une réception
+    sans prix entre au CMP du moment. Chaque réception garde le CMP qui la
+    précédait (item['cmp_precedent']), rétabli si son retrait vide le stock
+    valorisé. Une consommation sort au CMP du moment et garde son coût et
+    la part valorisée sortie (item['cout']) pour qu'une annulation rende
+    exactement la même valeur. Les coûts des consommations sont cumulés par
+    mois et par commande. Au chargement, les mouvements sont rejoués dans
+    l'ordre des dates (les réceptions d'un jour avant ses consommations).
+    """
+
+    def __init__(self):
+        self.positions = {}   # ref -> [quantité valorisée, valeur]
+        self.unit_costs = {}  # ref -> CMP, conservé quand le stock valorisé est épuisé
+        self.periods = {}     # AAAA-MM -> coût des consommations du mois
+        self.commandes = {}   # référence de commande -> coût des consommations de la commande
+
+    @classmethod
+    def build(cls, receptions, history):
+        valuation = cls()
+        moves = [(iso_date(item['date']) or "", 0, item) for item in receptions]
+        moves += [(iso_date(item['date']) or "", 1, item) for item in history]
+        moves.sort(key=lambda move: move[:2])
+        for _, kind, item in moves:
+            if kind == 0:
+                valuation.receive(item)
+            else:
+                valuation.consume(item)
+        return valuation
+
+    def unit_cost(self, ref):
+        """Coût moyen pondéré d'un kg du produit (0 si aucune réception avec prix)"""
+        return self.unit_costs.get(ref, 0.0)
+
+    def value(self, ref, stock):
+        """Valeur au CMP d'un stock réel du produit"""
+        return max(stock, 0.0) * self.unit_cost(ref)
+
+    def receive(self, item, sign=1):
+        """Reporte une ligne de réception (sign=-1 pour la retirer)"""
+        ref = item['ref']
+        price = item.get('prix') or self.unit_cost(ref)
+        if not price:
+            return
+        if sign > 0:
+            item['cmp_precedent'] = self.unit_costs.get(ref)
+        position = self.positions.setdefault(ref, [0.0, 0.0])
+        position[0] += sign * item['qty']
+        position[1] += sign * item['qty'] * price
+        if position[0] > LotStore.EPSILON:
+            self.unit_costs[ref] = position[1] / position[0]
+        else:
+            position[0] = position[1] = 0.0
+            if sign < 0:
+                # Réception retirée: le CMP qu'elle avait fixé disparaît avec elle
+                previous = item.get('cmp_precedent')
+                if previous is None:
+                    self.unit_costs.pop(ref, None)
+                else:
+                    self.unit_costs[ref] = previous
+
+    def consume(self, item, sign=1):
+        """Sort une consommation au CMP (sign=-1 pour l'annuler au coût enregistré)"""
+        ref = item['ref']
+        position = self.positions.setdefault(ref, [0.0, 0.0])
+        if sign > 0:
+            cost = item['qty'] * self.unit_cost(ref)
+            taken = min(item['qty'], position[0])
+            item['cout'] = cost, taken, taken * self.unit_cost(ref)
+        cost, taken, amount = item.get('cout') or (0.0, 0.0, 0.0)
+        position[0] -= sign * taken
+        position[1] -= sign * amount
+        if position[0] <= LotStore.EPSILON:
+            position[0] = position[1] = 0.0
+        
+        self.add(self.periods, str(item['date'])[:7], sign * cost)
+        if item.get('commande'):
+            self.add(self.commandes, item['commande'], sign * cost)
+
+    @staticmethod
+    def add(totals, key, amount):
+        value = totals.get(key, 0.0) + amount
+        if abs(value) > LotStore.EPSILON:
+            totals[key] = value
+        else:
+            totals.pop(key, None)
+
+
+# Emplacements de stock (cuisine des couleurs, magasin, entrepôt de débord...): le stock saisi
+# dans les feuilles produits et les mouvements sans emplacement appartiennent au magasin principal
+DEFAULT_LOCATION = "Magasin principal"
+LOCATION_SHEET = "Emplacements"
+LOCATION_COLUMNS = ((1, 'emplacement', "EMPLACEMENT"), (2, 'ref', "REFERENCE"), (3, 'minimum', "STOCK MINIMAL"))
+TRANSFER_SHEET = "Transferts"
+TRANSFER_COLUMNS = (
+    (1, 'date', "DATE"), (2, 'ref', "REFERENCE"), (3, 'de', "DE"), (4, 'vers', "VERS"), (5, 'qty', "QUANTITE"),
+)
+# Colonne masquée de la feuille Consommation: emplacement où le produit a été prélevé
+LOCATION_COLUMN = COMMANDE_LINK_COLUMN + 1
+LOCATION_HEADER = "EMPLACEMENT"
+
+
+def location_name(value):
+    """Nom d'emplacement d'une cellule ou d'une saisie (vide: magasin principal)"""
+    return str(value or "").strip() or DEFAULT_LOCATION
+
+
+@PROFILER.timed("load_data:Emplacements")
+def read_locations(wb):
+    """Lit les emplacements et leurs stocks minimaux par produit (aucun si la feuille n'existe pas encore)"""
+    rows = []
+    if LOCATION_SHEET not in wb.sheetnames:
+        return rows
+    for values in wb[LOCATION_SHEET].iter_rows(min_row=2, max_col=len(LOCATION_COLUMNS), values_only=True):
+        values = tuple(values) + (None,) * (len(LOCATION_COLUMNS) - len(values))
+        location, ref, minimum = values
+        if str(location or "").strip():
+            rows.append({'emplacement': location_name(location), 'ref': str(ref or "").strip(),
+                         'minimum': to_float(minimum)})
+    return rows
+
+
+@PROFILER.timed("load_data:Transferts")
+def read_transfers(wb):
+    """Lit les transferts entre emplacements (aucun si la feuille n'existe pas encore)"""
+    transfers = []
+    if TRANSFER_SHEET not in wb.sheetnames:
+        return transfers
+    rows = wb[TRANSFER_SHEET].iter_rows(min_row=2, max_col=len(TRANSFER_COLUMNS), values_only=True)
+    for row, values in enumerate(rows, start=2):
+        values = tuple(values) + (None,) * (len(TRANSFER_COLUMNS) - len(values))
+        date_val, ref, source, target, qty = values
+        qty = to_float(qty)
+        if not ref or qty <= 0:
+            continue
+        transfers.append({'date': str(to_date(date_val) or ""), 'ref': str(ref), 'de': location_name(source),
+                          'vers': location_name(target), 'qty': qty, 'row': row})
+    return transfers
+
+
+def transfer_key(item):
+    """Identité d'un transfert"""
+    return item['date'], item['ref'], item['de'], item['vers'], item['qty']
+
+
+class LocationStock:
+    """Stock des produits par emplacement.
+    
+    Le stock total de chaque produit reste celui du modèle (stocks,
+    aux_stocks): les vues existantes n'en dépendent pas. Ici sont indexées
+    par (produit, emplacement) les quantités hors du magasin principal, avec
+    leur somme par produit; le stock du magasin principal est le total moins
+    cette somme. Chaque mouvement (réception, consommation, transfert) met à
+    jour une ou deux entrées: toutes les lectures sont en temps constant.
+    """
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.quantities = {}  # (ref, emplacement) -> quantité, hors magasin principal
+        self.placed = {}      # ref -> somme des quantités hors magasin principal
+        self.by_ref = {}      # ref -> emplacements où le produit est présent
+        self.names = [DEFAULT_LOCATION]
+        self.minimums = {}    # (ref, emplacement) -> stock minimal
+        for row in self.rows:
+            self.add_location(row['emplacement'])
+            if row['ref']:
+                self.minimums[row['ref'], row['emplacement']] = row['minimum']
+
+    @classmethod
+    def build(cls, rows, receptions, history, transfers):
+        store = cls(rows)
+        for item in receptions:
+            store.receive(item)
+        for item in history:
+            store.consume(item)
+        for item in transfers:
+            store.transfer(item)
+        return store
+
+    def add_location(self, name):
+        if name not in self.names:
+            self.names.append(name)
+
+    def move(self, ref, location, qty):
+        """Ajoute `qty` (négative pour une sortie) au stock du produit à l'emplacement"""
+        location = location_name(location)
+        if location == DEFAULT_LOCATION:
+            return
+        self.add_location(location)
+        key = ref, location
+        value = self.quantities.get(key, 0.0) + qty
+        placed = self.placed.get(ref, 0.0) + qty
+        if abs(value) > LotStore.EPSILON:
+            self.quantities[key] = value
+            self.by_ref.setdefault(ref, set()).add(location)
+        else:
+            self.quantities.pop(key, None)
+            self.by_ref.get(ref, set()).discard(location)
+        if abs(placed) > LotStore.EPSILON:
+            self.placed[ref] = placed
+        else:
+            self.placed.pop(ref, None)
+
+    def quantity(self, ref, location, total):
+        """Stock du produit à l'emplacement, `total` étant son stock tous emplacements confondus"""
+        location = location_name(location)
+        if location == DEFAULT_LOCATION:
+            return total - self.placed.get(ref, 0.0)
+        return self.quantities.get((ref, location), 0.0)
+
+    def breakdown(self, ref, total):
+        """[(emplacement, quantité)] du produit, magasin principal en premier"""
+        others = sorted((location, self.quantities[ref, location]) for location in self.by_ref.get(ref, ()))
+        return [(DEFAULT_LOCATION, self.quantity(ref, DEFAULT_LOCATION, total))] + others
+
+    def receive(self, item, sign=1):
+        self.move(item['ref'], item.get('emplacement'), sign * item['qty'])
+
+    def consume(self, item, sign=1):
+        self.move(item['ref'], item.get('emplacement'), -sign * item['qty'])
+
+    def transfer(self, item, sign=1):
+        self.move(item['ref'], item['de'], -sign * item['qty'])
+        self.move(item['ref'], item['vers'], sign * item['qty'])
+
+    def shortages(self, stock_of):
+        """[(ref, emplacement, stock, minimum)] des produits sous leur minimum d'emplacement"""
+        found = []
+        for (ref, location), minimum in self.minimums.items():
+            total = stock_of(ref)
+            if total is None:
+                continue
+            qty = self.quantity(ref, location, total)
+            if qty < minimum:
+                found.append((ref, location, qty, minimum))
+        return found
+
+
+def read_receipt_file(path):
+    """Lit les lignes d'un bon de réception: référence, quantité, lot, péremption, prix unitaire (facultatif).
+    
+    Formats acceptés: .csv (séparateur ; ou ,) et .xlsx (première feuille).
+    Une première ligne dont la quantité n'est pas numérique est prise pour
+    des en-têtes et ignorée.
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            sample = f.read(4096)
+            f.seek(0)
+            delimiter = ";" if sample.count(";") >= sample.count(",") else ","
+            rows = list(csv.reader(f, delimiter=delimiter))
+    else:
+        with open(path, "rb") as f, XlsxReader(f.read()) as wb:
+            rows = list(wb[wb.sheetnames[0]].iter_rows(max_col=5, values_only=True))
+    
+    def number_of(value):
+        return float(value) if isinstance(value, (int, float)) else float(str(value).strip().replace(",", "."))
+    
+    lines = []
+    for number, row in enumerate(rows, start=1):
+        row = tuple(row) + (None,) * (5 - len(row))
+        ref, qty, lot, expiry, price = row[:5]
+        if all(value in (None, "") for value in row[:5]):
+            continue
+        try:
+            qty = number_of(qty)
+        except ValueError:
+            if number == 1:
+                continue
+            raise ValueError(f"Ligne {number}: quantité invalide ({qty})")
+        try:
+            price = number_of(price) if price not in (None, "") else None
+        except ValueError:
+            raise ValueError(f"Ligne {number}: prix invalide ({price})")
+        lines.append({
+            'ref': str(ref or "").strip(),
+            'qty': qty,
+            'lot': str(lot or "").strip(),
+            'peremption': str(to_date(expiry) or "").strip(),
+            'prix': price
+        })
+    return lines
+
+
+def check_receipt_lines(lines, refs):
+    """Contrôle les lignes d'un bon de réception; retourne la liste des erreurs (vide si le bon est valide)"""
+    errors = []
+    for number, line in enumerate(lines, start=1):
+        if line['ref'] not in refs:
+            errors.append(f"Ligne {number}: référence inconnue ({line['ref']})")
+        if not line['qty'] > 0:
+            errors.append(f"Ligne {number}: la quantité doit être positive")
+        if line.get('prix') is not None and line['prix'] < 0:
+            errors.append(f"Ligne {number}: le prix ne peut pas être négatif")
+        if line['peremption']:
+            try:
+                datetime.strptime(line['peremption'], '%Y-%m-%d')
+            except ValueError:
+                errors.append(f"Ligne {number}: date de péremption invalide ({line['peremption']})")
+    return errors
+
+
+# Feuille des recettes: une ligne par composant, dose en % du poids du lot (kg de produit pour 100 kg)
+RECIPE_SHEET = "Recettes"
+RECIPE_COLUMNS = ((1, 'code', "CODE COULEUR"), (2, 'ref', "REFERENCE"), (3, 'dose', "DOSE (%)"))
+
+
+def recipe_code(code):
+    """Forme normalisée d'un code couleur (clé de l'index des recettes)"""
+    return str(code).strip().upper() if code is not None else ""
+
+
+@PROFILER.timed("load_data:Recettes")
+def read_recipes(wb):
+    """Lit les lignes de recette (aucune si la feuille n'existe pas encore)"""
+    recipes = []
+    if RECIPE_SHEET not in wb.sheetnames:
+        return recipes
+    rows = wb[RECIPE_SHEET].iter_rows(min_row=2, max_col=len(RECIPE_COLUMNS), values_only=True)
+    for values in rows:
+        values = tuple(values) + (None,) * (len(RECIPE_COLUMNS) - len(values))
+        code, ref, dose = values
+        if not recipe_code(code) or not ref:
+            continue
+        try:
+            dose = float(dose)
+        except (TypeError, ValueError):
+            continue
+        if dose > 0:
+            recipes.append({'code': str(code).strip(), 'ref': str(ref).strip(), 'dose': dose})
+    return recipes
+
+
+class RecipeBook:
+    """Recettes par code couleur: matrice creuse code couleur × produit.
+    
+    Stockage en lignes compressées: les colonnes (indices de produit) et les
+    doses de toutes les recettes sont rangées bout à bout dans deux tableaux
+    typés, et l'index `codes` donne pour chaque code couleur sa tranche
+    [début, fin). Trouver une recette est un accès au dictionnaire; la
+    décomposer pour un poids de lot revient à parcourir sa seule tranche.
+    Une référence présente plusieurs fois dans une recette est cumulée.
+    """
+
+    def __init__(self):
+        self.products = []
+        self.columns = {}
+        self.codes = {}
+        self.names = {}
+        self.indices = array('i')
+        self.doses = array('d')
+
+    @classmethod
+    def build(cls, recipes):
+        book = cls()
+        rows = {}
+        for item in recipes:
+            key = recipe_code(item['code'])
+            book.names.setdefault(key, item['code'])
+            column = book.columns.get(item['ref'])
+            if column is None:
+                column = book.columns[item['ref']] = len(book.products)
+                book.products.append(item['ref'])
+            row = rows.setdefault(key, {})
+            row[column] = row.get(column, 0.0) + item['dose']
+        for key, row in rows.items():
+            start = len(book.indices)
+            book.indices.extend(row)
+            book.doses.extend(row.values())
+            book.codes[key] = (start, len(book.indices))
+        return book
+
+    def __contains__(self, code):
+        return recipe_code(code) in self.codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def code_names(self):
+        """Codes couleur ayant une recette, tels qu'ils sont écrits dans la feuille"""
+        return sorted(self.names.values())
+
+    def components(self, code):
+        """[(référence, dose en %)] de la recette d'un code couleur (vide si inconnue)"""
+        start, end = self.codes.get(recipe_code(code), (0, 0))
+        return [(self.products[self.indices[i]], self.doses[i]) for i in range(start, end)]
+
+    def explode(self, code, weight):
+        """Quantités à prélever [(référence, kg)] pour un lot de `weight` kg"""
+        start, end = self.codes.get(recipe_code(code), (0, 0))
+        factor = weight / 100.0
+        return [(self.products[column], dose * factor)
+                for column, dose in zip(self.indices[start:end], self.doses[start:end])]
+
+
+def check_recipe_stock(needs, stock_of, format_qty):
+    """Contrôle en une passe le stock de tous les composants; retourne les erreurs (vide si tout est disponible).
+    
+    `format_qty(ref, qty)` affiche une quantité en kg dans l'unité du produit (UnitTable.format).
+    """
+    errors = []
+    for ref, qty in needs:
+        stock = stock_of(ref)
+        if stock is None:
+            errors.append(f"{ref}: référence inconnue")
+        elif qty > stock + LotStore.EPSILON:
+            errors.append(f"{ref}: {format_qty(ref, qty)} demandés, {format_qty(ref, stock)} en stock")
+    return errors
+
+
+# Délais maximaux de traitement des commandes (jours): feuille Délais, une règle par code couleur
+# ou par statut; à défaut, SLA_DEFAULT_DAYS par statut (les statuts ouverts inconnus prennent "En Attente")
+SLA_SHEET = "Délais"
+SLA_COLUMNS = ((1, 'code', "CODE COULEUR"), (2, 'statut', "STATUT"), (3, 'jours', "DELAI MAX (jours)"))
+SLA_DEFAULT_DAYS = {"En Attente": 7}
+# Vérification périodique des échéances (ms)
+SLA_INTERVAL = 60000
+
+
+@PROFILER.timed("load_data:Délais")
+def read_sla_rules(wb):
+    """Lit les règles de délai (aucune si la feuille n'existe pas encore)"""
+    rules = []
+    if SLA_SHEET not in wb.sheetnames:
+        return rules
+    for values in wb[SLA_SHEET].iter_rows(min_row=2, max_col=len(SLA_COLUMNS), values_only=True):
+        values = tuple(values) + (None,) * (len(SLA_COLUMNS) - len(values))
+        code, statut, days = values
+        try:
+            days = float(days)
+        except (TypeError, ValueError):
+            continue
+        if recipe_code(code) or statut:
+            rules.append({'code': str(code or "").strip(), 'statut': str(statut or "").strip(), 'jours': days})
+    return rules
+
+
+class SlaTracker:
+    """Échéances des commandes ouvertes (ni traitées ni annulées).
+    
+    Échéance = date d'entrée + délai maximal, celui du code couleur s'il est
+    fixé, sinon celui du statut. Les échéances sont rangées dans un tas min:
+    à chaque passage du minuteur, seules les commandes échues sont dépilées
+    (O(log n) chacune), sans parcourir la liste des commandes. Une commande
+    modifiée est simplement empilée à nouveau; l'ancienne entrée, qui ne
+    correspond plus à `due`, est ignorée quand elle atteint le sommet.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self.codes = {}
+        self.statuses = {statut.casefold(): days for statut, days in SLA_DEFAULT_DAYS.items()}
+        for rule in self.rules:
+            if recipe_code(rule['code']):
+                self.codes[recipe_code(rule['code'])] = rule['jours']
+            else:
+                self.statuses[rule['statut'].casefold()] = rule['jours']
+        self.heap = []
+        self.due = {}
+        self.late = {}
+
+    @classmethod
+    def build(cls, commandes, rules=()):
+        tracker = cls(rules)
+        for cmd in commandes:
+            tracker.track(cmd)
+        return tracker
+
+    def max_days(self, cmd):
+        """Délai maximal d'une commande ouverte (None si aucune règle ne s'applique)"""
+        days = self.codes.get(recipe_code(cmd['code']))
+        if days is None:
+            statut = (cmd['statut'] or "").strip().casefold()
+            days = self.statuses.get(statut, self.statuses.get("en attente"))
+        return days
+
+    def track(self, cmd):
+        """(Re)calcule l'échéance d'une commande ajoutée ou modifiée"""
+        cid = cmd['id']
+        if cid is None:
+            return
+        days = self.max_days(cmd) if commande_status(cmd) == "En attente" else None
+        entree = iso_date(cmd['date_entree'])
+        try:
+            due = (datetime.fromisoformat(entree) + timedelta(days=days)).date().isoformat()
+        except (TypeError, ValueError):
+            self.untrack(cid)
+            return
+        if due in (self.due.get(cid), self.late.get(cid)):
+            return
+        self.untrack(cid)
+        self.due[cid] = due
+        heapq.heappush(self.heap, (due, cid))
+        if len(self.heap) > 2 * len(self.due) + 64:
+            # Trop d'entrées périmées: le tas est reconstruit à partir des échéances valides
+            self.heap = [(value, key) for key, value in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def untrack(self, cid):
+        """Oublie une commande fermée ou supprimée"""
+        self.due.pop(cid, None)
+        self.late.pop(cid, None)
+
+    def tick(self, today):
+        """Dépile les commandes dont l'échéance est passée; retourne le nombre de nouveaux retards"""
+        count = 0
+        while self.heap and self.heap[0][0] < today:
+            due, cid = heapq.heappop(self.heap)
+            if self.due.get(cid) == due:
+                del self.due[cid]
+                self.late[cid] = due
+                count += 1
+        return count
+
+    def breaches(self):
+        """[(identifiant, échéance)] des commandes en retard, de la plus ancienne échéance à la plus récente"""
+        return sorted(self.late.items(), key=lambda item: (item[1], item[0]))
+
+
+# Unités de mesure: toutes les quantités (feuilles, historique, agrégats) restent en kg;
+# la feuille « Unités » fixe, par produit, l'unité de saisie et d'affichage et la densité
+UNIT_SHEET = "Unités"
+UNIT_COLUMNS = ((1, 'ref', "REFERENCE"), (2, 'unite', "UNITE"), (3, 'densite', "DENSITE (kg/L)"))
+BASE_UNIT = "kg"
+# Contenance d'un fût (L)
+DRUM_LITRES = 200.0
+# Unités connues: (grandeur, valeur en kg ou en L)
+UNIT_FACTORS = {
+    "kg": ("masse", 1.0), "g": ("masse", 0.001), "t": ("masse", 1000.0),
+    "L": ("volume", 1.0), "mL": ("volume", 0.001), "fût": ("volume", DRUM_LITRES),
+}
+
+
+def unit_name(unit):
+    """Forme normalisée d'une unité saisie ("KG", "l", "Fut" -> "kg", "L", "fût"); "" si inconnue"""
+    text = str(unit or "").strip().lower().replace("fut", "fût")
+    return next((name for name in UNIT_FACTORS if name.lower() == text), "")
+
+
+@PROFILER.timed("load_data:Unités")
+def read_units(wb):
+    """Lit les unités des produits (aucune si la feuille n'existe pas encore)"""
+    units = []
+    if UNIT_SHEET not in wb.sheetnames:
+        return units
+    for values in wb[UNIT_SHEET].iter_rows(min_row=2, max_col=len(UNIT_COLUMNS), values_only=True):
+        values = tuple(values) + (None,) * (len(UNIT_COLUMNS) - len(values))
+        ref, unit, density = values
+        if ref and unit_name(unit):
+            units.append({'ref': str(ref).strip(), 'unite': unit_name(unit), 'densite': to_float(density)})
+    return units
+
+
+class UnitTable:
+    """Conversions entre l'unité de base (kg) et les unités de chaque produit.
+    
+    Les facteurs (kg par unité) sont calculés une fois par produit à la
+    lecture de la feuille: les unités de volume n'existent que pour les
+    produits dont la densité est connue. Les conversions n'ont lieu qu'à la
+    saisie et à l'affichage, jamais dans les agrégats.
+    """
+
+    MASS = {name: factor for name, (kind, factor) in UNIT_FACTORS.items() if kind == "masse"}
+
+    def __init__(self):
+        self.units = {}
+        self.factors = {}
+
+    @classmethod
+    def build(cls, rows):
+        table = cls()
+        for row in rows:
+            factors = dict(cls.MASS)
+            if row['densite'] > 0:
+                factors.update((name, factor * row['densite'])
+                               for name, (kind, factor) in UNIT_FACTORS.items() if kind == "volume")
+            if row['unite'] in factors:
+                table.units[row['ref']] = row['unite']
+                table.factors[row['ref']] = factors
+        return table
+
+    def unit_of(self, ref):
+        """Unité de saisie et d'affichage du produit"""
+        return self.units.get(ref, BASE_UNIT)
+
+    def units_for(self, ref):
+        """Unités dans lesquelles une quantité du produit peut être saisie"""
+        return list(self.factors.get(ref, self.MASS))
+
+    def to_base(self, ref, qty, unit=None):
+        """Quantité saisie dans `unit` (par défaut l'unité du produit) ramenée en kg"""
+        return qty * self.factors.get(ref, self.MASS)[unit or self.unit_of(ref)]
+
+    def from_base(self, ref, qty, unit=None):
+        """Quantité en kg exprimée dans `unit` (par défaut l'unité du produit)"""
+        return qty / self.factors.get(ref, self.MASS)[unit or self.unit_of(ref)]
+
+    def format(self, ref, qty):
+        """Quantité en kg affichée dans l'unité du produit ("12.50 L")"""
+        return f"{self.from_base(ref, qty):.2f} {self.unit_of(ref)}"
+
+
+def consumption_totals_by_ref(history):
+    """Calcule la consommation totale par référence"""
+    totals = {}
+    for item in history:
+        totals[item['ref']] = totals.get(item['ref'], 0.0) + item['qty']
+    return totals
+
+
+# Graphiques de tendance: regroupements proposés (libellé affiché -> clé)
+TREND_PERIODS = {"Jour": "jour", "Semaine": "semaine", "Mois": "mois"}
+
+
+def bucket_start(day, period):
+    """Premier jour (AAAA-MM-JJ) du regroupement jour / semaine (lundi) / mois contenant `day`"""
+    if period == "mois":
+        return day[:8] + "01"
+    if period == "semaine":
+        value = datetime.fromisoformat(day)
+        return (value - timedelta(days=value.weekday())).date().isoformat()
+    return day
+
+
+class DailyTotals:
+    """Quantités par produit et par jour (consommations ou réceptions), tenues à jour avec le modèle.
+    
+    Les séries par semaine ou par mois sont agrégées à partir des totaux
+    journaliers à la première demande, puis conservées jusqu'au prochain
+    mouvement du produit.
+    """
+
+    def __init__(self, items=()):
+        self.daily = {}
+        self.cache = {}
+        for item in items:
+            self.add(item['ref'], item['date'], item['qty'])
+
+    def add(self, ref, day, qty):
+        day = iso_date(day)
+        if not day:
+            return
+        days = self.daily.setdefault(ref, {})
+        days[day] = days.get(day, 0.0) + qty
+        if abs(days[day]) < LotStore.EPSILON:
+            del days[day]  # Mouvement annulé
+        for period in TREND_PERIODS.values():
+            self.cache.pop((ref, period), None)
+
+    def series(self, ref, period):
+        """[(début du regroupement, quantité)] triés par date"""
+        key = ref, period
+        series = self.cache.get(key)
+        if series is None:
+            buckets = {}
+            for day, qty in self.daily.get(ref, {}).items():
+                try:
+                    bucket = bucket_start(day, period)
+                except ValueError:
+                    continue
+                buckets[bucket] = buckets.get(bucket, 0.0) + qty
+            series = self.cache[key] = sorted(buckets.items())
+        return series
+
+
+def lttb(points, threshold):
+    """Sous-échantillonnage "Largest-Triangle-Three-Buckets" d'une série [(x, y)] triée par x.
+    
+    Garde le premier et le dernier point et, dans chacun des threshold - 2
+    groupes intermédiaires, le point qui forme le plus grand triangle avec le
+    point retenu précédent et la moyenne du groupe suivant: l'allure de la
+    courbe (pics compris) est conservée avec `threshold` points.
+    """
+    count = len(points)
+    if threshold >= count or threshold < 3:
+        return list(points)
+    
+    sampled = [points[0]]
+    every = (count - 2) / (threshold - 2)
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, count)
+        following = points[end:next_end] or points[-1:]
+        avg_x = sum(p[0] for p in following) / len(following)
+        avg_y = sum(p[1] for p in following) / len(following)
+        
+        ax, ay = points[previous]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        previous = best
+    sampled.append(points[-1])
+    return sampled
+
+
+# Saisies anormales: écart (en écarts-types robustes, échelle logarithmique) au-delà duquel une quantité est signalée
+ANOMALY_THRESHOLD = 3.5
+# Nombre minimal de consommations d'un produit avant de juger une saisie
+ANOMALY_MIN_SAMPLES = 8
+# Consommations récentes retenues par produit pour la médiane glissante
+ANOMALY_WINDOW = 50
+# Une quantité moins de deux fois plus grande (ou plus petite) que d'habitude n'est jamais signalée
+ANOMALY_MIN_FACTOR = 2.0
+# Rapport écart-type / MAD d'une loi normale
+MAD_SCALE = 1.4826
+# Consommations inhabituelles affichées au plus après une recherche dans l'historique
+ANOMALY_DISPLAY_LIMIT = 500
+
+
+def median_of(values):
+    """Médiane d'une liste triée non vide"""
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def robust_band(values):
+    """(médiane, dispersion) d'une liste de logarithmes, la MAD ramenée à un écart-type"""
+    values = sorted(values)
+    center = median_of(values)
+    spread = MAD_SCALE * median_of(sorted(abs(value - center) for value in values))
+    return center, spread
+
+
+def anomaly_score(qty, center, spread):
+    """Écart de log(qty) au centre, en dispersions (plancher: facteur ANOMALY_MIN_FACTOR au seuil)"""
+    spread = max(spread, math.log(ANOMALY_MIN_FACTOR) / ANOMALY_THRESHOLD)
+    return abs(math.log(qty) - center) / spread
+
+
+class ConsumptionStats:
+    """Statistiques en ligne des consommations de chaque produit, pour signaler les saisies anormales.
+    
+    Les quantités sont comparées sur une échelle logarithmique: une erreur de
+    virgule (500 au lieu de 5,00) est un écart d'un facteur 100 quel que soit
+    l'ordre de grandeur habituel du produit. Par produit sont tenues la
+    moyenne et la variance de toutes les consommations (Welford, retrait
+    compris) et la fenêtre des ANOMALY_WINDOW dernières, dont la médiane et
+    la MAD sont recalculées au premier contrôle après un mouvement: check()
+    est en temps constant.
+    """
+
+    def __init__(self, items=()):
+        self.moments = {}  # ref -> [nombre, moyenne, somme des carrés des écarts]
+        self.windows = {}
+        self.bands = {}
+        for item in items:
+            self.add(item['ref'], item['qty'])
+
+    def add(self, ref, qty):
+        if qty <= 0:
+            return
+        value = math.log(qty)
+        moments = self.moments.setdefault(ref, [0, 0.0, 0.0])
+        moments[0] += 1
+        delta = value - moments[1]
+        moments[1] += delta / moments[0]
+        moments[2] += delta * (value - moments[1])
+        self.windows.setdefault(ref, deque(maxlen=ANOMALY_WINDOW)).append(value)
+        self.bands.pop(ref, None)
+
+    def remove(self, ref, qty):
+        moments = self.moments.get(ref)
+        if qty <= 0 or moments is None:
+            return
+        value = math.log(qty)
+        moments[0] -= 1
+        if moments[0] == 0:
+            del self.moments[ref]
+            self.windows.pop(ref, None)
+        else:
+            delta = value - moments[1]
+            moments[1] -= delta / moments[0]
+            moments[2] = max(moments[2] - delta * (value - moments[1]), 0.0)
+            try:
+                self.windows[ref].remove(value)  # Sortie de la fenêtre si elle était récente
+            except ValueError:
+                pass
+        self.bands.pop(ref, None)
+
+    def check(self, ref, qty):
+        """(score, quantité habituelle) si qty est anormale pour ce produit, sinon None"""
+        moments = self.moments.get(ref)
+        if qty <= 0 or moments is None or moments[0] < ANOMALY_MIN_SAMPLES:
+            return None
+        band = self.bands.get(ref)
+        if band is None:
+            window = self.windows.get(ref)
+            if not window:
+                band = (moments[1], 0.0)
+            else:
+                band = robust_band(window)
+            if band[1] <= 0:
+                # Fenêtre de valeurs identiques: dispersion de tout l'historique
+                band = (band[0], math.sqrt(moments[2] / (moments[0] - 1)))
+            self.bands[ref] = band
+        score = anomaly_score(qty, *band)
+        return (score, math.exp(band[0])) if score > ANOMALY_THRESHOLD else None
+
+
+def scan_anomalies(rows):
+    """Recherche les consommations anormales d'un historique complet: rows = [(identifiant, ref, qty)].
+    
+    Chaque quantité est comparée à la médiane et à la MAD de toutes les
+    consommations de son produit (un tri par produit, puis un passage):
+    retourne [(score, identifiant, quantité habituelle)], la plus anormale
+    en premier.
+    """
+    values = {}
+    for _, ref, qty in rows:
+        if qty > 0:
+            values.setdefault(ref, []).append(math.log(qty))
+    bands = {ref: robust_band(logs) for ref, logs in values.items() if len(logs) >= ANOMALY_MIN_SAMPLES}
+    
+    found = []
+    for cid, ref, qty in rows:
+        band = bands.get(ref)
+        if band is None or qty <= 0:
+            continue
+        score = anomaly_score(qty, *band)
+        if score > ANOMALY_THRESHOLD:
+            found.append((score, cid, math.exp(band[0])))
+    found.sort(reverse=True)
+    return found
+
+
+# Classification ABC: part cumulée de la consommation (A jusqu'à 80 %, B jusqu'à 95 %, puis C)
+ABC_LIMITS = (0.80, 0.95)
+# Classification XYZ: coefficient de variation de la consommation mensuelle (X jusqu'à 0,5, Y jusqu'à 1, puis Z)
+XYZ_LIMITS = (0.5, 1.0)
+# Libellé de priorité par classe ABC (indicateurs et ordre des alertes)
+ABC_PRIORITY = {"A": "Élevée", "B": "Moyenne", "C": "Basse"}
+
+
+def month_number(day):
+    """Numéro de mois (année * 12 + mois) d'une date AAAA-MM-JJ"""
+    return int(day[:4]) * 12 + int(day[5:7]) - 1
+
+
+class ProductClasses:
+    """Classes ABC (part de la consommation) et XYZ (régularité de la demande) des produits.
+    
+    XYZ est calculé par produit sur ses consommations mensuelles, du premier
+    mois consommé au mois courant (les mois sans consommation comptent pour
+    zéro), et n'est recalculé que pour les produits marqués par touch(). ABC
+    est redistribué en un seul tri des totaux quand un total a changé. Un
+    produit jamais consommé est classé "CZ".
+    """
+
+    def __init__(self):
+        self.abc = {}
+        self.xyz = {}
+        self.cv = {}
+        self.dirty = set()
+        self.stale = True
+        self.month = None
+
+    def touch(self, ref):
+        """Signale un mouvement de consommation du produit"""
+        self.dirty.add(ref)
+        self.stale = True
+
+    def refresh(self, refs, totals, days, today=None):
+        """Met à jour les classes des produits `refs` à partir des totaux et des quantités journalières"""
+        month = month_number(today or datetime.today().strftime('%Y-%m-%d'))
+        if month != self.month:
+            # Nouveau mois: la variabilité de tous les produits change
+            self.month = month
+            self.xyz.clear()
+            self.cv.clear()
+            self.stale = True
+        if not self.stale and len(self.abc) == len(refs):
+            return
+        
+        for ref in refs:
+            if ref in self.dirty or ref not in self.xyz:
+                self.cv[ref] = cv = self.variation(days.series(ref, "mois"), month)
+                self.xyz[ref] = ("Z" if cv is None else "X" if cv <= XYZ_LIMITS[0]
+                                 else "Y" if cv <= XYZ_LIMITS[1] else "Z")
+        self.dirty.clear()
+        
+        ranked = sorted(refs, key=lambda ref: max(totals.get(ref, 0.0), 0.0), reverse=True)
+        grand_total = sum(max(totals.get(ref, 0.0), 0.0) for ref in ranked)
+        self.abc = {}
+        cumulated = 0.0
+        for ref in ranked:
+            value = max(totals.get(ref, 0.0), 0.0)
+            if value <= 0 or grand_total <= 0:
+                self.abc[ref] = "C"
+                continue
+            # Classe selon la part cumulée avant le produit: le premier produit est toujours A
+            share = cumulated / grand_total
+            self.abc[ref] = "A" if share < ABC_LIMITS[0] else "B" if share < ABC_LIMITS[1] else "C"
+            cumulated += value
+        self.stale = False
+
+    @staticmethod
+    def variation(monthly, month):
+        """Coefficient de variation des consommations mensuelles, None sans consommation"""
+        monthly = [(month_number(start), qty) for start, qty in monthly if qty > 0]
+        if not monthly:
+            return None
+        count = max(month, monthly[-1][0]) - monthly[0][0] + 1
+        mean = sum(qty for _, qty in monthly) / count
+        variance = max(sum(qty * qty for _, qty in monthly) / count - mean * mean, 0.0)
+        return variance ** 0.5 / mean
+
+    def get(self, ref):
+        """Classe combinée ("AX" ... "CZ") d'un produit, "" s'il n'est pas classé"""
+        return self.abc.get(ref, "") + self.xyz.get(ref, "")
+
+    def rank(self, ref):
+        """Clé de tri des alertes: A avant B avant C, puis X avant Y avant Z"""
+        return ("ABC".find(self.abc.get(ref, "C")), "XYZ".find(self.xyz.get(ref, "Z")))
+
+
+def iter_workbook_stages(filename):
+    """Lit le classeur étape par étape: catalogue, historique, commandes, puis agrégats.
+    
+    Deux lectures du même contenu: les valeurs (mises en cache par Excel) sont
+    lues en flux pour les trois premières étapes, affichables aussitôt; le
+    classeur modifiable est ensuite chargé avec ses formules, pour qu'elles
+    soient conservées à l'enregistrement. Les stocks définis par une formule
+    sans valeur en cache (fichier enregistré par l'application) sont calculés
+    par FormulaEvaluator. Ne touche à aucun widget: peut s'exécuter dans un
+    thread de travail.
+    """
+    # Le fichier est lu une seule fois: son empreinte correspond exactement aux données chargées
+    file_state, data = read_workbook_file(filename)
+    
+    with PROFILER.measure("load_data:ouverture (lecture seule)"):
+        source = XlsxReader(data)
+    with source:
+        catalog = read_catalog(source)
+        catalog['units'] = UnitTable.build(read_units(source))
+        yield "catalogue", catalog
+        history = read_consumption_history(source)
+        receptions = read_receptions(source)
+        transfers = read_transfers(source)
+        locations = LocationStock.build(read_locations(source), receptions, history, transfers)
+        yield "historique", {'consumption_history': history, 'receptions': receptions,
+                             'transfers': transfers, 'locations': locations}
+        commandes = read_commandes(source)
+        # Identifiants des commandes saisies hors de l'application attribués dès cette étape: la liste
+        # affichée en dépend (écrits dans le classeur modifiable à l'étape agrégats)
+        commandes_next, commandes_new = allocate_ids(source['commandes'], commandes)
+        yield "commandes", {'commandes': commandes, 'commande_order': CommandeOrder(commandes),
+                            'commande_index': {cmd['id']: cmd for cmd in commandes},
+                            'sla': SlaTracker.build(commandes, read_sla_rules(source)),
+                            'recipes': RecipeBook.build(read_recipes(source))}
+    
+    with PROFILER.measure("load_data:ouverture"):
+        wb = openpyxl.load_workbook(io.BytesIO(data))
+    
+    # Identifiants permanents: attribués aux lignes saisies hors de l'application (ou avant leur apparition)
+    with PROFILER.measure("load_data:identifiants"):
+        consumption_next, consumption_new = allocate_ids(wb['Consommation'], history)
+        write_ids(wb['Consommation'], consumption_new)
+        write_ids(wb['commandes'], commandes_new)
+        for column, header in ((LOT_COLUMN, LOT_HEADER), (COMMANDE_LINK_COLUMN, COMMANDE_LINK_HEADER),
+                               (LOCATION_COLUMN, LOCATION_HEADER)):
+            wb['Consommation'].cell(row=1, column=column, value=header)
+            wb['Consommation'].column_dimensions[openpyxl.utils.get_column_letter(column)].hidden = True
+    
+    aggregates = {
+        'consumption_index': {item['id']: item for item in history},
+        'lots': LotStore.build(receptions, history),
+        'valuation': StockValuation.build(receptions, history),
+        'next_ids': {'Consommation': consumption_next, 'commandes': commandes_next},
+        'new_ids': len(consumption_new),
+        'wb': wb,
+        'consumption_totals': consumption_totals_by_ref(history),
+        'consumption_days': DailyTotals(history),
+        'classes': ProductClasses(),
+        'anomalies': ConsumptionStats(history),
+        'reception_days': DailyTotals(receptions),
+        'file_state': file_state,
+        'sheet_parts': workbook_parts(data),
+        'evaluator': FormulaEvaluator(wb),
+        'formula_stocks': find_formula_stocks(wb),
+        'product_rows': find_product_rows(wb),
+    }
+    
+    # Nouveaux dictionnaires: ceux de l'étape catalogue appartiennent déjà au modèle
+    with PROFILER.measure("load_data:formules"):
+        for ref, (sheet, row, prefix) in aggregates['formula_stocks'].items():
+            stock = to_float(aggregates['evaluator'].value(sheet, row, 6))
+            if stock != catalog[prefix + 'stocks'].get(ref):
+                aggregates.setdefault(prefix + 'stocks', dict(catalog[prefix + 'stocks']))[ref] = stock
+    
+    yield "agregats", aggregates
+
+
+def find_product_rows(wb):
+    """Ligne de chaque produit dans sa feuille (colorants et auxiliaires): {ref: ligne}"""
+    rows = {}
+    for name in ('Liste des articles2', "Produits auxiliaires"):
+        if name not in wb.sheetnames:
+            continue
+        for row, (ref,) in enumerate(wb[name].iter_rows(min_row=2, max_col=1, values_only=True), start=2):
+            if ref:
+                rows[str(ref)] = row
+    return rows
+
+
+def find_formula_stocks(wb):
+    """Produits dont le stock réel (colonne F) est une formule: {ref: (feuille, ligne, préfixe du modèle)}"""
+    found = {}
+    for name, prefix in (('Liste des articles2', ""), ("Produits auxiliaires", "aux_")):
+        if name not in wb.sheetnames:
+            continue
+        for row, values in enumerate(wb[name].iter_rows(min_row=2, max_col=6, values_only=True), start=2):
+            if values[0] and is_formula(values[5]):
+                found[str(values[0])] = (name, row, prefix)
+    return found
+
+
+def read_workbook_snapshot(data, sheets=None):
+    """Lit catalogue, historique et commandes d'un contenu de classeur (lecture seule, sans agrégats).
+    
+    Si `sheets` est donné, seules ces feuilles sont analysées: XlsxReader ne lit
+    le XML d'une feuille qu'au moment où on la parcourt.
+    """
+    wb = XlsxReader(data)
+    try:
+        snapshot = read_catalog(wb, sheets)
+        if sheets is None or 'Consommation' in sheets:
+            snapshot['consumption_history'] = read_consumption_history(wb)
+        if sheets is None or 'commandes' in sheets:
+            snapshot['commandes'] = read_commandes(wb)
+        if sheets is None or RECEPTION_SHEET in sheets:
+            snapshot['receptions'] = read_receptions(wb)
+        if sheets is None or RECIPE_SHEET in sheets:
+            snapshot['recipes'] = read_recipes(wb)
+        if sheets is None or SLA_SHEET in sheets:
+            snapshot['sla_rules'] = read_sla_rules(wb)
+        if sheets is None or UNIT_SHEET in sheets:
+            snapshot['units'] = read_units(wb)
+        if sheets is None or LOCATION_SHEET in sheets:
+            snapshot['locations'] = read_locations(wb)
+        if sheets is None or TRANSFER_SHEET in sheets:
+            snapshot['transfers'] = read_transfers(wb)
+    finally:
+        wb.close()
+    return snapshot
+
+
+def workbook_parts(data):
+    """CRC de la partie XML de chaque feuille (et des chaînes partagées) d'un contenu xlsx.
+    
+    Les CRC sont lus dans le répertoire de l'archive zip, sans décompresser les feuilles.
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        crcs = {info.filename: info.CRC for info in archive.infolist()}
+        paths = sheet_part_paths(archive)
+    
+    parts = {SHARED_STRINGS: crcs.get(SHARED_STRINGS)}
+    for name, path in paths.items():
+        parts[name] = crcs.get(path)
+    return parts
+
+
+def changed_sheets(old_parts, new_parts):
+    """Noms des feuilles dont la partie XML a changé entre deux versions du fichier"""
+    names = {name for name in new_parts if name != SHARED_STRINGS}
+    if old_parts is None:
+        return names
+    changed = {name for name in names if old_parts.get(name) != new_parts[name]}
+    if not changed and old_parts.get(SHARED_STRINGS) != new_parts.get(SHARED_STRINGS):
+        # Seul le texte a changé: les indices des cellules sont identiques, tout est relu
+        return names
+    return changed
+
+
+def read_external_changes(filename, file_state, sheet_parts):
+    """Relit le fichier s'il a été modifié depuis `file_state` (hors thread Tk).
+    
+    Retourne None si le fichier est inchangé, sinon un dict avec le nouvel état,
+    les CRC des feuilles, les feuilles modifiées et leur contenu relu.
+    """
+    if file_state is None or not os.path.exists(filename):
+        return None
+    if file_signature(filename) == file_state[0]:
+        return None
+    
+    state, data = read_workbook_file(filename)
+    if state[1] == file_state[1]:
+        # Date modifiée mais contenu identique (copie, synchronisation)
+        return {'file_state': state, 'sheet_parts': sheet_parts, 'sheets': set(), 'snapshot': None}
+    
+    parts = workbook_parts(data)
+    sheets = changed_sheets(sheet_parts, parts)
+    return {
+        'file_state': state,
+        'sheet_parts': parts,
+        'sheets': sheets,
+        'snapshot': read_workbook_snapshot(data, sheets),
+    }
+
+
+# Onglets à rafraîchir quand une feuille est modifiée hors de l'application
+SHEET_TABS = {
+    'Liste des articles2': STAGE_TABS["catalogue"] + ("indicateurs",),
+    'Produits auxiliaires': STAGE_TABS["catalogue"] + ("indicateurs",),
+    'Consommation': ("consommation", "rapports", "indicateurs"),
+    'commandes': ("commandes", "indicateurs"),
+    RECEPTION_SHEET: ("stock",),
+    RECIPE_SHEET: ("consommation",),
+    SLA_SHEET: ("alertes",),
+    UNIT_SHEET: STAGE_TABS["catalogue"] + ("indicateurs",),
+    LOCATION_SHEET: ("consommation", "stock", "alertes"),
+    TRANSFER_SHEET: ("consommation", "stock", "alertes"),
+}
+
+# Intervalle de surveillance du fichier Excel (ms)
+WATCH_INTERVAL = 3000
+
+
+# Verrou consultatif: délai d'attente et âge au-delà duquel un verrou est considéré abandonné (secondes)
+LOCK_TIMEOUT = 15
+LOCK_STALE = 120
+
+
+class WorkbookLock:
+    """Verrou consultatif entre postes partageant le classeur (fichier <classeur>.lock)"""
+
+    def __init__(self, filename, timeout=LOCK_TIMEOUT, stale=LOCK_STALE):
+        self.path = filename + ".lock"
+        self.timeout = timeout
+        self.stale = stale
+
+    def owner(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return f.read().strip() or "?"
+        except OSError:
+            return "?"
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                # Verrou laissé par un poste arrêté brutalement
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.stale:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Le fichier est en cours d'enregistrement par {self.owner()}")
+                time.sleep(0.1)
+                continue
+            
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(f"{getpass.getuser()}@{socket.gethostname()} (pid {os.getpid()}) "
+                        f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            return self
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        return False
+
+
+def file_signature(filename):
+    """Signature rapide du fichier: (date de modification, taille)"""
+    st = os.stat(filename)
+    return st.st_mtime_ns, st.st_size
+
+
+def read_workbook_file(filename):
+    """Lit le fichier en mémoire; retourne ((signature, empreinte SHA-1), contenu)"""
+    signature = file_signature(filename)
+    with open(filename, "rb") as f:
+        data = f.read()
+    return (signature, hashlib.sha1(data).hexdigest()), data
+
+
+def write_workbook_file(wb, filename):
+    """Enregistre le classeur via un fichier temporaire remplacé atomiquement.
+    
+    Les autres postes ne voient jamais un fichier à moitié écrit. Retourne,
+    comme read_workbook_file, ((signature, empreinte), contenu) du fichier écrit.
+    """
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    data = buffer.getvalue()
+    
+    temp = filename + ".tmp"
+    try:
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, filename)
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return (file_signature(filename), hashlib.sha1(data).hexdigest()), data
+
+
+# Historique des indicateurs: un instantané par jour (stocks, alertes, commandes) dans <classeur>.historique
+SNAPSHOT_RECORD = struct.Struct("<IId")  # jour (ordinal), numéro de série, valeur: 16 octets
+SNAPSHOT_INTERVAL = 3600000  # Vérification périodique (ms): l'instantané du jour est pris au premier passage
+KPI_SERIES = ("kpi:alertes", "kpi:commandes", "kpi:traitees", "kpi:taux", "kpi:retards")
+
+
+def snapshot_path(filename):
+    """Fichier d'historique associé à un classeur"""
+    return os.path.splitext(filename)[0] + ".historique"
+
+
+class SnapshotStore:
+    """Séries chronologiques des indicateurs, en enregistrements binaires de taille fixe.
+    
+    Le fichier n'est jamais réécrit: chaque instantané ajoute à la fin un
+    enregistrement (jour, série, valeur) par produit et par indicateur. Les
+    jours étant croissants, une période se retrouve par dichotomie sur le
+    numéro d'enregistrement, sans lire ce qui précède. Les noms des séries
+    (références produit, "kpi:...") sont numérotés dans un fichier texte
+    voisin, lui aussi en ajout seul.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.names_path = path + ".series"
+        self.names = []
+        self.index = {}
+
+    def load_names(self):
+        """Relit les noms de séries (un autre poste a pu en ajouter)"""
+        if not os.path.exists(self.names_path):
+            return
+        with open(self.names_path, encoding="utf-8") as f:
+            for name in f.read().split("\n")[len(self.names):]:
+                if name:
+                    self.index[name] = len(self.names)
+                    self.names.append(name)
+
+    def record_count(self, f):
+        f.seek(0, os.SEEK_END)
+        return f.tell() // SNAPSHOT_RECORD.size
+
+    def day_at(self, f, position):
+        f.seek(position * SNAPSHOT_RECORD.size)
+        return SNAPSHOT_RECORD.unpack(f.read(SNAPSHOT_RECORD.size))[0]
+
+    def last_day(self):
+        """Dernier jour enregistré (date ISO, None si l'historique est vide)"""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            count = self.record_count(f)
+            return datetime.fromordinal(self.day_at(f, count - 1)).date().isoformat() if count else None
+
+    def capture(self, day, values):
+        """Ajoute l'instantané du jour `day` (AAAA-MM-JJ): {série: valeur}.
+        
+        Retourne False sans rien écrire si ce jour est déjà enregistré (par ce
+        poste ou un autre). Un enregistrement incomplet en fin de fichier
+        (arrêt pendant l'écriture) est retiré avant l'ajout.
+        """
+        ordinal = datetime.fromisoformat(day).toordinal()
+        with WorkbookLock(self.path, timeout=2):
+            self.load_names()
+            with open(self.path, "ab+") as f:
+                count = self.record_count(f)
+                if count and self.day_at(f, count - 1) >= ordinal:
+                    return False
+                f.truncate(count * SNAPSHOT_RECORD.size)
+                
+                new_names = [name for name in values if name not in self.index]
+                if new_names:
+                    with open(self.names_path, "a", encoding="utf-8") as names:
+                        names.write("".join(name + "\n" for name in new_names))
+                    for name in new_names:
+                        self.index[name] = len(self.names)
+                        self.names.append(name)
+                
+                f.seek(0, os.SEEK_END)
+                f.write(b"".join(SNAPSHOT_RECORD.pack(ordinal, self.index[name], float(value))
+                                 for name, value in values.items()))
+        return True
+
+    def bound(self, f, count, ordinal):
+        """Premier enregistrement dont le jour est >= ordinal (dichotomie sur le fichier)"""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self.day_at(f, middle) < ordinal:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, names, start=None, end=None):
+        """Séries demandées sur la période [start, end] (dates AAAA-MM-JJ, bornes facultatives).
+        
+        Retourne {série: [(date, valeur)]}; seules les données de la période sont lues.
+        """
+        self.load_names()
+        wanted = {self.index[name]: name for name in names if name in self.index}
+        series = {name: [] for name in names}
+        if not wanted or not os.path.exists(self.path):
+            return series
+        
+        with open(self.path, "rb") as f:
+            count = self.record_count(f)
+            first = self.bound(f, count, datetime.fromisoformat(start).toordinal()) if start else 0
+            last = self.bound(f, count, datetime.fromisoformat(end).toordinal() + 1) if end else count
+            f.seek(first * SNAPSHOT_RECORD.size)
+            data = f.read((last - first) * SNAPSHOT_RECORD.size)
+        
+        days = {}
+        for ordinal, number, value in SNAPSHOT_RECORD.iter_unpack(data):
+            name = wanted.get(number)
+            if name is not None:
+                day = days.get(ordinal)
+                if day is None:
+                    day = days[ordinal] = datetime.fromordinal(ordinal).date().isoformat()
+                series[name].append((day, value))
+        return series
+
+
+# Journal des modifications (qui, quand, quoi, avant, après) dans <classeur>.journal
+AUDIT_HEADER = struct.Struct("<IIII")  # premier et dernier jour (ordinaux), taille des références, taille des entrées
+AUDIT_DISPLAY_LIMIT = 2000  # Entrées affichées au plus dans la fenêtre du journal
+
+
+def audit_path(filename):
+    """Journal des modifications associé à un classeur"""
+    return os.path.splitext(filename)[0] + ".journal"
+
+
+def audit_text(value):
+    """Valeur d'une entrée du journal telle qu'affichée ("" si absente)"""
+    if value is None:
+        return ""
+    if isinstance(value, dict):
+        return ", ".join(f"{key}: {audit_text(item)}" for key, item in value.items())
+    if isinstance(value, float):
+        return f"{value:g}"
+    return str(value)
+
+
+class AuditLog:
+    """Journal des modifications, en segments compressés ajoutés en fin de fichier.
+    
+    Les entrées sont mises en attente en mémoire par le thread Tk (aucune
+    écriture disque pendant une action) puis écrites par flush(), dans un
+    thread de travail: chaque appel ajoute un segment formé d'un en-tête
+    (jours couverts, tailles), des références touchées en clair et des
+    entrées en JSON compressé par zlib. Le fichier n'est jamais réécrit.
+    
+    Les en-têtes servent d'index: lus une seule fois (puis seulement ceux
+    ajoutés depuis, par ce poste ou un autre), ils donnent pour chaque
+    référence et chaque jour les segments concernés. Une recherche ne lit et
+    ne décompresse que ces segments.
+    """
+
+    def __init__(self, path, user=None):
+        self.path = path
+        self.user = user or f"{getpass.getuser()}@{socket.gethostname()}"
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.file_lock = threading.Lock()  # Écriture et lecture des segments (thread Tk et thread de travail)
+        self.segments = []  # (position des entrées, taille, premier jour, dernier jour)
+        self.by_ref = {}    # ref -> numéros de segments
+        self.by_day = {}    # jour (ordinal) -> numéros de segments
+        self.scanned = 0    # Fin du dernier segment complet lu
+        self.paused = 0
+        self.recorded = 0   # Entrées mises en attente depuis l'ouverture (repère de mark/discard)
+
+    def record(self, ref, objet, champ, avant, apres):
+        """Met en attente une modification: `objet` (ex. "Consommation 12"), `champ`, valeurs avant et après"""
+        if self.paused:
+            return
+        entry = {'quand': datetime.now().isoformat(timespec="seconds"), 'qui': self.user, 'ref': str(ref),
+                 'objet': objet, 'champ': champ, 'avant': avant, 'apres': apres}
+        with self.pending_lock:
+            self.pending.append(entry)
+            self.recorded += 1
+
+    def mark(self):
+        """Repère des entrées en attente, pour retirer ensuite celles d'une action défaite"""
+        return self.recorded
+
+    def discard(self, mark):
+        """Retire les entrées mises en attente depuis `mark` (action défaite avant d'atteindre le fichier)"""
+        with self.pending_lock:
+            count = self.recorded - mark
+            if count > 0:
+                del self.pending[-count:]
+            self.recorded = mark
+
+    @contextmanager
+    def suspended(self):
+        """Modifications non journalisées: celles d'un autre poste, fusionnées, sont dans son propre segment"""
+        self.paused += 1
+        try:
+            yield
+        finally:
+            self.paused -= 1
+
+    def has_pending(self):
+        return bool(self.pending)
+
+    def flush(self, count=None):
+        """Écrit les entrées en attente (ou les `count` premières) en un segment; retourne leur nombre.
+        
+        En cas d'échec (verrou, disque), les entrées restent en attente pour le
+        prochain appel. Un segment incomplet en fin de fichier (arrêt pendant
+        l'écriture) est retiré avant l'ajout.
+        """
+        with self.pending_lock:
+            if count is None:
+                count = len(self.pending)
+            entries, self.pending = self.pending[:count], self.pending[count:]
+        if not entries:
+            return 0
+        try:
+            data = zlib.compress("\n".join(json.dumps(entry, ensure_ascii=False, default=str)
+                                           for entry in entries).encode("utf-8"))
+            refs = "\n".join(sorted({entry['ref'] for entry in entries})).encode("utf-8")
+            days = [datetime.fromisoformat(entry['quand']).toordinal() for entry in entries]
+            with self.file_lock, WorkbookLock(self.path, timeout=2):
+                with open(self.path, "ab+") as f:
+                    self.scan(f)
+                    f.truncate(self.scanned)
+                    f.write(AUDIT_HEADER.pack(min(days), max(days), len(refs), len(data)) + refs + data)
+                    self.scan(f)
+        except Exception:
+            with self.pending_lock:
+                self.pending[:0] = entries
+            raise
+        return len(entries)
+
+    def scan(self, f):
+        """Lit les en-têtes des segments ajoutés depuis le dernier passage et complète les index"""
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        position = self.scanned
+        while position + AUDIT_HEADER.size <= end:
+            f.seek(position)
+            first, last, refs_size, size = AUDIT_HEADER.unpack(f.read(AUDIT_HEADER.size))
+            start = position + AUDIT_HEADER.size + refs_size
+            if start + size > end:
+                break  # Segment incomplet
+            number = len(self.segments)
+            self.segments.append((start, size, first, last))
+            for ref in f.read(refs_size).decode("utf-8").split("\n"):
+                self.by_ref.setdefault(ref, []).append(number)
+            for day in range(first, last + 1):
+                self.by_day.setdefault(day, []).append(number)
+            position = start + size
+        self.scanned = position
+
+    def query(self, ref=None, start=None, end=None):
+        """Modifications d'une référence et/ou d'une période [start, end] (dates AAAA-MM-JJ, bornes facultatives).
+        
+        Retourne les entrées de la plus ancienne à la plus récente, celles
+        encore en attente comprises. Les segments sont choisis par l'index des
+        références (ou, sans référence, par celui des jours) et filtrés par
+        leurs jours; eux seuls sont décompressés.
+        """
+        first = datetime.fromisoformat(start).toordinal() if start else 0
+        last = datetime.fromisoformat(end).toordinal() if end else float("inf")
+        chunks = []
+        with self.file_lock:
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    self.scan(f)
+                    if ref is not None:
+                        numbers = self.by_ref.get(str(ref), [])
+                    elif start and end:
+                        numbers = sorted({number for day in range(first, last + 1)
+                                          for number in self.by_day.get(day, ())})
+                    else:
+                        numbers = range(len(self.segments))
+                    for number in numbers:
+                        position, size, seg_first, seg_last = self.segments[number]
+                        if seg_last >= first and seg_first <= last:
+                            f.seek(position)
+                            chunks.append(f.read(size))
+        with self.pending_lock:
+            pending = list(self.pending)
+        
+        entries = []
+        for chunk in chunks:
+            entries.extend(json.loads(line) for line in zlib.decompress(chunk).decode("utf-8").split("\n"))
+        entries.extend(pending)
+        found = [entry for entry in entries
+                 if (ref is None or entry['ref'] == str(ref))
+                 and (not start or entry['quand'][:10] >= start) and (not end or entry['quand'][:10] <= end)]
+        found.sort(key=lambda entry: entry['quand'])
+        return found
+
+
+def consumption_fields(item):
+    """Valeurs comparées d'une consommation lors d'une fusion"""
+    return item['ref'], item['date'], item['qty']
+
+
+# Colonnes de la feuille commandes: (colonne, champ)
+COMMANDE_COLUMNS = (
+    (1, 'ref'), (2, 'code'), (3, 'date_entree'), (4, 'date_sortie'),
+    (5, 'delai'), (7, 'statut'), (8, 'observation'), (ID_COLUMN, 'id'),
+)
+
+
+def commande_fields(cmd):
+    """Valeurs comparées d'une commande lors d'une fusion"""
+    return (str(cmd['ref']), cmd['code'], to_date(cmd['date_entree']), to_date(cmd['date_sortie']),
+            cmd['delai'], cmd['statut'], cmd['observation'])
+
+
+def to_date(value):
+    """Convertit une date (datetime ou texte AAAA-MM-JJ) en date; sinon retourne la valeur telle quelle"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value.strip(), '%Y-%m-%d').date()
+        except ValueError:
+            pass
+    return value
+
+# Colonnes triables de la liste des commandes, filtres de statut et nombre de lignes affichées à la fois
+COMMANDE_SORT_COLUMNS = ("ref", "code", "date_entree", "date_sortie", "delai", "statut")
+COMMANDE_STATUS_FILTERS = ("Tous", "En attente", "Traitée", "Annulée")
+COMMANDES_WINDOW = 30
+
+
+def iso_date(value):
+    """Date AAAA-MM-JJ d'une cellule ("" si vide); le texte déjà à ce format est repris sans analyse"""
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, str):
+        value = value.strip()
+        if len(value) == 10 and value[4] == value[7] == "-":
+            return value
+    return str(to_date(value) or "")
+
+
+def commande_status(cmd):
+    """Statut normalisé d'une commande (valeur des filtres)"""
+    statut = (cmd['statut'] or "").lower()
+    if "traitée" in statut:
+        return "Traitée"
+    if "annul" in statut:
+        return "Annulée"
+    return "En attente"
+
+
+def commande_sort_key(cmd, column):
+    """Clé de tri d'une colonne: comparable entre toutes les commandes, cellules vides en dernier"""
+    value = cmd[column]
+    if value is None or value == "":
+        return 1, 0.0, ""
+    if column == "delai":
+        try:
+            return 0, float(value), ""
+        except (TypeError, ValueError):
+            return 0, float("inf"), str(value)
+    if column in ("date_entree", "date_sortie"):
+        return 0, 0.0, iso_date(value)
+    return 0, 0.0, str(value).casefold()
+
+
+class CommandeOrder:
+    """Ordres de tri et filtres de la liste des commandes, tenus à jour avec le modèle.
+    
+    Pour chaque colonne triée au moins une fois, un tableau de couples
+    (clé, identifiant) est conservé trié: une commande ajoutée, modifiée ou
+    retirée y est placée ou retrouvée par dichotomie, sans nouveau tri. Les
+    clés de chaque commande sont gardées pour la retrouver après
+    modification. Statut normalisé et date d'entrée servent aux filtres.
+    """
+
+    def __init__(self, commandes):
+        self.commandes = commandes
+        self.reset()
+
+    def reset(self):
+        """Oublie les ordres calculés (rechargement, fusion): ils seront reconstruits à la demande"""
+        self.orders = {}
+        self.keys = {}
+        self.facets = {cmd['id']: self.facet(cmd) for cmd in self.commandes}
+        self.version = getattr(self, 'version', 0) + 1
+
+    @staticmethod
+    def facet(cmd):
+        return commande_status(cmd), iso_date(cmd['date_entree'])
+
+    def order(self, column):
+        """Identifiants des commandes triés par la colonne (tableau construit au premier tri)"""
+        entries = self.orders.get(column)
+        if entries is None:
+            keys = self.keys[column] = {cmd['id']: commande_sort_key(cmd, column) for cmd in self.commandes}
+            entries = self.orders[column] = sorted((key, cid) for cid, key in keys.items())
+        return entries
+
+    def remove(self, cmd):
+        for column, entries in self.orders.items():
+            key = self.keys[column].pop(cmd['id'], None)
+            index = bisect.bisect_left(entries, (key, cmd['id'])) if key is not None else len(entries)
+            if index < len(entries) and entries[index][1] == cmd['id']:
+                del entries[index]
+        self.facets.pop(cmd['id'], None)
+        self.version += 1
+
+    def update(self, cmd):
+        """Place une commande ajoutée, ou replace une commande modifiée dans les ordres dont sa clé a changé"""
+        for column, entries in self.orders.items():
+            old = self.keys[column].get(cmd['id'])
+            key = commande_sort_key(cmd, column)
+            if key == old:
+                continue
+            if old is not None:
+                index = bisect.bisect_left(entries, (old, cmd['id']))
+                if index < len(entries) and entries[index][1] == cmd['id']:
+                    del entries[index]
+            self.keys[column][cmd['id']] = key
+            bisect.insort(entries, (key, cmd['id']))
+        self.facets[cmd['id']] = self.facet(cmd)
+        self.version += 1
+
+    def select(self, column=None, descending=False, statut="Tous", start="", end=""):
+        """Identifiants à afficher: ordre de la colonne (ordre du fichier si None), puis filtres"""
+        if column is None:
+            ids = [cmd['id'] for cmd in self.commandes]
+        else:
+            ids = [cid for _, cid in self.order(column)]
+        if descending:
+            ids.reverse()
+        if statut != "Tous" or start or end:
+            facets = self.facets
+            ids = [cid for cid in ids
+                   if (statut == "Tous" or facets[cid][0] == statut)
+                   and (not start or facets[cid][1] >= start)
+                   and (not end or (facets[cid][1] and facets[cid][1] <= end))]
+        return ids
+
+
+
+# Nombre d'actions conservées pour l'annulation
+UNDO_LIMIT = 100
+
+
+class CommandLog:
+    """Journal des actions pour annuler / rétablir.
+    
+    Chaque action enregistre son inverse sous forme de fonctions qui ne
+    touchent que le modèle et les cellules concernées (coût constant, sans
+    relecture du classeur). Les suppressions laissent une ligne vide à leur
+    place: les numéros de ligne des autres enregistrements restent valides
+    et une action annulée peut être rétablie à l'identique.
+    """
+
+    def __init__(self, limit=UNDO_LIMIT):
+        self.done = deque(maxlen=limit)
+        self.undone = []
+
+    def record(self, label, undo, redo):
+        self.done.append((label, undo, redo))
+        self.undone.clear()
+
+    def clear(self):
+        self.done.clear()
+        self.undone.clear()
+
+    def undo(self):
+        """Annule la dernière action; retourne son libellé (None si rien à annuler)"""
+        if not self.done:
+            return None
+        command = self.done.pop()
+        try:
+            command[1]()
+        except Exception:
+            self.done.append(command)
+            raise
+        self.undone.append(command)
+        return command[0]
+
+    def redo(self):
+        """Rétablit la dernière action annulée; retourne son libellé (None si rien à rétablir)"""
+        if not self.undone:
+            return None
+        command = self.undone.pop()
+        try:
+            command[2]()
+        except Exception:
+            self.undone.append(command)
+            raise
+        self.done.append(command)
+        return command[0]
+
+
+# Fréquence (en lignes) des notifications de progression pendant un export
+EXPORT_PROGRESS_STEP = 5000
+
+
+@PROFILER.timed("export_sections")
+def export_sections(path, sections, progress=None):
+    """Écrit des sections (clé, titre, en-têtes, lignes, nombre) en flux vers un fichier.
+    
+    En .xlsx, chaque section devient une feuille d'un classeur openpyxl en mode
+    écriture seule; en .csv, la première section va dans `path` et les suivantes
+    dans des fichiers voisins suffixés par leur clé. Les lignes sont consommées
+    une à une: la mémoire reste constante quelle que soit la taille de l'export.
+    """
+    total = sum(section[4] for section in sections)
+    done = 0
+    
+    def advance():
+        nonlocal done
+        done += 1
+        if progress and done % EXPORT_PROGRESS_STEP == 0:
+            progress(done, total)
+    
+    if path.lower().endswith(".csv"):
+        base, ext = os.path.splitext(path)
+        for index, (key, title, headers, rows, count) in enumerate(sections):
+            target = path if index == 0 else f"{base}_{key}{ext}"
+            with open(target, "w", newline="", encoding="utf-8-sig") as f:
+                writer = csv.writer(f, delimiter=";")
+                writer.writerow(headers)
+                for row in rows:
+                    writer.writerow(row)
+                    advance()
+    else:
+        wb = openpyxl.Workbook(write_only=True)
+        for key, title, headers, rows, count in sections:
+            sheet = wb.create_sheet(title)
+            sheet.append(headers)
+            for row in rows:
+                sheet.append(row)
+                advance()
+        wb.save(path)
+    
+    if progress:
+        progress(done, total)
+    return done
+
 
 class StockApp(tk.Tk):
     def __init__(self):
@@ -12,8 +3006,12 @@ class StockApp(tk.Tk):
         
         # Configuration du fichier Excel
         self.filename = "suivi_consommation.xlsx"
+        self.snapshots = SnapshotStore(snapshot_path(self.filename))
+        self.audit = AuditLog(audit_path(self.filename))
+        self.audit_future = None
+        self.audit_mark = self.audit.mark()  # Entrées antérieures au dernier enregistrement réussi
         self.create_template_if_needed()
-        self.load_data()
+        self.reset_data()
         
         # Style professionnel amélioré
         self.style = ttk.Style()
@@ -31,18 +3029,36 @@ class StockApp(tk.Tk):
         self.style.configure("Treeview", rowheight=25)
         self.style.configure("Treeview.Heading", font=("Segoe UI", 10, "bold"))
         
-        # Onglets
+        # Onglets: (titre, construction des widgets, rafraîchissement des données)
+        self.tab_specs = {
+            "consommation": ("📊 Consommation", self.create_consumption_tab, self.refresh_consumption_tab),
+            "stock": ("📦 Gestion Stock", self.create_stock_tab, self.refresh_stock_tab),
+            "commandes": ("Commandes", self.create_commandes_tab, self.update_commandes_display),
+            "alertes": ("Alertes Stock", self.create_alerts_tab, self.check_stock_alerts),
+            "rapports": ("Rapports", self.create_report_tab, self.update_report_table),
+            "auxiliaires": ("🧪 Produits Auxiliaires", self.create_auxiliary_tab, self.load_auxiliary_data),
+            "indicateurs": ("📈 Indicateurs", self.create_indicators_tab, self.update_indicators),
+        }
+        if PROFILER.enabled:
+            self.tab_specs["diagnostics"] = ("⏱ Diagnostics", self.create_diagnostics_tab, self.update_diagnostics)
+        
         self.notebook = ttk.Notebook(self)
         self.notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         
-        # Création des onglets
-        self.create_consumption_tab()
-        self.create_stock_tab()
-        self.create_commandes_tab()
-        self.create_alerts_tab()
-        self.create_report_tab()
-        self.create_auxiliary_tab()
-        self.create_indicators_tab()
+        # Les onglets sont créés vides: widgets et données sont construits à la première sélection
+        self.tabs = {}
+        self.tabs_built = set()
+        self.tabs_dirty = set()
+        for key, (label, _, _) in self.tab_specs.items():
+            tab = ttk.Frame(self.notebook)
+            self.notebook.add(tab, text=label)
+            self.tabs[key] = tab
+        
+        # Onglet de diagnostic masqué: Ctrl+Maj+D pour l'afficher
+        if PROFILER.enabled:
+            self.notebook.hide(self.tabs["diagnostics"])
+            self.bind("<Control-D>", self.toggle_diagnostics_tab)
+            self.after(2000, self.poll_diagnostics)
         
         # Barre de statut
         self.status_var = tk.StringVar()
@@ -51,77 +3067,213 @@ class StockApp(tk.Tk):
         self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
         self.status_var.set("Prêt | Système de Gestion de Stock")
         
-        # Initialisation
-        if self.colorants:
-            self.combo_ref.current(0)
-            self.update_stock_display()
-            self.check_stock_alerts()
-            self.update_report_table()
-            self.update_commandes_display()
-            self.update_indicators()
-            self.load_auxiliary_data()
+        # Annuler / rétablir: boutons et raccourcis Ctrl+Z / Ctrl+Y
+        undo_frame = ttk.Frame(self)
+        undo_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=10)
+        ttk.Button(undo_frame, text="↷ Rétablir", command=self.redo).pack(side=tk.RIGHT, padx=2)
+        ttk.Button(undo_frame, text="↶ Annuler", command=self.undo).pack(side=tk.RIGHT, padx=2)
+        self.bind("<Control-z>", self.undo)
+        self.bind("<Control-y>", self.redo)
+        
+        # Indicateur de chargement
+        self.progress_bar = ttk.Progressbar(self, mode="determinate", maximum=len(LOAD_STAGES), length=200)
+        self.progress_bar.pack(side=tk.BOTTOM, anchor=tk.E, padx=10)
+        
+        # Threads de travail: chargement du classeur, exports
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="stockmaster")
+        self.export_future = None
+        self.watch_future = None
+        
+        # Initialisation: seul l'onglet visible est construit, les données arrivent en arrière-plan
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        self.on_tab_changed()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.start_background_load()
+
+    def reset_data(self):
+        """Initialise un modèle de données vide"""
+        self.wb = None
+        self.colorants = []
+        self.colorant_names = {}
+        self.stock_min = {}
+        self.stocks = {}
+        self.stock_initial = {}
+        self.auxiliaires = []
+        self.aux_names = {}
+        self.aux_stock_min = {}
+        self.aux_stocks = {}
+        self.aux_stock_initial = {}
+        self.consumption_history = []
+        self.consumption_totals = {}
+        self.consumption_days = DailyTotals()
+        self.classes = ProductClasses()
+        self.anomalies = ConsumptionStats()
+        self.valuation = StockValuation()
+        self.units = UnitTable()
+        self.reception_days = DailyTotals()
+        self.consumption_index = {}
+        self.commandes = []
+        self.commande_index = {}
+        self.commande_order = CommandeOrder(self.commandes)
+        self.sla = SlaTracker()
+        self.next_ids = {'Consommation': 1, 'commandes': 1}
+        self.receptions = []
+        self.transfers = []
+        self.locations = LocationStock()
+        self.lots = LotStore()
+        self.recipes = RecipeBook()
+        self.total_commandes = 0
+        self.commandes_traitees = 0
+        self.taux_commandes = 0.0
+        self.file_state = None
+        self.sheet_parts = None
+        self.sync_base = None
+        self.evaluator = None
+        self.formula_stocks = {}
+        self.product_rows = {}  # Ligne des produits, pour des écritures sans parcours de feuille
+        self.command_log = CommandLog()
+
+    def apply_load_stage(self, stage, data):
+        """Installe dans le modèle les données d'une étape de chargement"""
+        new_ids = data.pop('new_ids', 0)
+        for name, value in data.items():
+            setattr(self, name, value)
+        
+        if stage == "commandes":
+            self.update_commandes_stats()
+        elif stage == "agregats":
+            self.sheet_articles = self.wb['Liste des articles2']
+            self.sheet_consommation = self.wb['Consommation']
+            self.sheet_commandes = self.wb['commandes']
+            self.sheet_stats = self.wb['Groupe compta. Stock']
+            self.sync_base = self.capture_sync_base()
+            self.command_log.clear()  # Les actions enregistrées portaient sur l'ancien modèle
+            if new_ids:
+                # Identifiants des consommations attribués après l'affichage de l'historique
+                self.refresh_tabs("consommation")
+            if 'stocks' in data or 'aux_stocks' in data:
+                self.refresh_tabs(*STAGE_TABS["catalogue"])
+
+    def start_background_load(self):
+        """Lance la lecture du classeur dans un thread de travail"""
+        for tab in self.notebook.tabs():
+            if self.notebook.tab(tab, "state") != "hidden":
+                self.notebook.tab(tab, state="disabled")
+        self.progress_bar["value"] = 0
+        self.status_var.set("Chargement des données...")
+        
+        self.load_queue = queue.Queue()
+        self.executor.submit(self._load_worker, self.filename, self.load_queue)
+        self.after(50, self.poll_load_queue)
+
+    @staticmethod
+    def _load_worker(filename, results):
+        """Exécuté dans le thread de travail: publie chaque étape dans la file"""
+        try:
+            with PROFILER.measure("chargement arrière-plan"):
+                for stage, data in iter_workbook_stages(filename):
+                    results.put((stage, data))
+        except Exception as e:
+            results.put(("erreur", e))
+
+    def poll_load_queue(self):
+        """Applique sur le thread Tk les étapes publiées par le thread de travail"""
+        try:
+            while True:
+                stage, data = self.load_queue.get_nowait()
+                if stage == "erreur":
+                    messagebox.showerror("Erreur", f"Impossible de charger le fichier Excel:\n{str(data)}")
+                    self.finish_background_load()
+                    return
+                
+                self.apply_load_stage(stage, data)
+                self.on_stage_loaded(stage)
+                if stage == LOAD_STAGES[-1]:
+                    self.finish_background_load()
+                    return
+        except queue.Empty:
+            pass
+        self.after(50, self.poll_load_queue)
+
+    def on_stage_loaded(self, stage):
+        """Rafraîchit et active les onglets dont les données sont prêtes"""
+        self.refresh_tabs(*STAGE_TABS[stage])
+        
+        for name in STAGE_TABS[stage]:
+            self.notebook.tab(self.tabs[name], state="normal")
+        
+        self.progress_bar["value"] = LOAD_STAGES.index(stage) + 1
+        self.status_var.set(f"Chargement des données... ({stage} prêt)")
+
+    def finish_background_load(self):
+        """Termine le chargement: tous les onglets deviennent accessibles"""
+        for tab in self.notebook.tabs():
+            if self.notebook.tab(tab, "state") != "hidden":
+                self.notebook.tab(tab, state="normal")
+        self.progress_bar.pack_forget()
+        if self.wb is not None:
+            self.status_var.set("Prêt | Système de Gestion de Stock")
+            self.after(WATCH_INTERVAL, self.poll_external_changes)
+            self.poll_sla()
+            self.poll_snapshot()
+
+    def workbook_ready(self):
+        """Vérifie que le classeur modifiable est chargé avant une écriture"""
+        if self.wb is None:
+            messagebox.showwarning("Chargement", "Le fichier Excel est encore en cours de chargement, veuillez patienter")
+            return False
+        return True
+
+    def current_tab(self):
+        """Retourne la clé de l'onglet sélectionné"""
+        selected = self.notebook.select()
+        for key, tab in self.tabs.items():
+            if str(tab) == str(selected):
+                return key
+        return None
+
+    def on_tab_changed(self, event=None):
+        """Construit l'onglet à sa première sélection, ou le rafraîchit s'il est périmé"""
+        key = self.current_tab()
+        if key is None:
+            return
+        
+        _, build, refresh = self.tab_specs[key]
+        if key not in self.tabs_built:
+            with PROFILER.measure(f"construction onglet:{key}"):
+                build()
+            self.tabs_built.add(key)
+            refresh()
+        elif key in self.tabs_dirty:
+            refresh()
+        self.tabs_dirty.discard(key)
+
+    def refresh_tabs(self, *keys):
+        """Rafraîchit l'onglet visible et marque les autres onglets comme périmés"""
+        current = self.current_tab()
+        for key in keys:
+            if key not in self.tabs_built:
+                continue  # Les données seront liées à la construction
+            if key == current:
+                self.tab_specs[key][2]()
+                self.tabs_dirty.discard(key)
+            else:
+                self.tabs_dirty.add(key)
+
+    def on_close(self):
+        """Ferme la fenêtre sans attendre la fin d'un chargement ou d'un export en cours"""
+        try:
+            self.audit.flush()  # Dernières modifications journalisées (une écriture, quelques millisecondes)
+        except Exception:
+            pass
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.destroy()
 
     def create_template_if_needed(self):
         """Crée un fichier Excel modèle s'il n'existe pas"""
         if not os.path.exists(self.filename):
             try:
-                wb = openpyxl.Workbook()
-                
-                # Feuille 1: Groupe compta. Stock
-                sheet1 = wb.active
-                sheet1.title = "Groupe compta. Stock"
-                sheet1.append(["Liste des articles"])
-                sheet1.append(["Groupe compta. Stock"])
-                for _ in range(5): sheet1.append([])
-                sheet1.append(["", "LES COMMANDES", "CONSOMMATION"])
-                for _ in range(2): sheet1.append([])
-                sheet1.append(["", "N° total de cmd traitée", "=MAX(Consommation!D2:D143)"])
-                sheet1.append(["", "=COUNTIF(commandes!G2:G162,\"traitée\")", "=MIN(Consommation!D2:D136)"])
-                for _ in range(2): sheet1.append([])
-                sheet1.append(["", "taux des comandes", ""])
-                sheet1.append(["", "=B10/B16", ""])
-                for _ in range(2): sheet1.append([])
-                sheet1.append(["", "N total de commandes", ""])
-                sheet1.append(["", "=COUNTA(commandes!A2:A148)", ""])
-                
-                # Feuille 2: Liste des articles2
-                sheet2 = wb.create_sheet("Liste des articles2")
-                headers = [
-                    "ID COLORANTS", "NOM DE COLORANT", "Stock", "STOCK MIN", 
-                    "CONSOMMATION", "STOCK REEL", "DATE D'ENTRE", "ALERTE DE STOCK"
-                ]
-                sheet2.append(headers)
-                
-                # Feuille 3: Consommation
-                sheet3 = wb.create_sheet("Consommation")
-                sheet3.append(["ID COLORANTS/NOM DE COLORANT", "DATE", "CONSOMMATION (jours)", "CONSOMMATION ( semaine)"])
-                
-                # Feuille 4: Consommation total par colorant
-                sheet4 = wb.create_sheet("Consommation total par colorant")
-                sheet4.append(["ID COLORANT", "CONSOMMATION TOTAL (mois)"])
-                
-                # Feuille 5: commandes
-                sheet5 = wb.create_sheet("commandes")
-                headers = [
-                    "LES COMMANDES", "CODE COULEUR", "DATE D'ENTRE", "DATE SORTIE", 
-                    "delai (jours)", "delai de traitement", "Statut", "observation"
-                ]
-                sheet5.append(headers)
-                
-                # Feuille 6: Feuil2
-                sheet6 = wb.create_sheet("Feuil2")
-                sheet6.append(["statut"])
-                sheet6.append(["traité"])
-                sheet6.append(["non traité"])
-                
-                # Feuille 7: Produits auxiliaires
-                sheet7 = wb.create_sheet("Produits auxiliaires")
-                headers = [
-                    "ID PRODUIT", "NOM", "Stock", "STOCK MIN", 
-                    "CONSOMMATION", "STOCK REEL", "DATE D'ENTRE", "ALERTE DE STOCK"
-                ]
-                sheet7.append(headers)
-                
+                wb = build_template_workbook()
                 wb.save(self.filename)
                 messagebox.showinfo("Fichier créé", 
                                    "Un nouveau fichier Excel modèle a été créé.")
@@ -129,6 +3281,965 @@ class StockApp(tk.Tk):
                 messagebox.showerror("Erreur", 
                                     f"Impossible de créer le fichier Excel:\n{str(e)}")
 
+    def save_workbook(self, rollback=None):
+        """Enregistre le classeur dans le fichier Excel.
+        
+        Le fichier peut être partagé entre plusieurs postes: l'écriture se fait
+        sous verrou, et si un autre poste a enregistré depuis notre dernière
+        lecture, ses modifications sont d'abord fusionnées dans le classeur.
+        
+        Si l'enregistrement échoue (verrou occupé, fusion, écriture), `rollback`
+        défait l'action qui l'a demandé (modèle et feuilles) et ses entrées du
+        journal des modifications sont retirées: rien ne reste qui n'ait atteint
+        le fichier. L'erreur est ensuite remontée à l'action.
+        """
+        merged = False
+        try:
+            with PROFILER.measure("wb.save"):
+                with WorkbookLock(self.filename):
+                    changes = read_external_changes(self.filename, self.file_state, self.sheet_parts)
+                    if changes and changes['sheets']:
+                        self.merge_external_changes(changes['snapshot'], changes['sheets'])
+                        # Fichier relu et fusionné: il reste la référence même si l'écriture échoue
+                        self.file_state, self.sheet_parts = changes['file_state'], changes['sheet_parts']
+                        merged = True
+                    self.file_state, data = write_workbook_file(self.wb, self.filename)
+                self.sheet_parts = workbook_parts(data)
+        except Exception:
+            if rollback is not None:
+                with self.audit.suspended():
+                    rollback()
+                self.audit.discard(self.audit_mark)
+            if merged:
+                self.sync_base = self.capture_sync_base()
+            if rollback is not None or merged:
+                self.refresh_tabs(*self.tab_specs)
+            if rollback is not None:
+                self.status_var.set("Action annulée: le fichier n'a pas pu être enregistré (Ctrl+Y pour réessayer)")
+            raise
+        self.sync_base = self.capture_sync_base()
+        self.audit_mark = self.audit.mark()
+        self.flush_audit()
+
+    def flush_audit(self):
+        """Écrit en arrière-plan les modifications journalisées: l'enregistrement n'attend pas le journal"""
+        if self.audit.has_pending() and (self.audit_future is None or self.audit_future.done()):
+            # Seules les entrées déjà enregistrées dans le classeur: celles d'une action suivante attendent
+            self.audit_future = self.executor.submit(self.audit.flush, len(self.audit.pending))
+
+    def poll_external_changes(self):
+        """Surveille le fichier: les modifications faites ailleurs (Excel, autre poste) sont relues en arrière-plan"""
+        if self.watch_future is None:
+            if self.wb is not None:
+                self.watch_future = self.executor.submit(
+                    read_external_changes, self.filename, self.file_state, self.sheet_parts)
+                self.watch_future.file_state = self.file_state
+        elif self.watch_future.done():
+            future, self.watch_future = self.watch_future, None
+            try:
+                changes = future.result()
+            except Exception:
+                changes = None  # Fichier en cours d'écriture par Excel: nouvel essai au prochain passage
+            # Résultat ignoré si nous avons enregistré entre-temps
+            if changes and future.file_state == self.file_state:
+                self.apply_external_changes(changes)
+        self.after(WATCH_INTERVAL, self.poll_external_changes)
+
+    def poll_sla(self):
+        """Minuteur des délais de commande: signale les commandes dont l'échéance vient de passer"""
+        late = self.sla.tick(datetime.today().strftime('%Y-%m-%d'))
+        if late:
+            self.refresh_tabs("alertes")
+            self.status_var.set(f"{late} commande(s) en attente ont dépassé leur délai de traitement")
+        self.after(SLA_INTERVAL, self.poll_sla)
+
+    def poll_snapshot(self):
+        """Planificateur des instantanés: au plus un par jour, pris au premier passage de la journée"""
+        try:
+            self.capture_snapshot()
+        except Exception as e:
+            # Historique indisponible (verrou, disque): nouvel essai au prochain passage
+            self.status_var.set(f"Historique des indicateurs non enregistré: {e}")
+        self.after(SNAPSHOT_INTERVAL, self.poll_snapshot)
+
+    def capture_snapshot(self, day=None):
+        """Enregistre l'instantané du jour à partir du modèle en mémoire: O(produits), sans relire le classeur"""
+        values = {}
+        alerts = 0
+        for refs, stocks, minimum in ((self.colorants, self.stocks, self.stock_min),
+                                      (self.auxiliaires, self.aux_stocks, self.aux_stock_min)):
+            for ref in refs:
+                stock = stocks.get(ref, 0.0)
+                values[ref] = stock
+                alerts += stock < minimum.get(ref, 0.0)
+        values.update(zip(KPI_SERIES, (alerts, self.total_commandes, self.commandes_traitees,
+                                       self.taux_commandes, len(self.sla.late))))
+        return self.snapshots.capture(day or datetime.today().strftime('%Y-%m-%d'), values)
+
+    def apply_external_changes(self, changes):
+        """Intègre au modèle et au classeur les feuilles modifiées hors de l'application"""
+        if changes['sheets']:
+            self.merge_external_changes(changes['snapshot'], changes['sheets'])
+        self.file_state = changes['file_state']
+        self.sheet_parts = changes['sheet_parts']
+        self.sync_base = self.capture_sync_base()
+
+    def set_cell(self, sheet, row, col, value):
+        """Écrit une cellule et invalide les formules qui en dépendent"""
+        sheet.cell(row=row, column=col).value = value
+        self.evaluator.invalidate(sheet.title, row, col)
+
+    def set_derived(self, sheet, row, col, value):
+        """Écrit une valeur calculée par l'application, sauf si la cellule porte une formule"""
+        if not is_formula(sheet.cell(row=row, column=col).value):
+            self.set_cell(sheet, row, col, value)
+
+    def resolve_formula_stocks(self, refs=None):
+        """Recalcule les stocks définis par une formule (tous, ou ceux de `refs`)"""
+        for ref, (sheet, row, prefix) in self.formula_stocks.items():
+            if refs is None or ref in refs:
+                getattr(self, prefix + "stocks")[ref] = to_float(self.evaluator.value(sheet, row, 6))
+
+    def product_sheet(self, ref):
+        """Feuille et préfixe des données ("" colorants, "aux_" auxiliaires) d'un produit"""
+        if ref in self.stock_initial:
+            return self.sheet_articles, ""
+        return self.wb["Produits auxiliaires"], "aux_"
+
+    def adjust_stock(self, ref, delta):
+        """Reporte un mouvement sur le stock réel d'un produit (modèle, colonnes F et H)"""
+        if ref not in self.stock_initial and ref not in self.aux_stock_initial:
+            return  # Produit retiré du catalogue
+        sheet, prefix = self.product_sheet(ref)
+        stocks = getattr(self, prefix + "stocks")
+        stocks[ref] = stocks.get(ref, 0.0) + delta
+        row = self.product_rows.get(ref)
+        if row is not None:
+            self.set_derived(sheet, row, 6, stocks[ref])
+            alerte = "vrai" if stocks[ref] < getattr(self, prefix + "stock_min").get(ref, 0.0) else "faux"
+            self.set_derived(sheet, row, 8, alerte)
+        # Stock défini par une formule: la valeur affichée est celle de la formule
+        self.resolve_formula_stocks({ref})
+
+    def new_id(self, sheet_name):
+        """Prochain identifiant permanent d'une feuille (Consommation, commandes)"""
+        value = self.next_ids[sheet_name]
+        self.next_ids[sheet_name] += 1
+        return value
+
+    def insert_consumption(self, item):
+        """Écrit une consommation à sa ligne (item['row']) et la reporte sur l'historique et le stock"""
+        row = item['row']
+        self.set_cell(self.sheet_consommation, row, 1, item['ref'])
+        self.set_cell(self.sheet_consommation, row, 2, item['date'])
+        self.set_cell(self.sheet_consommation, row, 3, item['qty'])
+        self.set_cell(self.sheet_consommation, row, ID_COLUMN, item['id'])
+        if item.get('commande'):
+            self.set_cell(self.sheet_consommation, row, COMMANDE_LINK_COLUMN, item['commande'])
+        if location_name(item.get('emplacement')) != DEFAULT_LOCATION:
+            self.set_cell(self.sheet_consommation, row, LOCATION_COLUMN, item['emplacement'])
+        self.consumption_index[item['id']] = item
+        self.audit.record(item['ref'], f"Consommation {item['id']}", "ajout", None,
+                          {'date': item['date'], 'quantité': item['qty']})
+        
+        # Prélèvement dans les lots (FEFO/FIFO); une consommation rétablie reprend les mêmes lots
+        if item.get('lots') is None:
+            item['lots'] = self.lots.draw(item['ref'], item['qty'])
+        else:
+            self.lots.take(item['ref'], item['lots'])
+        self.set_cell(self.sheet_consommation, row, LOT_COLUMN, encode_draws(item['lots']))
+        
+        # L'historique reste trié par ligne: ajout en fin sauf pour une ligne rétablie
+        if not self.consumption_history or self.consumption_history[-1]['row'] < row:
+            self.consumption_history.append(item)
+        else:
+            bisect.insort(self.consumption_history, item, key=lambda h: h['row'])
+        self.account_consumption(item)
+        self.adjust_stock(item['ref'], -item['qty'])
+
+    def remove_consumption(self, item):
+        """Retire une consommation en vidant sa ligne: les autres lignes gardent leur numéro,
+        l'identifiant reste dans la colonne masquée et ne sera pas réattribué"""
+        row = item['row']
+        for col in (1, 2, 3, LOT_COLUMN, COMMANDE_LINK_COLUMN, LOCATION_COLUMN):
+            self.set_cell(self.sheet_consommation, row, col, None)
+        self.consumption_index.pop(item['id'], None)
+        self.audit.record(item['ref'], f"Consommation {item['id']}", "suppression",
+                          {'date': item['date'], 'quantité': item['qty']}, None)
+        self.lots.give_back(item['ref'], item.get('lots') or [])
+        
+        index = bisect.bisect_left(self.consumption_history, row, key=lambda h: h['row'])
+        if index < len(self.consumption_history) and self.consumption_history[index] is item:
+            del self.consumption_history[index]
+        self.account_consumption(item, -1)
+        self.adjust_stock(item['ref'], item['qty'])
+
+    def account_consumption(self, item, sign=1):
+        """Reporte (sign=1) ou retire (sign=-1) une consommation des agrégats tenus à jour:
+        totaux, journées, classes, anomalies, valorisation et emplacements"""
+        ref, qty = item['ref'], item['qty']
+        self.consumption_totals[ref] = self.consumption_totals.get(ref, 0.0) + sign * qty
+        self.consumption_days.add(ref, item['date'], sign * qty)
+        self.classes.touch(ref)
+        if sign > 0:
+            self.anomalies.add(ref, qty)
+        else:
+            self.anomalies.remove(ref, qty)
+        self.valuation.consume(item, sign)
+        self.locations.consume(item, sign)
+
+    def change_consumption(self, item, date_str, qty):
+        """Modifie la date et la quantité d'une consommation; retourne les anciennes valeurs"""
+        old = item['date'], item['qty']
+        for champ, before, after in (("date", item['date'], date_str), ("quantité", item['qty'], qty)):
+            if before != after:
+                self.audit.record(item['ref'], f"Consommation {item['id']}", champ, before, after)
+        self.set_cell(self.sheet_consommation, item['row'], 2, date_str)
+        self.set_cell(self.sheet_consommation, item['row'], 3, qty)
+        self.account_consumption(item, -1)
+        item['date'], item['qty'] = date_str, qty
+        self.account_consumption(item)
+        
+        # Les lots sont prélevés à nouveau pour la nouvelle quantité
+        self.lots.give_back(item['ref'], item.get('lots') or [])
+        item['lots'] = self.lots.draw(item['ref'], qty)
+        self.set_cell(self.sheet_consommation, item['row'], LOT_COLUMN, encode_draws(item['lots']))
+        self.adjust_stock(item['ref'], old[1] - qty)
+        return old
+
+    def set_initial_stock(self, ref, value):
+        """Met à jour le stock initial d'un produit (F = C - E); retourne l'ancienne valeur"""
+        sheet, prefix = self.product_sheet(ref)
+        initial = getattr(self, prefix + "stock_initial")
+        stocks = getattr(self, prefix + "stocks")
+        old = initial[ref]
+        if old != value:
+            self.audit.record(ref, "Produit", "stock initial", old, value)
+        row = self.product_rows.get(ref)
+        if row is not None:
+            # Mettre à jour le stock initial (colonne C/3)
+            self.set_cell(sheet, row, 3, value)
+            
+            # Recalculer le stock réel (F = C - E, E pouvant être une formule)
+            consommation = to_float(self.evaluator.value(sheet.title, row, 5))
+            stocks[ref] = value - consommation
+            self.set_derived(sheet, row, 6, stocks[ref])
+            
+            # Mise à jour de l'alerte de stock
+            alerte = "vrai" if stocks[ref] < getattr(self, prefix + "stock_min").get(ref, 0.0) else "faux"
+            self.set_derived(sheet, row, 8, alerte)
+        initial[ref] = value
+        self.resolve_formula_stocks({ref})
+        return old
+
+    def insert_product(self, product, row=None):
+        """Ajoute un produit (prefix, ref, nom, stock initial, stock minimal) à sa feuille; retourne sa ligne"""
+        prefix, ref, name, init_stock, min_stock = product
+        sheet = self.sheet_articles if not prefix else self.wb["Produits auxiliaires"]
+        self.audit.record(ref, "Produit", "ajout", None,
+                          {'nom': name, 'stock initial': init_stock, 'stock minimal': min_stock})
+        if row is None:
+            row = sheet.max_row + 1
+        
+        self.set_cell(sheet, row, 1, ref)
+        self.set_cell(sheet, row, 2, name)
+        self.set_cell(sheet, row, 3, init_stock)
+        self.set_cell(sheet, row, 4, min_stock)
+        # CONSOMMATION =SUMIF(Consommation!A:A,A{row},Consommation!C:C): colonnes entières,
+        # pour que les consommations ajoutées ensuite soient comptées
+        self.set_cell(sheet, row, 5, f'=SUMIF(Consommation!A:A,A{row},Consommation!C:C)')
+        # STOCK REEL =C3-E3
+        self.set_cell(sheet, row, 6, f'=C{row}-E{row}')
+        # ALERTE DE STOCK =IF(D3>=F3,"faux","vrai")
+        self.set_cell(sheet, row, 8, f'=IF(D{row}>=F{row},"faux","vrai")')
+        
+        getattr(self, "colorants" if not prefix else "auxiliaires").append(ref)
+        getattr(self, "colorant_names" if not prefix else "aux_names")[ref] = name
+        getattr(self, prefix + "stock_initial")[ref] = init_stock
+        getattr(self, prefix + "stock_min")[ref] = min_stock
+        self.formula_stocks[ref] = (sheet.title, row, prefix)
+        self.product_rows[ref] = row
+        self.resolve_formula_stocks({ref})
+        return row
+
+    def remove_product(self, product, row):
+        """Retire un produit en laissant sa ligne vide"""
+        prefix, ref, name, init_stock, min_stock = product
+        sheet = self.sheet_articles if not prefix else self.wb["Produits auxiliaires"]
+        self.audit.record(ref, "Produit", "suppression",
+                          {'nom': name, 'stock initial': init_stock, 'stock minimal': min_stock}, None)
+        for col in range(1, 9):
+            self.set_cell(sheet, row, col, None)
+        
+        getattr(self, "colorants" if not prefix else "auxiliaires").remove(ref)
+        getattr(self, "colorant_names" if not prefix else "aux_names").pop(ref, None)
+        for name in ("stock_initial", "stock_min", "stocks"):
+            getattr(self, prefix + name).pop(ref, None)
+        self.formula_stocks.pop(ref, None)
+        self.product_rows.pop(ref, None)
+
+    def write_commande(self, cmd):
+        """Écrit une commande à sa ligne de la feuille commandes"""
+        for col, key in COMMANDE_COLUMNS:
+            self.set_cell(self.sheet_commandes, cmd['row'], col, cmd[key])
+        self.commande_order.update(cmd)
+        self.sla.track(cmd)
+
+    def insert_commande(self, cmd, position=None):
+        """Ajoute une commande (en fin de liste, ou à `position` pour une commande rétablie)"""
+        if cmd.get('id') is None:
+            cmd['id'] = self.new_id('commandes')
+            cmd['row'] = self.sheet_commandes.max_row + 1
+        self.commandes.insert(len(self.commandes) if position is None else position, cmd)
+        self.commande_index[cmd['id']] = cmd
+        self.audit.record(cmd['ref'], f"Commande {cmd['id']}", "ajout", None,
+                          {'code': cmd['code'], 'statut': cmd['statut']})
+        self.write_commande(cmd)  # Place aussi la commande dans les ordres de tri et le suivi des délais
+
+    def remove_commande(self, cmd):
+        """Retire une commande en vidant sa ligne (l'identifiant reste); retourne sa position dans la liste"""
+        position = next(i for i, other in enumerate(self.commandes) if other is cmd)
+        del self.commandes[position]
+        self.commande_index.pop(cmd['id'], None)
+        self.audit.record(cmd['ref'], f"Commande {cmd['id']}", "suppression",
+                          {'code': cmd['code'], 'statut': cmd['statut']}, None)
+        self.commande_order.remove(cmd)
+        self.sla.untrack(cmd['id'])
+        for col, _ in COMMANDE_COLUMNS:
+            if col != ID_COLUMN:
+                self.set_cell(self.sheet_commandes, cmd['row'], col, None)
+        return position
+
+    def update_commande(self, cmd, fields):
+        """Modifie les champs d'une commande et réécrit sa ligne"""
+        old_fields = dict(cmd)
+        cmd.update(fields)
+        self.audit_commande(cmd, old_fields)
+        self.write_commande(cmd)
+
+    def audit_commande(self, cmd, old_fields):
+        """Journalise les champs d'une commande qui diffèrent de `old_fields`"""
+        for _, key in COMMANDE_COLUMNS:
+            if old_fields.get(key) != cmd.get(key):
+                self.audit.record(cmd['ref'], f"Commande {cmd['id']}", key, old_fields.get(key), cmd.get(key))
+
+    def selected_commande(self):
+        """Commande sélectionnée dans la liste (l'identifiant de la ligne est celui de la commande)"""
+        selected = self.commandes_tree.selection()
+        if not selected:
+            messagebox.showwarning("Erreur", "Veuillez sélectionner une commande")
+            return None
+        commande = self.commande_index.get(int(selected[0]))
+        if not commande:
+            messagebox.showwarning("Erreur", "Commande introuvable")
+        return commande
+
+    def record_commandes(self, label, undo, redo):
+        """Enregistre une action sur les commandes: chaque inverse réécrit ensuite la feuille"""
+        def replay(change):
+            change()
+            self.update_commandes_stats()
+            self.write_commandes_stats()
+        
+        self.command_log.record(label, lambda: replay(undo), lambda: replay(redo))
+
+    def receptions_sheet(self):
+        """Feuille des réceptions, créée au premier bon enregistré dans un ancien classeur"""
+        if RECEPTION_SHEET not in self.wb.sheetnames:
+            sheet = self.wb.create_sheet(RECEPTION_SHEET)
+            for col, _, header in RECEPTION_COLUMNS:
+                sheet.cell(row=1, column=col, value=header)
+        return self.wb[RECEPTION_SHEET]
+
+    def insert_reception(self, item):
+        """Écrit une ligne de réception à sa ligne (item['row']) et la reporte sur son lot"""
+        sheet = self.receptions_sheet()
+        for col, key, _ in RECEPTION_COLUMNS:
+            self.set_cell(sheet, item['row'], col, item.get(key))
+        self.audit.record(item['ref'], f"Réception {item['document'] or item['date']}", "ajout", None,
+                          {'quantité': item['qty'], 'lot': item['lot'], 'emplacement': item.get('emplacement')})
+        if not self.receptions or self.receptions[-1]['row'] < item['row']:
+            self.receptions.append(item)
+        else:
+            bisect.insort(self.receptions, item, key=lambda r: r['row'])
+        self.lots.receive(item)
+        self.valuation.receive(item)
+        self.locations.receive(item)
+        self.reception_days.add(item['ref'], item['date'], item['qty'])
+
+    def remove_reception(self, item):
+        """Retire une ligne de réception en vidant sa ligne"""
+        sheet = self.receptions_sheet()
+        for col, _, _ in RECEPTION_COLUMNS:
+            self.set_cell(sheet, item['row'], col, None)
+        self.audit.record(item['ref'], f"Réception {item['document'] or item['date']}", "suppression",
+                          {'quantité': item['qty'], 'lot': item['lot'], 'emplacement': item.get('emplacement')}, None)
+        index = bisect.bisect_left(self.receptions, item['row'], key=lambda r: r['row'])
+        if index < len(self.receptions) and self.receptions[index] is item:
+            del self.receptions[index]
+        self.lots.receive(item, -1)
+        self.valuation.receive(item, -1)
+        self.locations.receive(item, -1)
+        self.reception_days.add(item['ref'], item['date'], -item['qty'])
+
+    def transfers_sheet(self):
+        """Feuille des transferts, créée au premier transfert enregistré dans un ancien classeur"""
+        if TRANSFER_SHEET not in self.wb.sheetnames:
+            sheet = self.wb.create_sheet(TRANSFER_SHEET)
+            for col, _, header in TRANSFER_COLUMNS:
+                sheet.cell(row=1, column=col, value=header)
+        return self.wb[TRANSFER_SHEET]
+
+    def insert_transfer(self, item):
+        """Écrit un transfert à sa ligne (item['row']) et le reporte sur les emplacements"""
+        sheet = self.transfers_sheet()
+        for col, key, _ in TRANSFER_COLUMNS:
+            self.set_cell(sheet, item['row'], col, item[key])
+        self.audit.record(item['ref'], "Transfert", "ajout", None,
+                          {'de': item['de'], 'vers': item['vers'], 'quantité': item['qty']})
+        if not self.transfers or self.transfers[-1]['row'] < item['row']:
+            self.transfers.append(item)
+        else:
+            bisect.insort(self.transfers, item, key=lambda r: r['row'])
+        self.locations.transfer(item)
+
+    def remove_transfer(self, item):
+        """Retire un transfert en vidant sa ligne"""
+        sheet = self.transfers_sheet()
+        for col, _, _ in TRANSFER_COLUMNS:
+            self.set_cell(sheet, item['row'], col, None)
+        self.audit.record(item['ref'], "Transfert", "suppression",
+                          {'de': item['de'], 'vers': item['vers'], 'quantité': item['qty']}, None)
+        index = bisect.bisect_left(self.transfers, item['row'], key=lambda r: r['row'])
+        if index < len(self.transfers) and self.transfers[index] is item:
+            del self.transfers[index]
+        self.locations.transfer(item, -1)
+
+    def apply_receipt(self, items, sign=1):
+        """Applique (sign=1) ou retire (sign=-1) un bon de réception: lignes, lots, puis stocks.
+        
+        Les quantités sont cumulées par produit: une seule mise à jour du stock
+        par référence, quel que soit le nombre de lignes du bon.
+        """
+        totals = {}
+        for item in (items if sign > 0 else reversed(items)):
+            if sign > 0:
+                self.insert_reception(item)
+            else:
+                self.remove_reception(item)
+            totals[item['ref']] = totals.get(item['ref'], 0.0) + item['qty']
+        
+        for ref, qty in totals.items():
+            self.receive_stock(ref, sign * qty)
+
+    def receive_stock(self, ref, qty):
+        """Entrée en stock: ajoute `qty` au stock initial (colonne C) et au stock réel"""
+        sheet, prefix = self.product_sheet(ref)
+        initial = getattr(self, prefix + "stock_initial")
+        initial[ref] += qty
+        row = self.product_rows.get(ref)
+        if row is not None:
+            self.set_cell(sheet, row, 3, initial[ref])
+        self.adjust_stock(ref, qty)
+
+    @PROFILER.timed("action:reception")
+    def save_receipt(self, document, date_str, lines, location=DEFAULT_LOCATION):
+        """Enregistre un bon de réception en une seule transaction.
+        
+        Toutes les lignes sont contrôlées avant la moindre écriture; elles sont
+        ensuite appliquées ensemble (dans l'emplacement `location`), enregistrées
+        une fois et l'interface est rafraîchie une fois. Retourne True si le bon
+        a été enregistré.
+        """
+        if not lines:
+            messagebox.showwarning("Erreur", "Le bon de réception ne contient aucune ligne")
+            return False
+        try:
+            datetime.strptime(date_str, '%Y-%m-%d')
+        except ValueError:
+            messagebox.showwarning("Erreur", "Format de date invalide. Utilisez AAAA-MM-JJ")
+            return False
+        
+        refs = set(self.stock_initial) | set(self.aux_stock_initial)
+        errors = check_receipt_lines(lines, refs)
+        if errors:
+            shown = "\n".join(errors[:15]) + (f"\n... ({len(errors) - 15} autres)" if len(errors) > 15 else "")
+            messagebox.showwarning("Bon de réception invalide", shown)
+            return False
+        
+        try:
+            first_row = self.receptions_sheet().max_row + 1
+            items = [dict(line, date=date_str, document=document, emplacement=location, row=first_row + i)
+                     for i, line in enumerate(lines)]
+            self.apply_receipt(items)
+            self.command_log.record(f"Réception {document or date_str} ({len(items)} ligne(s))",
+                                    lambda: self.apply_receipt(items, -1),
+                                    lambda: self.apply_receipt(items))
+            
+            self.save_workbook(rollback=self.command_log.undo)
+            self.refresh_tabs("stock", "consommation", "alertes", "rapports", "auxiliaires", "indicateurs")
+            
+            total = sum(item['qty'] for item in items)
+            self.status_var.set(f"Réception {document} enregistrée: {len(items)} ligne(s), {total:.2f} kg")
+            return True
+        except Exception as e:
+            messagebox.showerror("Erreur", f"Erreur lors de l'enregistrement de la réception:\n{str(e)}")
+            return False
+
+    def stock_of(self, ref):
+        """Stock réel d'un produit, colorant ou auxiliaire (None si la référence est inconnue)"""
+        if ref in self.stock_initial:
+            return self.stocks.get(ref, 0.0)
+        if ref in self.aux_stock_initial:
+            return self.aux_stocks.get(ref, 0.0)
+        return None
+
+    def location_stock_of(self, location, ref):
+        """Stock réel d'un produit à un emplacement (None si la référence est inconnue)"""
+        total = self.stock_of(ref)
+        return None if total is None else self.locations.quantity(ref, location, total)
+
+    def refresh_classes(self):
+        """Met à jour les classes ABC/XYZ des produits du catalogue; retourne self.classes"""
+        self.classes.refresh(self.colorants + self.auxiliaires, self.consumption_totals, self.consumption_days)
+        return self.classes
+
+    def prepare_recipe(self, code, weight, date_str, commande=None, location=DEFAULT_LOCATION):
+        """Décompose la recette d'un code couleur pour un lot de `weight` kg.
+        
+        Le stock de tous les composants à l'emplacement `location` est contrôlé
+        avant toute écriture; retourne les consommations à enregistrer (None,
+        après un message, si la recette est inconnue ou si un composant manque),
+        prélevées à cet emplacement et rattachées à la référence de commande
+        `commande` s'il y en a une.
+        """
+        needs = self.recipes.explode(code, weight)
+        if not needs:
+            messagebox.showwarning("Erreur", f"Aucune recette pour le code couleur {code}")
+            return None
+        errors = check_recipe_stock(needs, functools.partial(self.location_stock_of, location), self.units.format)
+        if errors:
+            messagebox.showwarning("Stock insuffisant", f"Recette {code} pour {weight:.2f} kg ({location}):\n"
+                                   + "\n".join(errors))
+            return None
+        
+        first_row = self.sheet_consommation.max_row + 1
+        return [{'ref': ref, 'date': date_str, 'qty': qty, 'id': self.new_id('Consommation'), 'row': first_row + i,
+                 'commande': commande, 'emplacement': location}
+                for i, (ref, qty) in enumerate(needs)]
+
+    def apply_consumptions(self, items, sign=1):
+        """Enregistre (sign=1) ou retire (sign=-1) les consommations d'une recette, toutes ou aucune"""
+        done = []
+        try:
+            for item in (items if sign > 0 else reversed(items)):
+                if sign > 0:
+                    self.insert_consumption(item)
+                else:
+                    self.remove_consumption(item)
+                done.append(item)
+        except Exception:
+            for item in reversed(done):
+                if sign > 0:
+                    self.remove_consumption(item)
+                else:
+                    self.insert_consumption(item)
+            raise
+
+    def undo(self, event=None):
+        """Annule la dernière action (Ctrl+Z)"""
+        self.replay(self.command_log.undo, "annulée", "Rien à annuler")
+
+    def redo(self, event=None):
+        """Rétablit la dernière action annulée (Ctrl+Y)"""
+        self.replay(self.command_log.redo, "rétablie", "Rien à rétablir")
+
+    @PROFILER.timed("action:annuler")
+    def replay(self, step, verb, empty):
+        """Joue l'inverse (ou la reprise) d'une action, puis enregistre et rafraîchit les onglets"""
+        if not self.workbook_ready():
+            return
+        try:
+            label = step()
+            if label is None:
+                self.status_var.set(empty)
+                return
+            # Si l'enregistrement échoue, l'action repart dans la pile d'où elle venait
+            self.save_workbook(rollback=self.command_log.redo if step == self.command_log.undo
+                               else self.command_log.undo)
+            self.refresh_tabs(*self.tab_specs)
+            self.status_var.set(f"{label}: action {verb}")
+        except Exception as e:
+            messagebox.showerror("Erreur", f"Erreur lors de l'annulation:\n{str(e)}")
+
+    def capture_sync_base(self):
+        """Mémorise l'état commun au fichier et au modèle, base des fusions à trois voies"""
+        return {
+            'consommation': {item['id']: consumption_fields(item) for item in self.consumption_history},
+            'colorants': {ref: (self.stock_initial.get(ref, 0.0), self.stocks.get(ref, 0.0))
+                          for ref in self.colorants},
+            'auxiliaires': {ref: (self.aux_stock_initial.get(ref, 0.0), self.aux_stocks.get(ref, 0.0))
+                            for ref in self.auxiliaires},
+            'commandes': {cmd['id']: commande_fields(cmd) for cmd in self.commandes},
+            'receptions': Counter(reception_key(item) for item in self.receptions),
+            'transferts': Counter(transfer_key(item) for item in self.transfers),
+        }
+
+    @PROFILER.timed("fusion")
+    def merge_external_changes(self, theirs, sheets):
+        """Fusionne dans le classeur les modifications enregistrées par un autre poste.
+        
+        Fusion à trois voies entre la base (dernier état synchronisé), nos
+        modifications et le fichier sur disque:
+        - consommations: identifiées par (référence, date, quantité), les ajouts
+          et suppressions de l'autre poste sont rejoués sur la feuille;
+        - stocks: traités comme un journal, stock = base + Δ nôtre + Δ disque,
+          de sorte qu'aucune écriture ne soit perdue;
+        - commandes: identifiées par (référence, code, date d'entrée), une
+          modification de l'autre poste l'emporte si nous n'avons pas touché la commande.
+        
+        Seules les feuilles de `sheets` (celles dont le XML a changé) sont
+        comparées, et seuls les onglets concernés sont rafraîchis.
+        """
+        # Modifications de l'autre poste: déjà dans son journal, elles ne sont pas journalisées à nouveau
+        with self.audit.suspended():
+            base = self.sync_base
+            changes = 0
+            tabs = set()
+            
+            if 'Consommation' in sheets and self.merge_consumption(base['consommation'], theirs['consumption_history']):
+                changes += 1
+                tabs.update(SHEET_TABS['Consommation'])
+                if self.formula_stocks:
+                    tabs.update(SHEET_TABS['Liste des articles2'])
+            if 'Liste des articles2' in sheets and self.merge_stock(base['colorants'], theirs, self.sheet_articles, ""):
+                changes += 1
+                tabs.update(SHEET_TABS['Liste des articles2'])
+            if 'Produits auxiliaires' in sheets and "Produits auxiliaires" in self.wb.sheetnames:
+                if self.merge_stock(base['auxiliaires'], theirs, self.wb["Produits auxiliaires"], "aux_"):
+                    changes += 1
+                    tabs.update(SHEET_TABS['Produits auxiliaires'])
+            if 'commandes' in sheets and self.merge_commandes(base['commandes'], theirs['commandes']):
+                changes += 1
+                tabs.update(SHEET_TABS['commandes'])
+            if RECEPTION_SHEET in sheets and self.merge_receptions(base['receptions'], theirs.get('receptions', [])):
+                changes += 1
+                tabs.update(SHEET_TABS[RECEPTION_SHEET])
+            if RECIPE_SHEET in sheets and self.merge_recipes(theirs.get('recipes', [])):
+                changes += 1
+                tabs.update(SHEET_TABS[RECIPE_SHEET])
+            if SLA_SHEET in sheets and self.merge_sla_rules(theirs.get('sla_rules', [])):
+                changes += 1
+                tabs.update(SHEET_TABS[SLA_SHEET])
+            if UNIT_SHEET in sheets and self.merge_units(theirs.get('units', [])):
+                changes += 1
+                tabs.update(SHEET_TABS[UNIT_SHEET])
+            if LOCATION_SHEET in sheets and self.merge_locations(theirs.get('locations', [])):
+                changes += 1
+                tabs.update(SHEET_TABS[LOCATION_SHEET])
+            if TRANSFER_SHEET in sheets and self.merge_transfers(base['transferts'], theirs.get('transfers', [])):
+                changes += 1
+                tabs.update(SHEET_TABS[TRANSFER_SHEET])
+            
+            if changes:
+                self.refresh_tabs(*tabs)
+                self.status_var.set(f"Fichier modifié hors de l'application: {len(tabs)} onglet(s) mis à jour")
+
+    def merge_consumption(self, base, theirs_history):
+        """Rejoue sur la feuille Consommation les ajouts, modifications et suppressions du fichier sur disque.
+        
+        Les consommations sont rapprochées par leur identifiant permanent. Une
+        ligne ajoutée par l'autre poste garde le sien; si nous l'avons déjà
+        attribué à une ligne pas encore enregistrée, c'est la nôtre qui est
+        renumérotée: l'identifiant du fichier l'emporte, tous les postes
+        retiennent le même. Une modification de l'autre poste l'emporte si nous
+        n'avons pas touché la ligne. Les lignes sans identifiant (saisies dans
+        Excel) sont rapprochées par leurs valeurs des lignes connues absentes
+        du fichier, puis reçoivent un identifiant de notre séquence.
+        """
+        theirs = {}
+        anonymous = {}
+        for other in theirs_history:
+            if other['id'] is None or other['id'] in theirs:
+                anonymous.setdefault(consumption_fields(other), []).append(other)
+            else:
+                theirs[other['id']] = other
+        
+        removed = []
+        for cid, fields in base.items():
+            if cid in theirs:
+                continue
+            if anonymous.get(fields):
+                anonymous[fields].pop()  # Même ligne, identifiant pas encore écrit dans le fichier
+            elif cid in self.consumption_index:
+                removed.append(self.consumption_index[cid])
+        changed = [(self.consumption_index[cid], other) for cid, other in theirs.items()
+                   if cid in base and cid in self.consumption_index and consumption_fields(other) != base[cid]
+                   and consumption_fields(self.consumption_index[cid]) == base[cid]]
+        added = [other for cid, other in theirs.items() if cid not in base]
+        added += [other for others in anonymous.values() for other in others]
+        if not removed and not changed and not added:
+            return 0
+        
+        # Les stocks de l'autre poste incluent déjà ces mouvements (fusionnés par merge_stock):
+        # seuls la feuille, l'historique et les agrégats (mis à jour ligne par ligne) sont repris ici
+        if removed:
+            gone = {item['id'] for item in removed}
+            for item in removed:
+                # Ligne vidée, pas supprimée: les autres consommations gardent leur ligne
+                for col in (1, 2, 3, LOT_COLUMN, COMMANDE_LINK_COLUMN, LOCATION_COLUMN):
+                    self.set_cell(self.sheet_consommation, item['row'], col, None)
+                self.consumption_index.pop(item['id'], None)
+                self.lots.give_back(item['ref'], item.get('lots') or [])
+                self.account_consumption(item, -1)
+            self.consumption_history[:] = [item for item in self.consumption_history if item['id'] not in gone]
+        
+        for item, other in changed:
+            # Même objet: les actions enregistrées restent valides
+            self.lots.give_back(item['ref'], item.get('lots') or [])
+            self.account_consumption(item, -1)
+            item.update(ref=other['ref'], date=other['date'], qty=other['qty'], lots=other.get('lots') or [])
+            self.account_consumption(item)
+            self.lots.take(item['ref'], item['lots'])
+            for col, value in ((1, item['ref']), (2, item['date']), (3, item['qty']),
+                               (LOT_COLUMN, encode_draws(item['lots']))):
+                self.set_cell(self.sheet_consommation, item['row'], col, value)
+        
+        # Notre séquence reprend après les identifiants du fichier
+        if theirs:
+            self.next_ids['Consommation'] = max(self.next_ids['Consommation'], max(theirs) + 1)
+        for other in added:
+            cid = other['id'] if other['id'] in theirs and theirs[other['id']] is other else None
+            if cid is not None and cid in self.consumption_index:
+                # Même identifiant attribué ici à une ligne pas encore enregistrée: la nôtre est renumérotée
+                mine = self.consumption_index.pop(cid)
+                mine['id'] = self.new_id('Consommation')
+                self.consumption_index[mine['id']] = mine
+                self.set_cell(self.sheet_consommation, mine['row'], ID_COLUMN, mine['id'])
+            item = {'ref': other['ref'], 'date': other['date'], 'qty': other['qty'], 'lots': other.get('lots') or [],
+                    'commande': other.get('commande'), 'emplacement': location_name(other.get('emplacement')),
+                    'id': cid if cid is not None else self.new_id('Consommation'),
+                    'row': self.sheet_consommation.max_row + 1}
+            location = item['emplacement'] if item['emplacement'] != DEFAULT_LOCATION else None
+            for col, value in ((1, item['ref']), (2, item['date']), (3, item['qty']), (ID_COLUMN, item['id']),
+                               (LOT_COLUMN, encode_draws(item['lots'])), (COMMANDE_LINK_COLUMN, item['commande']),
+                               (LOCATION_COLUMN, location)):
+                self.set_cell(self.sheet_consommation, item['row'], col, value)
+            self.lots.take(item['ref'], item['lots'])
+            self.consumption_history.append(item)
+            self.consumption_index[item['id']] = item
+            self.account_consumption(item)
+        
+        self.resolve_formula_stocks()
+        return len(added) + len(changed) + len(removed)
+
+    def merge_receptions(self, base, theirs_receptions):
+        """Rejoue sur la feuille Réceptions les lignes ajoutées ou retirées par un autre poste.
+        
+        Les quantités reçues sont déjà comprises dans le stock initial de l'autre
+        poste (fusionné par merge_stock): seuls les lignes et les lots sont repris.
+        """
+        theirs = {}
+        for item in theirs_receptions:
+            theirs.setdefault(reception_key(item), []).append(item)
+        counts = Counter({key: len(items) for key, items in theirs.items()})
+        added = counts - base
+        removed = base - counts
+        if not added and not removed:
+            return 0
+        
+        pending = Counter(removed)
+        for item in list(self.receptions):
+            key = reception_key(item)
+            if pending[key] > 0:
+                pending[key] -= 1
+                self.remove_reception(item)
+        for key, count in added.items():
+            for other in theirs[key][-count:]:
+                self.insert_reception(dict(other, row=self.receptions_sheet().max_row + 1))
+        return sum(added.values()) + sum(removed.values())
+
+    def merge_transfers(self, base, theirs_transfers):
+        """Rejoue sur la feuille Transferts les transferts ajoutés ou retirés par un autre poste (comme les réceptions)"""
+        theirs = {}
+        for item in theirs_transfers:
+            theirs.setdefault(transfer_key(item), []).append(item)
+        counts = Counter({key: len(items) for key, items in theirs.items()})
+        added = counts - base
+        removed = base - counts
+        if not added and not removed:
+            return 0
+        
+        pending = Counter(removed)
+        for item in list(self.transfers):
+            key = transfer_key(item)
+            if pending[key] > 0:
+                pending[key] -= 1
+                self.remove_transfer(item)
+        for key, count in added.items():
+            for other in theirs[key][-count:]:
+                self.insert_transfer(dict(other, row=self.transfers_sheet().max_row + 1))
+        return sum(added.values()) + sum(removed.values())
+
+    def merge_recipes(self, theirs_recipes):
+        """Reprend les recettes du fichier sur disque: l'application ne les modifie pas,
+        la version du fichier l'emporte et la feuille du classeur en mémoire est réécrite"""
+        theirs = RecipeBook.build(theirs_recipes)
+        if (theirs.codes.keys() == self.recipes.codes.keys()
+                and all(theirs.components(code) == self.recipes.components(code) for code in theirs.codes)):
+            return 0
+        
+        self.rewrite_sheet(RECIPE_SHEET, RECIPE_COLUMNS, theirs_recipes)
+        self.recipes = theirs
+        return 1
+
+    def merge_units(self, theirs_units):
+        """Reprend les unités du fichier sur disque (comme les recettes, le fichier l'emporte)"""
+        theirs = UnitTable.build(theirs_units)
+        if theirs.units == self.units.units and theirs.factors == self.units.factors:
+            return 0
+        self.rewrite_sheet(UNIT_SHEET, UNIT_COLUMNS, theirs_units)
+        self.units = theirs
+        return 1
+
+    def merge_locations(self, theirs_rows):
+        """Reprend les emplacements et leurs minimums du fichier sur disque (comme les recettes, le fichier l'emporte)"""
+        if theirs_rows == self.locations.rows:
+            return 0
+        self.rewrite_sheet(LOCATION_SHEET, LOCATION_COLUMNS, theirs_rows)
+        self.locations = LocationStock.build(theirs_rows, self.receptions, self.consumption_history, self.transfers)
+        return 1
+
+    def merge_sla_rules(self, theirs_rules):
+        """Reprend les règles de délai du fichier sur disque (comme les recettes, le fichier l'emporte)"""
+        if theirs_rules == self.sla.rules:
+            return 0
+        self.rewrite_sheet(SLA_SHEET, SLA_COLUMNS, theirs_rules)
+        self.sla = SlaTracker.build(self.commandes, theirs_rules)
+        self.sla.tick(datetime.today().strftime('%Y-%m-%d'))
+        return 1
+
+    def rewrite_sheet(self, name, columns, items):
+        """Remplace les lignes d'une feuille de paramètres (recettes, délais, unités, emplacements), en-têtes compris si elle manque"""
+        if name not in self.wb.sheetnames:
+            sheet = self.wb.create_sheet(name)
+            for col, _, header in columns:
+                sheet.cell(row=1, column=col, value=header)
+        sheet = self.wb[name]
+        if sheet.max_row > 1:
+            sheet.delete_rows(2, sheet.max_row - 1)
+        for row, item in enumerate(items, start=2):
+            for col, key, _ in columns:
+                sheet.cell(row=row, column=col, value=item[key])
+
+    def merge_stock(self, base, theirs, sheet, prefix):
+        """Fusionne les stocks d'une feuille produits comme un journal de mouvements"""
+        initial = getattr(self, prefix + "stock_initial")
+        stocks = getattr(self, prefix + "stocks")
+        minimum = getattr(self, prefix + "stock_min")
+        
+        theirs_refs = theirs["colorants" if not prefix else "auxiliaires"]
+        theirs_names = theirs["colorant_names" if not prefix else "aux_names"]
+        theirs_initial = theirs[prefix + "stock_initial"]
+        theirs_stocks = theirs[prefix + "stocks"]
+        theirs_min = theirs[prefix + "stock_min"]
+        
+        updates = {}
+        for ref in theirs_refs:
+            if ref not in base:
+                if ref in initial:
+                    continue  # Créé des deux côtés: notre version est conservée
+                # Produit créé par l'autre poste: même ligne et mêmes formules qu'une création ici
+                self.insert_product((prefix, ref, theirs_names[ref], theirs_initial[ref], theirs_min[ref]))
+                updates[ref] = None
+                continue
+            
+            base_initial, base_stock = base[ref]
+            delta_initial = theirs_initial[ref] - base_initial
+            # Stock défini par une formule: recalculé après la fusion, pas de delta à reporter
+            delta_stock = theirs_stocks[ref] - base_stock if ref not in self.formula_stocks else 0.0
+            if (delta_initial or delta_stock) and ref in initial:
+                initial[ref] += delta_initial
+                stocks[ref] += delta_stock
+                updates[ref] = self.product_rows.get(ref)
+        
+        if not updates:
+            return 0
+        
+        for ref, row in updates.items():
+            if row is None:
+                continue
+            self.set_cell(sheet, row, 3, initial[ref])
+            self.set_derived(sheet, row, 6, stocks[ref])
+            self.set_derived(sheet, row, 8, "vrai" if stocks[ref] < minimum.get(ref, 0.0) else "faux")
+        self.resolve_formula_stocks(updates)
+        return len(updates)
+
+    def merge_commandes(self, base, theirs_commandes):
+        """Fusionne la liste des commandes avec celle du fichier sur disque.
+        
+        Les commandes sont rapprochées par leur identifiant permanent: deux
+        commandes de même référence, code et date d'entrée restent distinctes.
+        Une commande ajoutée par l'autre poste garde le sien; si nous l'avons
+        déjà attribué à une commande pas encore enregistrée, c'est la nôtre qui
+        est renumérotée. Une modification de l'autre poste l'emporte si nous
+        n'avons pas touché la commande. Les lignes sans identifiant (saisies
+        dans Excel) sont rapprochées par leurs valeurs des commandes connues
+        absentes du fichier, puis reçoivent un identifiant de notre séquence.
+        """
+        theirs = {}
+        anonymous = {}
+        for other in theirs_commandes:
+            if other['id'] is None or other['id'] in theirs:
+                anonymous.setdefault(commande_fields(other), []).append(other)
+            else:
+                theirs[other['id']] = other
+        
+        removed = set()
+        for cid, fields in base.items():
+            if cid in theirs:
+                continue
+            if anonymous.get(fields):
+                anonymous[fields].pop()  # Même commande, identifiant pas encore écrit dans le fichier
+            elif cid in self.commande_index:
+                removed.add(cid)
+        changed = [(self.commande_index[cid], other) for cid, other in theirs.items()
+                   if cid in base and cid in self.commande_index and commande_fields(other) != base[cid]
+                   and commande_fields(self.commande_index[cid]) == base[cid]]
+        added = [other for cid, other in theirs.items() if cid not in base]
+        added += [other for others in anonymous.values() for other in others]
+        changes = len(removed) + len(changed) + len(added)
+        
+        if not changes:
+            return 0
+        
+        # Lignes réécrites une à une: une commande retirée garde son identifiant dans sa ligne vidée
+        for cid in removed:
+            self.remove_commande(self.commande_index[cid])
+        for cmd, other in changed:
+            # Même objet: les actions enregistrées restent valides
+            self.update_commande(cmd, {key: other[key] for _, key in COMMANDE_COLUMNS if key != 'id'})
+        
+        # Notre séquence reprend après les identifiants du fichier
+        if theirs:
+            self.next_ids['commandes'] = max(self.next_ids['commandes'], max(theirs) + 1)
+        for other in added:
+            cid = other['id'] if other['id'] in theirs and theirs[other['id']] is other else None
+            if cid is not None and cid in self.commande_index:
+                # Même identifiant attribué ici à une commande pas encore enregistrée: la nôtre est renumérotée
+                mine = self.commande_index.pop(cid)
+                self.commande_order.remove(mine)
+                self.sla.untrack(cid)
+                mine['id'] = self.new_id('commandes')
+                self.commande_index[mine['id']] = mine
+                self.write_commande(mine)
+            self.insert_commande(dict(other, id=cid, row=self.sheet_commandes.max_row + 1))
+        
+        self.update_commandes_stats()
+        self.write_commandes_stats()
+        return changes
+
+    @PROFILER.timed("load_data")
     def load_data(self):
         """Charge les données depuis le fichier Excel"""
         try:
@@ -136,110 +4247,12 @@ class StockApp(tk.Tk):
                 messagebox.showerror("Erreur", f"Fichier Excel introuvable: {self.filename}")
                 return
             
-            self.wb = openpyxl.load_workbook(self.filename, data_only=True)
-            self.sheet_articles = self.wb['Liste des articles2']
-            self.sheet_consommation = self.wb['Consommation']
-            self.sheet_commandes = self.wb['commandes']
-            self.sheet_stats = self.wb['Groupe compta. Stock']
-            
-            # Récupère la liste des colorants
-            self.colorants = []
-            self.colorant_names = {}
-            self.stock_min = {}
-            self.stocks = {}
-            self.stock_initial = {}
-            
-            # Lire les valeurs de stock
-            for row in range(2, self.sheet_articles.max_row + 1):
-                ref = self.sheet_articles.cell(row=row, column=1).value
-                if ref:
-                    ref = str(ref)
-                    self.colorants.append(ref)
-                    
-                    # Nom du colorant
-                    name = self.sheet_articles.cell(row=row, column=2).value
-                    self.colorant_names[ref] = name if name else ref
-                    
-                    # Stock minimum
-                    min_val = self.sheet_articles.cell(row=row, column=4).value
-                    try:
-                        min_val = float(min_val) if min_val is not None else 0.0
-                    except (TypeError, ValueError):
-                        min_val = 0.0
-                    self.stock_min[ref] = min_val
-                    
-                    # Stock initial
-                    init_val = self.sheet_articles.cell(row=row, column=3).value
-                    try:
-                        init_val = float(init_val) if init_val is not None else 0.0
-                    except (TypeError, ValueError):
-                        init_val = 0.0
-                    self.stock_initial[ref] = init_val
-                    
-                    # Stock réel
-                    stock_val = self.sheet_articles.cell(row=row, column=6).value
-                    try:
-                        stock_val = float(stock_val) if stock_val is not None else 0.0
-                    except (TypeError, ValueError):
-                        stock_val = 0.0
-                    self.stocks[ref] = stock_val
-            
-            # Charger l'historique des consommations
-            self.consumption_history = []
-            for row in range(2, self.sheet_consommation.max_row + 1):
-                ref = self.sheet_consommation.cell(row=row, column=1).value
-                date_val = self.sheet_consommation.cell(row=row, column=2).value
-                qty = self.sheet_consommation.cell(row=row, column=3).value
-                
-                if ref and date_val and qty:
-                    try:
-                        if isinstance(date_val, datetime):
-                            date_str = date_val.strftime('%Y-%m-%d')
-                        else:
-                            date_str = str(date_val)
-                        
-                        self.consumption_history.append({
-                            'ref': str(ref),
-                            'date': date_str,
-                            'qty': float(qty),
-                            'id': row  # Stocker l'ID de ligne pour les modifications
-                        })
-                    except:
-                        continue
-            
-            # Charger les commandes
-            self.commandes = []
-            for row in range(2, self.sheet_commandes.max_row + 1):
-                cmd_ref = self.sheet_commandes.cell(row=row, column=1).value
-                if cmd_ref:
-                    commande = {
-                        'ref': cmd_ref,
-                        'code': self.sheet_commandes.cell(row=row, column=2).value,
-                        'date_entree': self.sheet_commandes.cell(row=row, column=3).value,
-                        'date_sortie': self.sheet_commandes.cell(row=row, column=4).value,
-                        'delai': self.sheet_commandes.cell(row=row, column=5).value,
-                        'statut': self.sheet_commandes.cell(row=row, column=7).value,
-                        'observation': self.sheet_commandes.cell(row=row, column=8).value,
-                        'id': row  # Stocker l'ID de ligne pour les modifications
-                    }
-                    self.commandes.append(commande)
-            
-            # Charger les statistiques de commandes
-            self.total_commandes = self.get_cell_value('Groupe compta. Stock', 'B16')  # N total de commandes
-            self.commandes_traitees = self.get_cell_value('Groupe compta. Stock', 'B10')  # N° total de cmd traitée
-            self.taux_commandes = self.get_cell_value('Groupe compta. Stock', 'B13')  # taux des commandes
+            for stage, data in iter_workbook_stages(self.filename):
+                self.apply_load_stage(stage, data)
             
         except Exception as e:
             messagebox.showerror("Erreur", f"Impossible de charger le fichier Excel:\n{str(e)}")
-            self.colorants = []
-            self.stock_min = {}
-            self.stocks = {}
-            self.stock_initial = {}
-            self.consumption_history = []
-            self.commandes = []
-            self.total_commandes = 0
-            self.commandes_traitees = 0
-            self.taux_commandes = 0.0
+            self.reset_data()
     
     def get_cell_value(self, sheet_name, cell_ref):
         """Récupère la valeur d'une cellule par référence"""
@@ -251,8 +4264,7 @@ class StockApp(tk.Tk):
 
     def create_consumption_tab(self):
         """Crée l'onglet de consommation"""
-        tab = ttk.Frame(self.notebook)
-        self.notebook.add(tab, text="📊 Consommation")
+        tab = self.tabs["consommation"]
         
         # Frame principale avec padding
         main_frame = ttk.Frame(tab, padding=15)
@@ -280,9 +4292,14 @@ class StockApp(tk.Tk):
         self.combo_ref.bind("<<ComboboxSelected>>", lambda e: self.update_stock_display())
         
         # Consommation
-        ttk.Label(form_frame, text="Consommation (kg):", font=("Segoe UI", 10)).grid(row=2, column=0, sticky="e", padx=5, pady=5)
-        self.entry_consommation = ttk.Entry(form_frame, width=15)
-        self.entry_consommation.grid(row=2, column=1, sticky="w", padx=5, pady=5)
+        ttk.Label(form_frame, text="Consommation:", font=("Segoe UI", 10)).grid(row=2, column=0, sticky="e", padx=5, pady=5)
+        qty_frame = ttk.Frame(form_frame)
+        qty_frame.grid(row=2, column=1, sticky="w", padx=5, pady=5)
+        self.entry_consommation = ttk.Entry(qty_frame, width=15)
+        self.entry_consommation.pack(side=tk.LEFT)
+        self.combo_unit = ttk.Combobox(qty_frame, values=[BASE_UNIT], state="readonly", width=6)
+        self.combo_unit.set(BASE_UNIT)
+        self.combo_unit.pack(side=tk.LEFT, padx=(5, 0))
         
         # Date
         ttk.Label(form_frame, text="Date:", font=("Segoe UI", 10)).grid(row=3, column=0, sticky="e", padx=5, pady=5)
@@ -290,10 +4307,17 @@ class StockApp(tk.Tk):
         self.entry_date.insert(0, datetime.today().strftime('%Y-%m-%d'))
         self.entry_date.grid(row=3, column=1, sticky="w", padx=5, pady=5)
         
+        # Emplacement où le produit est prélevé
+        ttk.Label(form_frame, text="Emplacement:", font=("Segoe UI", 10)).grid(row=4, column=0, sticky="e", padx=5, pady=5)
+        self.combo_location = ttk.Combobox(form_frame, values=[DEFAULT_LOCATION], state="readonly", width=30)
+        self.combo_location.set(DEFAULT_LOCATION)
+        self.combo_location.grid(row=4, column=1, sticky="w", padx=5, pady=5)
+        self.combo_location.bind("<<ComboboxSelected>>", lambda e: self.update_stock_display())
+        
         # Stock réel
-        ttk.Label(form_frame, text="Stock Réel Actuel:", font=("Segoe UI", 10)).grid(row=4, column=0, sticky="e", padx=5, pady=5)
+        ttk.Label(form_frame, text="Stock Réel Actuel:", font=("Segoe UI", 10)).grid(row=5, column=0, sticky="e", padx=5, pady=5)
         self.label_stock = ttk.Label(form_frame, text="0.0 kg", font=("Segoe UI", 10, "bold"), foreground="#1a73e8")
-        self.label_stock.grid(row=4, column=1, sticky="w", padx=5, pady=5)
+        self.label_stock.grid(row=5, column=1, sticky="w", padx=5, pady=5)
         
         # Bouton d'enregistrement
         btn_frame = ttk.Frame(group, padding=10)
@@ -302,6 +4326,27 @@ class StockApp(tk.Tk):
                                   command=self.save_consumption, style="Accent.TButton")
         self.btn_save.pack(pady=5)
         
+        # Consommation d'une recette complète pour un poids de lot
+        recipe_group = ttk.LabelFrame(main_frame, text="🧪 Consommation par recette")
+        recipe_group.pack(fill=tk.X, pady=(0, 15))
+        recipe_frame = ttk.Frame(recipe_group, padding=10)
+        recipe_frame.pack(fill=tk.X)
+        
+        ttk.Label(recipe_frame, text="Code couleur:", font=("Segoe UI", 10)).grid(row=0, column=0, sticky="e", padx=5, pady=5)
+        self.combo_recipe = ttk.Combobox(recipe_frame, state="readonly", width=20)
+        self.combo_recipe.grid(row=0, column=1, sticky="w", padx=5, pady=5)
+        self.combo_recipe.bind("<<ComboboxSelected>>", lambda e: self.update_recipe_display())
+        
+        ttk.Label(recipe_frame, text="Poids du lot (kg):", font=("Segoe UI", 10)).grid(row=0, column=2, sticky="e", padx=5, pady=5)
+        self.entry_batch_weight = ttk.Entry(recipe_frame, width=12)
+        self.entry_batch_weight.grid(row=0, column=3, sticky="w", padx=5, pady=5)
+        
+        ttk.Button(recipe_frame, text="🧪 Consommer la recette",
+                   command=self.save_recipe_consumption).grid(row=0, column=4, padx=10, pady=5)
+        
+        self.label_recipe = ttk.Label(recipe_frame, text="", foreground="#555555")
+        self.label_recipe.grid(row=1, column=0, columnspan=5, sticky="w", padx=5)
+        
         # Historique des consommations
         history_group = ttk.LabelFrame(main_frame, text="🕒 Historique des Consommations")
         history_group.pack(fill=tk.BOTH, expand=True, pady=(15, 0))
@@ -313,6 +4358,8 @@ class StockApp(tk.Tk):
         ttk.Button(toolbar_frame, text="🔄 Actualiser", command=self.update_history_tree).pack(side=tk.LEFT, padx=2)
         ttk.Button(toolbar_frame, text="✏️ Modifier", command=self.edit_consumption).pack(side=tk.LEFT, padx=2)
         ttk.Button(toolbar_frame, text="🗑️ Supprimer", command=self.delete_consumption).pack(side=tk.LEFT, padx=2)
+        ttk.Button(toolbar_frame, text="🔍 Anomalies", command=self.scan_history_anomalies).pack(side=tk.LEFT, padx=2)
+        ttk.Button(toolbar_frame, text="📜 Journal", command=self.show_audit_log).pack(side=tk.LEFT, padx=2)
         
         # Tableau d'historique
         columns = ("date", "ref", "name", "qty", "type", "id")
@@ -322,7 +4369,7 @@ class StockApp(tk.Tk):
         self.history_tree.heading("date", text="Date")
         self.history_tree.heading("ref", text="Référence")
         self.history_tree.heading("name", text="Nom")
-        self.history_tree.heading("qty", text="Quantité (kg)")
+        self.history_tree.heading("qty", text="Quantité")
         self.history_tree.heading("type", text="Type")
         self.history_tree.heading("id", text="ID")
         
@@ -343,10 +4390,33 @@ class StockApp(tk.Tk):
         # Placement des éléments
         self.history_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        self.update_history_tree()
+
+    def refresh_consumption_tab(self):
+        """Rafraîchit l'onglet consommation en conservant la référence sélectionnée"""
+        ref = self.combo_ref.get()
         self.update_product_list()
+        if ref and ref in self.combo_ref['values']:
+            self.combo_ref.set(ref)
+            self.update_stock_display()
+        self.update_recipe_list()
+        self.update_history_tree()
 
+    def update_recipe_list(self):
+        """Met à jour la liste des codes couleur ayant une recette"""
+        codes = self.recipes.code_names()
+        self.combo_recipe['values'] = codes
+        if self.combo_recipe.get() not in codes:
+            self.combo_recipe.set(codes[0] if codes else "")
+        self.update_recipe_display()
+
+    def update_recipe_display(self):
+        """Affiche les composants de la recette sélectionnée"""
+        code = self.combo_recipe.get()
+        components = self.recipes.components(code) if code else []
+        self.label_recipe.config(text=", ".join(f"{ref} {dose:g} %" for ref, dose in components)
+                                 or "Aucune recette (feuille « Recettes » du classeur)")
+
+    @PROFILER.timed("update_product_list")
     def update_product_list(self, event=None):
         """Met à jour la liste des produits selon le type sélectionné"""
         product_type = self.product_type.get()
@@ -356,26 +4426,15 @@ class StockApp(tk.Tk):
             if self.colorants:
                 self.combo_ref.current(0)
         elif product_type == "Produit auxiliaire":
-            # Charger les produits auxiliaires
-            try:
-                sheet = self.wb["Produits auxiliaires"]
-                products = []
-                for row in range(2, sheet.max_row + 1):
-                    ref = sheet.cell(row=row, column=1).value
-                    if ref:
-                        products.append(str(ref))
-                self.combo_ref['values'] = products
-                if products:
-                    self.combo_ref.current(0)
-            except:
-                self.combo_ref['values'] = []
+            self.combo_ref['values'] = self.auxiliaires
+            if self.auxiliaires:
+                self.combo_ref.current(0)
         
         self.update_stock_display()
 
     def create_stock_tab(self):
         """Crée l'onglet de gestion de stock"""
-        tab = ttk.Frame(self.notebook)
-        self.notebook.add(tab, text="📦 Gestion Stock")
+        tab = self.tabs["stock"]
         
         # Frame principale avec padding
         main_frame = ttk.Frame(tab, padding=15)
@@ -423,6 +4482,34 @@ class StockApp(tk.Tk):
                                          command=self.update_initial_stock, style="Accent.TButton")
         self.btn_update_stock.pack(pady=5)
         
+        # Réception de marchandises: bon de plusieurs lignes, avec lots
+        ttk.Button(btn_frame, text="📥 Réception de Marchandises",
+                   command=self.reception_marchandises).pack(pady=5)
+        
+        # Lots en stock du produit sélectionné
+        self.label_lots = ttk.Label(left_frame, text="", font=("Segoe UI", 9), padding=10,
+                                    wraplength=450, justify=tk.LEFT)
+        self.label_lots.pack(fill=tk.X)
+        
+        # Stock du produit sélectionné par emplacement, et transfert entre emplacements
+        self.label_locations = ttk.Label(left_frame, text="", font=("Segoe UI", 9), padding=(10, 0),
+                                         wraplength=450, justify=tk.LEFT)
+        self.label_locations.pack(fill=tk.X)
+        transfer_frame = ttk.LabelFrame(left_frame, text="🔀 Transfert entre Emplacements", padding=10)
+        transfer_frame.pack(fill=tk.X, padx=10, pady=5)
+        ttk.Label(transfer_frame, text="De:").grid(row=0, column=0, sticky="e", padx=5, pady=2)
+        self.combo_transfer_from = ttk.Combobox(transfer_frame, values=[DEFAULT_LOCATION], width=22)
+        self.combo_transfer_from.set(DEFAULT_LOCATION)
+        self.combo_transfer_from.grid(row=0, column=1, sticky="w", padx=5, pady=2)
+        ttk.Label(transfer_frame, text="Vers:").grid(row=1, column=0, sticky="e", padx=5, pady=2)
+        self.combo_transfer_to = ttk.Combobox(transfer_frame, values=[DEFAULT_LOCATION], width=22)
+        self.combo_transfer_to.grid(row=1, column=1, sticky="w", padx=5, pady=2)
+        ttk.Label(transfer_frame, text="Quantité:").grid(row=2, column=0, sticky="e", padx=5, pady=2)
+        self.entry_transfer_qty = ttk.Entry(transfer_frame, width=12)
+        self.entry_transfer_qty.grid(row=2, column=1, sticky="w", padx=5, pady=2)
+        ttk.Button(transfer_frame, text="🔀 Transférer",
+                   command=self.transfer_stock).grid(row=0, column=2, rowspan=3, padx=10)
+        
         # Colonne droite - Ajout de nouveau produit
         right_frame = ttk.LabelFrame(dual_frame, text="➕ Ajouter un Nouveau Produit")
         right_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=(10, 0), pady=5)
@@ -462,9 +4549,16 @@ class StockApp(tk.Tk):
         self.btn_add_colorant = ttk.Button(btn_frame, text="➕ Ajouter Nouveau Produit", 
                                          command=self.add_new_product, style="Accent.TButton")
         self.btn_add_colorant.pack(pady=5)
-        
+
+    def refresh_stock_tab(self):
+        """Rafraîchit l'onglet gestion de stock en conservant la référence sélectionnée"""
+        ref = self.combo_stock_ref.get()
         self.update_stock_product_list()
+        if ref and ref in self.combo_stock_ref['values']:
+            self.combo_stock_ref.set(ref)
+            self.update_stock_info()
 
+    @PROFILER.timed("update_stock_product_list")
     def update_stock_product_list(self, event=None):
         """Met à jour la liste des produits pour la gestion de stock"""
         product_type = self.stock_product_type.get()
@@ -474,26 +4568,15 @@ class StockApp(tk.Tk):
             if self.colorants:
                 self.combo_stock_ref.current(0)
         elif product_type == "Produit auxiliaire":
-            # Charger les produits auxiliaires
-            try:
-                sheet = self.wb["Produits auxiliaires"]
-                products = []
-                for row in range(2, sheet.max_row + 1):
-                    ref = sheet.cell(row=row, column=1).value
-                    if ref:
-                        products.append(str(ref))
-                self.combo_stock_ref['values'] = products
-                if products:
-                    self.combo_stock_ref.current(0)
-            except:
-                self.combo_stock_ref['values'] = []
+            self.combo_stock_ref['values'] = self.auxiliaires
+            if self.auxiliaires:
+                self.combo_stock_ref.current(0)
         
         self.update_stock_info()
 
     def create_commandes_tab(self):
         """Crée l'onglet de gestion des commandes"""
-        tab = ttk.Frame(self.notebook)
-        self.notebook.add(tab, text="Commandes")
+        tab = self.tabs["commandes"]
         
         # Frame principale
         main_frame = ttk.Frame(tab)
@@ -524,20 +4607,51 @@ class StockApp(tk.Tk):
         ttk.Button(btn_frame, text="Marquer comme Traitée", command=self.marquer_traitee).pack(side=tk.LEFT, padx=5)
         ttk.Button(btn_frame, text="Supprimer", command=self.supprimer_commande).pack(side=tk.LEFT, padx=5)
         
-        # Liste des commandes
+        # Filtres: statut et période d'entrée
+        filter_frame = ttk.Frame(main_frame)
+        filter_frame.pack(fill=tk.X, pady=(0, 10))
+        
+        ttk.Label(filter_frame, text="Statut:").pack(side=tk.LEFT, padx=5)
+        self.commandes_status_filter = ttk.Combobox(filter_frame, values=COMMANDE_STATUS_FILTERS, state="readonly", width=12)
+        self.commandes_status_filter.current(0)
+        self.commandes_status_filter.pack(side=tk.LEFT, padx=5)
+        self.commandes_status_filter.bind("<<ComboboxSelected>>", lambda e: self.apply_commandes_filter())
+        
+        ttk.Label(filter_frame, text="Entrée du:").pack(side=tk.LEFT, padx=5)
+        self.entry_commandes_from = ttk.Entry(filter_frame, width=12)
+        self.entry_commandes_from.pack(side=tk.LEFT, padx=5)
+        ttk.Label(filter_frame, text="au:").pack(side=tk.LEFT, padx=5)
+        self.entry_commandes_to = ttk.Entry(filter_frame, width=12)
+        self.entry_commandes_to.pack(side=tk.LEFT, padx=5)
+        for entry in (self.entry_commandes_from, self.entry_commandes_to):
+            entry.bind("<Return>", lambda e: self.apply_commandes_filter())
+        
+        ttk.Button(filter_frame, text="Filtrer", command=self.apply_commandes_filter).pack(side=tk.LEFT, padx=5)
+        ttk.Button(filter_frame, text="Réinitialiser", command=self.reset_commandes_filter).pack(side=tk.LEFT, padx=5)
+        self.commandes_count_var = tk.StringVar(value="")
+        ttk.Label(filter_frame, textvariable=self.commandes_count_var).pack(side=tk.RIGHT, padx=5)
+        
+        # Liste des commandes: seules les lignes visibles existent dans l'arbre
+        self.commandes_sort = (None, False)
+        self.commandes_filter = ("Tous", "", "")
+        self.commandes_visible = []
+        self.commandes_view_key = None
+        self.commandes_offset = 0
+        self.commandes_rows = COMMANDES_WINDOW
+        
         commandes_frame = ttk.LabelFrame(main_frame, text="Liste des Commandes")
         commandes_frame.pack(fill=tk.BOTH, expand=True)
         
-        columns = ("ref", "code", "date_entree", "date_sortie", "delai", "statut")
-        self.commandes_tree = ttk.Treeview(commandes_frame, columns=columns, show="headings")
+        columns = COMMANDE_SORT_COLUMNS
+        self.commandes_tree = ttk.Treeview(commandes_frame, columns=columns, show="headings", height=COMMANDES_WINDOW)
         
-        # Configuration des colonnes
-        self.commandes_tree.heading("ref", text="Référence")
-        self.commandes_tree.heading("code", text="Code Couleur")
-        self.commandes_tree.heading("date_entree", text="Date Entrée")
-        self.commandes_tree.heading("date_sortie", text="Date Sortie")
-        self.commandes_tree.heading("delai", text="Délai (jours)")
-        self.commandes_tree.heading("statut", text="Statut")
+        # Configuration des colonnes (un clic sur l'en-tête trie la liste)
+        self.commandes_headings = {
+            "ref": "Référence", "code": "Code Couleur", "date_entree": "Date Entrée",
+            "date_sortie": "Date Sortie", "delai": "Délai (jours)", "statut": "Statut",
+        }
+        for column, text in self.commandes_headings.items():
+            self.commandes_tree.heading(column, text=text, command=lambda c=column: self.sort_commandes(c))
         
         self.commandes_tree.column("ref", width=100, anchor="center")
         self.commandes_tree.column("code", width=150, anchor="w")
@@ -546,21 +4660,20 @@ class StockApp(tk.Tk):
         self.commandes_tree.column("delai", width=100, anchor="center")
         self.commandes_tree.column("statut", width=100, anchor="center")
         
-        # Scrollbar
-        scrollbar = ttk.Scrollbar(commandes_frame, orient="vertical", command=self.commandes_tree.yview)
-        self.commandes_tree.configure(yscrollcommand=scrollbar.set)
+        # Scrollbar: elle parcourt la liste filtrée entière, l'arbre n'en montre qu'une fenêtre
+        self.commandes_scrollbar = ttk.Scrollbar(commandes_frame, orient="vertical", command=self.scroll_commandes)
+        self.commandes_tree.bind("<MouseWheel>", lambda e: self.scroll_commandes("scroll", -3 if e.delta > 0 else 3, "units") or "break")
+        self.commandes_tree.bind("<Button-4>", lambda e: self.scroll_commandes("scroll", -3, "units") or "break")
+        self.commandes_tree.bind("<Button-5>", lambda e: self.scroll_commandes("scroll", 3, "units") or "break")
+        self.commandes_tree.bind("<Configure>", self.resize_commandes_window)
         
         # Placement des éléments
         self.commandes_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        # Mettre à jour l'affichage
-        self.update_commandes_display()
+        self.commandes_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
     def create_alerts_tab(self):
         """Crée l'onglet d'alertes"""
-        tab = ttk.Frame(self.notebook)
-        self.notebook.add(tab, text="Alertes Stock")
+        tab = self.tabs["alertes"]
         
         # Frame principale
         main_frame = ttk.Frame(tab)
@@ -579,11 +4692,19 @@ class StockApp(tk.Tk):
         btn_frame.pack(fill=tk.X, padx=10, pady=10)
         btn_refresh = ttk.Button(btn_frame, text="Actualiser les Alertes", command=self.check_stock_alerts)
         btn_refresh.pack(pady=5)
+        
+        # Groupe: commandes en attente au-delà de leur délai maximal
+        sla_group = ttk.LabelFrame(main_frame, text="Commandes en Retard - Délai de Traitement Dépassé")
+        sla_group.pack(fill=tk.BOTH, expand=True, pady=(10, 0))
+        
+        self.sla_summary_var = tk.StringVar(value="")
+        ttk.Label(sla_group, textvariable=self.sla_summary_var).pack(anchor="w", padx=10, pady=(10, 0))
+        self.sla_list = tk.Listbox(sla_group, font=("Arial", 10), bg="#ffffff", selectbackground="#e0e0e0")
+        self.sla_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
     def create_report_tab(self):
         """Crée l'onglet de rapports"""
-        tab = ttk.Frame(self.notebook)
-        self.notebook.add(tab, text="Rapports")
+        tab = self.tabs["rapports"]
         
         # Frame principale
         main_frame = ttk.Frame(tab)
@@ -593,8 +4714,12 @@ class StockApp(tk.Tk):
         report_group = ttk.LabelFrame(main_frame, text="Rapport Complet des Stocks")
         report_group.pack(fill=tk.BOTH, expand=True)
         
+        # Valeur totale du stock
+        self.stock_value_var = tk.StringVar()
+        ttk.Label(report_group, textvariable=self.stock_value_var, font=("Segoe UI", 10, "bold")).pack(anchor="w", padx=10, pady=(5, 0))
+        
         # Tableau de rapport
-        columns = ("ref", "name", "stock_init", "stock_reel", "stock_min", "status", "type")
+        columns = ("ref", "name", "stock_init", "stock_reel", "stock_min", "status", "type", "classe", "cmp", "valeur")
         self.report_tree = ttk.Treeview(report_group, columns=columns, show="headings")
         
         # Configuration des colonnes
@@ -605,6 +4730,9 @@ class StockApp(tk.Tk):
         self.report_tree.heading("stock_min", text="Stock Minimal")
         self.report_tree.heading("status", text="Statut")
         self.report_tree.heading("type", text="Type")
+        self.report_tree.heading("classe", text="Classe ABC/XYZ")
+        self.report_tree.heading("cmp", text="Coût Moyen (/kg)")
+        self.report_tree.heading("valeur", text="Valeur du Stock")
         
         self.report_tree.column("ref", width=120, anchor="center")
         self.report_tree.column("name", width=200, anchor="w")
@@ -613,6 +4741,9 @@ class StockApp(tk.Tk):
         self.report_tree.column("stock_min", width=100, anchor="e")
         self.report_tree.column("status", width=100, anchor="center")
         self.report_tree.column("type", width=120, anchor="center")
+        self.report_tree.column("classe", width=100, anchor="center")
+        self.report_tree.column("cmp", width=110, anchor="e")
+        self.report_tree.column("valeur", width=110, anchor="e")
         
         # Scrollbar
         scrollbar = ttk.Scrollbar(report_group, orient="vertical", command=self.report_tree.yview)
@@ -627,102 +4758,155 @@ class StockApp(tk.Tk):
         btn_frame.pack(fill=tk.X, padx=10, pady=10)
         btn_export = ttk.Button(btn_frame, text="Exporter vers Excel", command=self.export_to_excel)
         btn_export.pack(pady=5)
+        
+        # Groupe: coût des consommations (au coût moyen pondéré)
+        cost_group = ttk.LabelFrame(main_frame, text="Coût des Consommations")
+        cost_group.pack(fill=tk.X, pady=(10, 0))
+        
+        self.period_cost_tree = ttk.Treeview(cost_group, columns=("mois", "cout"), show="headings", height=6)
+        self.period_cost_tree.heading("mois", text="Mois")
+        self.period_cost_tree.heading("cout", text="Coût")
+        self.period_cost_tree.column("mois", width=100, anchor="center")
+        self.period_cost_tree.column("cout", width=120, anchor="e")
+        self.period_cost_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        self.commande_cost_tree = ttk.Treeview(cost_group, columns=("commande", "cout"), show="headings", height=6)
+        self.commande_cost_tree.heading("commande", text="Commande")
+        self.commande_cost_tree.heading("cout", text="Coût")
+        self.commande_cost_tree.column("commande", width=140, anchor="center")
+        self.commande_cost_tree.column("cout", width=120, anchor="e")
+        self.commande_cost_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
 
+    @PROFILER.timed("update_stock_display")
     def update_stock_display(self):
         """Met à jour l'affichage du stock réel"""
         product_type = self.product_type.get()
         ref = self.combo_ref.get()
         
+        if list(self.combo_location['values']) != self.locations.names:
+            self.combo_location['values'] = self.locations.names
+            if self.combo_location.get() not in self.locations.names:
+                self.combo_location.set(DEFAULT_LOCATION)
+        
         if product_type == "Colorant" and ref:
-            self.label_stock.config(text=f"{self.stocks.get(ref, 0.0):.2f} kg")
+            self.label_stock.config(text=self.location_stock_text(ref, self.stocks.get(ref, 0.0)))
         elif product_type == "Produit auxiliaire" and ref:
-            # Récupérer le stock du produit auxiliaire
-            try:
-                sheet = self.wb["Produits auxiliaires"]
-                for row in range(2, sheet.max_row + 1):
-                    if str(sheet.cell(row=row, column=1).value) == ref:
-                        stock_val = sheet.cell(row=row, column=6).value
-                        try:
-                            stock_val = float(stock_val) if stock_val is not None else 0.0
-                        except:
-                            stock_val = 0.0
-                        self.label_stock.config(text=f"{stock_val:.2f} kg")
-                        break
-            except:
-                self.label_stock.config(text="0.0 kg")
+            self.label_stock.config(text=self.location_stock_text(ref, self.aux_stocks.get(ref, 0.0)))
+        
+        # Unités de saisie du produit, la sienne par défaut
+        if ref:
+            units = self.units.units_for(ref)
+            if self.combo_unit.get() not in units or list(self.combo_unit['values']) != units:
+                self.combo_unit['values'] = units
+                self.combo_unit.set(self.units.unit_of(ref))
+
+    def location_stock_text(self, ref, total):
+        """Stock du produit à l'emplacement choisi, suivi du total s'il y a plusieurs emplacements"""
+        if len(self.locations.names) == 1:
+            return self.units.format(ref, total)
+        location = self.combo_location.get()
+        return (f"{self.units.format(ref, self.locations.quantity(ref, location, total))} "
+                f"(total: {self.units.format(ref, total)})")
 
+    @PROFILER.timed("update_stock_info")
     def update_stock_info(self):
         """Met à jour l'affichage du stock dans l'onglet gestion de stock"""
         product_type = self.stock_product_type.get()
         ref = self.combo_stock_ref.get()
         
         if product_type == "Colorant" and ref:
-            self.label_current_stock.config(text=f"{self.stock_initial.get(ref, 0.0):.2f} kg")
+            self.label_current_stock.config(text=self.units.format(ref, self.stock_initial.get(ref, 0.0)))
             self.entry_new_stock.delete(0, tk.END)
-            self.entry_new_stock.insert(0, str(self.stock_initial.get(ref, 0.0)))
+            self.entry_new_stock.insert(0, f"{self.units.from_base(ref, self.stock_initial.get(ref, 0.0)):g}")
         elif product_type == "Produit auxiliaire" and ref:
-            # Récupérer le stock initial du produit auxiliaire
-            try:
-                sheet = self.wb["Produits auxiliaires"]
-                for row in range(2, sheet.max_row + 1):
-                    if str(sheet.cell(row=row, column=1).value) == ref:
-                        stock_val = sheet.cell(row=row, column=3).value
-                        try:
-                            stock_val = float(stock_val) if stock_val is not None else 0.0
-                        except:
-                            stock_val = 0.0
-                        self.label_current_stock.config(text=f"{stock_val:.2f} kg")
-                        self.entry_new_stock.delete(0, tk.END)
-                        self.entry_new_stock.insert(0, str(stock_val))
-                        break
-            except:
-                self.label_current_stock.config(text="0.0 kg")
+            self.label_current_stock.config(text=self.units.format(ref, self.aux_stock_initial.get(ref, 0.0)))
+            self.entry_new_stock.delete(0, tk.END)
+            self.entry_new_stock.insert(0, f"{self.units.from_base(ref, self.aux_stock_initial.get(ref, 0.0)):g}")
+        
+        # Lots en stock, dans l'ordre de sortie
+        lots = self.lots.available(ref)
+        if lots:
+            text = f"Lots en stock ({self.lots.policy}): " + ", ".join(
+                f"{lot['lot'] or 'sans n°'} {self.units.format(ref, lot['reste'])}" + (f" (pér. {lot['peremption']})" if lot['peremption'] else "")
+                for lot in lots[:8])
+            if len(lots) > 8:
+                text += f", ... ({len(lots) - 8} autres)"
+        else:
+            text = ""
+        self.label_lots.config(text=text)
+        
+        # Emplacements: les nouveaux noms peuvent être saisis dans les listes de transfert
+        for combo in (self.combo_transfer_from, self.combo_transfer_to):
+            combo['values'] = self.locations.names
+        total = self.stock_of(ref) if ref else None
+        if total is None or len(self.locations.names) == 1:
+            self.label_locations.config(text="")
+        else:
+            self.label_locations.config(text="Par emplacement: " + ", ".join(
+                f"{location} {self.units.format(ref, qty)}" for location, qty in self.locations.breakdown(ref, total)))
 
-    def update_history_tree(self):
-        """Met à jour l'arbre d'historique des consommations"""
+    @PROFILER.timed("update_history_tree")
+    def update_history_tree(self, items=None):
+        """Met à jour l'arbre d'historique des consommations (par défaut les 20 plus récentes)"""
         # Effacer les anciennes entrées
         for item in self.history_tree.get_children():
             self.history_tree.delete(item)
         
         # Trier par date récente
-        recent_history = sorted(self.consumption_history, 
-                               key=lambda x: x['date'], 
-                               reverse=True)[:20]
+        recent_history = items if items is not None else sorted(self.consumption_history, 
+                                                                key=lambda x: x['date'], 
+                                                                reverse=True)[:20]
         
         # Ajouter les nouvelles entrées
         for item in recent_history:
             ref = item['ref']
             # Déterminer le type de produit
-            product_type = "Colorant" if ref in self.colorants else "Produit auxiliaire"
+            product_type = "Colorant" if ref in self.colorant_names else "Produit auxiliaire"
             
             # Trouver le nom du produit
             if product_type == "Colorant":
                 name = self.colorant_names.get(ref, ref)
             else:
-                name = ref  # Pour les produits auxiliaires, on utilise la référence comme nom par défaut
-                try:
-                    sheet = self.wb["Produits auxiliaires"]
-                    for row in range(2, sheet.max_row + 1):
-                        if str(sheet.cell(row=row, column=1).value) == ref:
-                            name = sheet.cell(row=row, column=2).value or ref
-                            break
-                except:
-                    pass
+                name = self.aux_names.get(ref, ref)
             
             self.history_tree.insert("", "end", values=(
                 item['date'], 
                 ref, 
                 name, 
-                f"{item['qty']:.2f}",
+                self.units.format(ref, item['qty']),
                 product_type,
                 item['id']
-            ))
+            ), tags=("anomaly",) if items is not None else ())
+        self.history_tree.tag_configure("anomaly", background="#fff9c4")
+
+    def scan_history_anomalies(self):
+        """Recherche en arrière-plan les consommations anormales de tout l'historique et les affiche"""
+        rows = [(item['id'], item['ref'], item['qty']) for item in self.consumption_history]
+        
+        def on_done(future):
+            error = future.exception()
+            if error is not None:
+                messagebox.showerror("Erreur", f"Erreur lors de la recherche d'anomalies:\n{str(error)}")
+                self.status_var.set("Échec de la recherche d'anomalies")
+                return
+            found = future.result()
+            items = [self.consumption_index[cid] for _, cid, _ in found if cid in self.consumption_index]
+            self.update_history_tree(items[:ANOMALY_DISPLAY_LIMIT])
+            self.status_var.set(f"{len(items)} consommation(s) inhabituelle(s) sur {len(rows)}, "
+                                f"{min(len(items), ANOMALY_DISPLAY_LIMIT)} affichée(s) "
+                                f"(« Actualiser » pour revenir aux plus récentes)")
+        
+        self.run_background_task("Recherche d'anomalies", lambda progress: scan_anomalies(rows), on_done)
 
+    @PROFILER.timed("update_report_table")
     def update_report_table(self):
         """Met à jour le tableau de rapport de stock"""
         # Effacer les anciennes entrées
         for item in self.report_tree.get_children():
             self.report_tree.delete(item)
+        classes = self.refresh_classes()
+        valuation = self.valuation
+        units = self.units
         
         # Ajouter les colorants
         for ref in self.colorants:
@@ -736,11 +4920,14 @@ class StockApp(tk.Tk):
             self.report_tree.insert("", "end", values=(
                 ref, 
                 name, 
-                f"{stock_init:.2f}", 
-                f"{stock_reel:.2f}", 
-                f"{stock_min:.2f}", 
+                units.format(ref, stock_init), 
+                units.format(ref, stock_reel), 
+                units.format(ref, stock_min), 
                 status,
-                "Colorant"
+                "Colorant",
+                classes.get(ref),
+                f"{valuation.unit_cost(ref):.2f}",
+                f"{valuation.value(ref, stock_reel):.2f}"
             ))
             
             # Colorer les lignes critiques
@@ -748,54 +4935,56 @@ class StockApp(tk.Tk):
                 self.report_tree.item(self.report_tree.get_children()[-1], tags=("critical",))
         
         # Ajouter les produits auxiliaires
-        try:
-            sheet = self.wb["Produits auxiliaires"]
-            for row in range(2, sheet.max_row + 1):
-                ref = sheet.cell(row=row, column=1).value
-                if ref:
-                    ref = str(ref)
-                    name = sheet.cell(row=row, column=2).value or ref
-                    
-                    try:
-                        stock_init = float(sheet.cell(row=row, column=3).value) if sheet.cell(row=row, column=3).value is not None else 0.0
-                    except:
-                        stock_init = 0.0
-                    
-                    try:
-                        stock_reel = float(sheet.cell(row=row, column=6).value) if sheet.cell(row=row, column=6).value is not None else 0.0
-                    except:
-                        stock_reel = 0.0
-                    
-                    try:
-                        stock_min = float(sheet.cell(row=row, column=4).value) if sheet.cell(row=row, column=4).value is not None else 0.0
-                    except:
-                        stock_min = 0.0
-                    
-                    status = "CRITIQUE" if stock_reel < stock_min else "OK"
-                    
-                    self.report_tree.insert("", "end", values=(
-                        ref, 
-                        name, 
-                        f"{stock_init:.2f}", 
-                        f"{stock_reel:.2f}", 
-                        f"{stock_min:.2f}", 
-                        status,
-                        "Produit auxiliaire"
-                    ))
-                    
-                    # Colorer les lignes critiques
-                    if stock_reel < stock_min:
-                        self.report_tree.item(self.report_tree.get_children()[-1], tags=("critical",))
-        except:
-            pass
+        for ref in self.auxiliaires:
+            name = self.aux_names.get(ref, ref)
+            stock_init = self.aux_stock_initial.get(ref, 0.0)
+            stock_reel = self.aux_stocks.get(ref, 0.0)
+            stock_min = self.aux_stock_min.get(ref, 0.0)
+            
+            status = "CRITIQUE" if stock_reel < stock_min else "OK"
+            
+            self.report_tree.insert("", "end", values=(
+                ref, 
+                name, 
+                units.format(ref, stock_init), 
+                units.format(ref, stock_reel), 
+                units.format(ref, stock_min), 
+                status,
+                "Produit auxiliaire",
+                classes.get(ref),
+                f"{valuation.unit_cost(ref):.2f}",
+                f"{valuation.value(ref, stock_reel):.2f}"
+            ))
+            
+            # Colorer les lignes critiques
+            if stock_reel < stock_min:
+                self.report_tree.item(self.report_tree.get_children()[-1], tags=("critical",))
         
         # Configurer le style pour les lignes critiques
         self.report_tree.tag_configure("critical", background="#ffcccc")
+        
+        refs = self.colorants + self.auxiliaires
+        total = sum(valuation.value(ref, self.stock_of(ref) or 0.0) for ref in refs)
+        lots_total = sum(self.lots.value(ref) for ref in refs)
+        total_txt, lots_txt = (f"{value:,.2f}".replace(",", " ") for value in (total, lots_total))
+        self.stock_value_var.set(f"Valeur du stock: {total_txt} au coût moyen pondéré, "
+                                 f"{lots_txt} pour les lots suivis à leur prix d'achat")
+        
+        # Coûts des consommations: par mois (le plus récent en premier) et par commande (la plus coûteuse en premier)
+        self.period_cost_tree.delete(*self.period_cost_tree.get_children())
+        for month, cost in sorted(valuation.periods.items(), reverse=True):
+            self.period_cost_tree.insert("", "end", values=(month, f"{cost:.2f}"))
+        self.commande_cost_tree.delete(*self.commande_cost_tree.get_children())
+        for commande, cost in sorted(valuation.commandes.items(), key=lambda x: x[1], reverse=True):
+            self.commande_cost_tree.insert("", "end", values=(commande, f"{cost:.2f}"))
 
+    @PROFILER.timed("check_stock_alerts")
     def check_stock_alerts(self):
         """Vérifie les alertes de stock et les affiche en rouge"""
         self.alert_list.delete(0, tk.END)
         alerts = []
+        classes = self.refresh_classes()
+        shortages = []
         
         # Vérifier les colorants
         for ref, min_val in self.stock_min.items():
@@ -804,31 +4993,36 @@ class StockApp(tk.Tk):
             # Vérification de l'alerte
             if current_stock < min_val:
                 name = self.colorant_names.get(ref, ref)
-                alerts.append(f"Colorant: {ref} - {name}: Stock actuel {current_stock:.2f} kg (Min: {min_val:.2f} kg)")
+                shortages.append((ref, f"Colorant: {ref} - {name}: Stock actuel {self.units.format(ref, current_stock)} "
+                                       f"(Min: {self.units.format(ref, min_val)})"))
         
         # Vérifier les produits auxiliaires
-        try:
-            sheet = self.wb["Produits auxiliaires"]
-            for row in range(2, sheet.max_row + 1):
-                ref = sheet.cell(row=row, column=1).value
-                if ref:
-                    ref = str(ref)
-                    name = sheet.cell(row=row, column=2).value or ref
-                    
-                    try:
-                        min_val = float(sheet.cell(row=row, column=4).value) if sheet.cell(row=row, column=4).value is not None else 0.0
-                    except:
-                        min_val = 0.0
-                    
-                    try:
-                        current_stock = float(sheet.cell(row=row, column=6).value) if sheet.cell(row=row, column=6).value is not None else 0.0
-                    except:
-                        current_stock = 0.0
-                    
-                    if current_stock < min_val:
-                        alerts.append(f"Produit auxiliaire: {ref} - {name}: Stock actuel {current_stock:.2f} kg (Min: {min_val:.2f} kg)")
-        except:
-            pass
+        for ref, min_val in self.aux_stock_min.items():
+            current_stock = self.aux_stocks.get(ref, 0.0)
+            
+            if current_stock < min_val:
+                name = self.aux_names.get(ref, ref)
+                shortages.append((ref, f"Produit auxiliaire: {ref} - {name}: Stock actuel {self.units.format(ref, current_stock)} "
+                                       f"(Min: {self.units.format(ref, min_val)})"))
+        
+        # Stocks minimaux par emplacement (feuille Emplacements), en plus du minimum tous emplacements confondus
+        for ref, location, current_stock, min_val in self.locations.shortages(self.stock_of):
+            name = self.colorant_names.get(ref) or self.aux_names.get(ref, ref)
+            shortages.append((ref, f"{location}: {ref} - {name}: Stock actuel {self.units.format(ref, current_stock)} "
+                                   f"(Min: {self.units.format(ref, min_val)})"))
+        
+        # Les ruptures des produits les plus consommés et les plus réguliers d'abord (tri stable)
+        shortages.sort(key=lambda shortage: classes.rank(shortage[0]))
+        for ref, text in shortages:
+            alerts.append(f"[{classes.get(ref) or '-'}] {text}")
+        
+        # Péremption: le prochain lot à expirer de chaque produit (sommet de son tas)
+        today = datetime.today().strftime('%Y-%m-%d')
+        limit = (datetime.today() + timedelta(days=LOT_EXPIRY_WARNING)).strftime('%Y-%m-%d')
+        for ref, lot in self.lots.expiring(limit):
+            etat = "périmé depuis le" if lot['peremption'] < today else "expire le"
+            alerts.append(f"Péremption: {ref} - lot {lot['lot'] or 'sans n°'} ({self.units.format(ref, lot['reste'])}) "
+                          f"{etat} {lot['peremption']}")
         
         if alerts:
             for alert in alerts:
@@ -837,35 +5031,143 @@ class StockApp(tk.Tk):
         else:
             self.alert_list.insert(tk.END, "Aucune alerte de stock - tous les niveaux sont suffisants")
             self.alert_list.itemconfig(tk.END, fg="green")
+        
+        self.update_sla_alerts()
 
+    def update_sla_alerts(self):
+        """Affiche les commandes en retard, la plus ancienne échéance en premier"""
+        today = datetime.today()
+        self.sla.tick(today.strftime('%Y-%m-%d'))
+        breaches = self.sla.breaches()
+        self.sla_list.delete(0, tk.END)
+        for cid, due in breaches:
+            cmd = self.commande_index[cid]
+            retard = (today - datetime.fromisoformat(due)).days
+            self.sla_list.insert(tk.END, f"Commande {cmd['ref']} (code {cmd['code'] or '-'}), "
+                                         f"entrée le {iso_date(cmd['date_entree'])}, {cmd['statut'] or 'En Attente'}: "
+                                         f"échéance du {due} dépassée de {retard} jour(s)")
+            self.sla_list.itemconfig(tk.END, fg="red")
+        if not breaches:
+            self.sla_list.insert(tk.END, "Aucune commande en retard")
+            self.sla_list.itemconfig(tk.END, fg="green")
+        
+        opened = len(self.sla.due) + len(breaches)
+        self.sla_summary_var.set(f"Commandes en attente suivies: {opened}, dont {len(breaches)} en retard")
+
+    @PROFILER.timed("update_commandes_display")
     def update_commandes_display(self):
-        """Met à jour l'affichage des commandes et des statistiques"""
-        # Effacer les anciennes entrées
-        for item in self.commandes_tree.get_children():
-            self.commandes_tree.delete(item)
-        
-        # Ajouter les commandes
-        for cmd in self.commandes:
-            date_entree = cmd['date_entree']
-            date_sortie = cmd['date_sortie']
-            
-            # Formater les dates
-            if isinstance(date_entree, datetime):
-                date_entree = date_entree.strftime('%Y-%m-%d')
-            
-            if isinstance(date_sortie, datetime):
-                date_sortie = date_sortie.strftime('%Y-%m-%d')
-            
-            self.commandes_tree.insert("", "end", values=(
-                cmd['ref'],
-                cmd['code'],
-                date_entree or "",
-                date_sortie or "",
-                cmd['delai'] or "",
-                cmd['statut'] or ""
-            ))
+        """Met à jour l'affichage des commandes et de leurs statistiques.
+        
+        La liste triée et filtrée n'est recalculée que si le modèle, le tri ou
+        les filtres ont changé; seule la fenêtre visible est écrite dans l'arbre.
+        """
+        view_key = (self.commande_order.version, self.commandes_sort, self.commandes_filter)
+        if view_key != self.commandes_view_key:
+            column, descending = self.commandes_sort
+            self.commandes_visible = [cid for cid in self.commande_order.select(column, descending, *self.commandes_filter)
+                                      if cid is not None]
+            self.commandes_view_key = view_key
+        self.show_commandes_window()
+        
+        # Mettre à jour les variables d'affichage
+        self.total_cmd_var.set(str(self.total_commandes))
+        self.traitees_var.set(str(self.commandes_traitees))
+        self.taux_var.set(f"{self.taux_commandes:.1f}%")
+
+    @staticmethod
+    def commande_values(cmd):
+        """Valeurs d'une ligne de la liste des commandes"""
+        date_entree = cmd['date_entree']
+        date_sortie = cmd['date_sortie']
+        
+        # Formater les dates
+        if isinstance(date_entree, datetime):
+            date_entree = date_entree.strftime('%Y-%m-%d')
+        
+        if isinstance(date_sortie, datetime):
+            date_sortie = date_sortie.strftime('%Y-%m-%d')
+        
+        return (cmd['ref'], cmd['code'], date_entree or "", date_sortie or "", cmd['delai'] or "", cmd['statut'] or "")
+
+    def show_commandes_window(self):
+        """Affiche la fenêtre courante de la liste: les lignes déjà présentes sont
+        déplacées (move) et mises à jour, les autres créées ou supprimées"""
+        tree = self.commandes_tree
+        total = len(self.commandes_visible)
+        self.commandes_offset = max(0, min(self.commandes_offset, total - self.commandes_rows))
+        window = self.commandes_visible[self.commandes_offset:self.commandes_offset + self.commandes_rows]
+        
+        wanted = {str(cid) for cid in window}
+        stale = [iid for iid in tree.get_children() if iid not in wanted]
+        if stale:
+            tree.delete(*stale)
+        for position, cid in enumerate(window):
+            iid = str(cid)
+            values = self.commande_values(self.commande_index[cid])
+            if tree.exists(iid):
+                tree.item(iid, values=values)
+                tree.move(iid, "", position)
+            else:
+                tree.insert("", position, iid=iid, values=values)
         
-        # Mettre à jour les statistiques
+        if total:
+            self.commandes_scrollbar.set(self.commandes_offset / total, (self.commandes_offset + len(window)) / total)
+        else:
+            self.commandes_scrollbar.set(0.0, 1.0)
+        self.commandes_count_var.set(f"{total} commande(s) affichée(s) sur {len(self.commandes)}")
+
+    def scroll_commandes(self, action, amount, unit=None):
+        """Déplace la fenêtre visible (commande de la scrollbar et molette de la souris)"""
+        total = len(self.commandes_visible)
+        if action == "moveto":
+            self.commandes_offset = int(float(amount) * total)
+        else:
+            step = max(1, self.commandes_rows - 1) if unit == "pages" else 1
+            self.commandes_offset += int(amount) * step
+        self.show_commandes_window()
+
+    def resize_commandes_window(self, event):
+        """Ajuste le nombre de lignes matérialisées à la hauteur de l'arbre"""
+        row_height = to_float(ttk.Style().lookup("Treeview", "rowheight")) or 20
+        rows = max(1, int((event.height - row_height) // row_height))
+        if rows != self.commandes_rows:
+            self.commandes_rows = rows
+            self.show_commandes_window()
+
+    def sort_commandes(self, column):
+        """Trie la liste par une colonne; un second clic inverse l'ordre"""
+        current, descending = self.commandes_sort
+        self.commandes_sort = (column, not descending if column == current else False)
+        for name, text in self.commandes_headings.items():
+            arrow = (" ▼" if self.commandes_sort[1] else " ▲") if name == column else ""
+            self.commandes_tree.heading(name, text=text + arrow)
+        self.commandes_offset = 0
+        self.update_commandes_display()
+
+    def apply_commandes_filter(self):
+        """Applique les filtres de statut et de période d'entrée"""
+        start = self.entry_commandes_from.get().strip()
+        end = self.entry_commandes_to.get().strip()
+        for value in (start, end):
+            if value:
+                try:
+                    datetime.strptime(value, '%Y-%m-%d')
+                except ValueError:
+                    messagebox.showwarning("Erreur", "Format de date invalide. Utilisez AAAA-MM-JJ")
+                    return
+        self.commandes_filter = (self.commandes_status_filter.get() or "Tous", start, end)
+        self.commandes_offset = 0
+        self.update_commandes_display()
+
+    def reset_commandes_filter(self):
+        """Efface les filtres de la liste des commandes"""
+        self.commandes_status_filter.current(0)
+        self.entry_commandes_from.delete(0, tk.END)
+        self.entry_commandes_to.delete(0, tk.END)
+        self.apply_commandes_filter()
+
+    def update_commandes_stats(self):
+        """Recalcule les statistiques des commandes"""
         self.total_commandes = len(self.commandes)
         self.commandes_traitees = sum(1 for cmd in self.commandes if cmd['statut'] and "traitée" in cmd['statut'].lower())
         
@@ -874,14 +5176,13 @@ class StockApp(tk.Tk):
             self.taux_commandes = (self.commandes_traitees / self.total_commandes) * 100
         else:
             self.taux_commandes = 0.0
-        
-        # Mettre à jour les variables d'affichage
-        self.total_cmd_var.set(str(self.total_commandes))
-        self.traitees_var.set(str(self.commandes_traitees))
-        self.taux_var.set(f"{self.taux_commandes:.1f}%")
 
+    @PROFILER.timed("action:ajouter_commande")
     def ajouter_commande(self):
         """Ouvre une fenêtre pour ajouter une nouvelle commande"""
+        if not self.workbook_ready():
+            return
+        
         dialog = tk.Toplevel(self)
         dialog.title("Nouvelle Commande")
         dialog.geometry("400x300")
@@ -923,6 +5224,7 @@ class StockApp(tk.Tk):
         btn_frame = ttk.Frame(dialog, padding=10)
         btn_frame.pack(fill=tk.X)
         
+        @PROFILER.timed("action:ajouter_commande:enregistrer")
         def save_cmd():
             ref = entry_ref.get().strip()
             code = entry_code.get().strip()
@@ -964,35 +5266,235 @@ class StockApp(tk.Tk):
                     commande['delai'] = 0
             
             # Ajouter à la liste
-            self.commandes.append(commande)
+            self.insert_commande(commande)
+            self.record_commandes(f"Commande {ref}",
+                                  lambda: self.remove_commande(commande),
+                                  lambda: self.insert_commande(commande))
             
             # Mettre à jour l'affichage
-            self.update_commandes_display()
+            self.update_commandes_stats()
+            self.refresh_tabs("commandes", "indicateurs")
             
             # Sauvegarder dans Excel
-            self.save_commandes_to_excel()
+            if not self.save_commandes_to_excel():
+                return  # Action défaite: le dialogue reste ouvert pour réessayer
             
             dialog.destroy()
         
         ttk.Button(btn_frame, text="Enregistrer", command=save_cmd, style="Accent.TButton").pack(side=tk.RIGHT, padx=5)
         ttk.Button(btn_frame, text="Annuler", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
 
+    @PROFILER.timed("action:reception_marchandises")
+    def reception_marchandises(self):
+        """Ouvre le bon de réception: lignes saisies dans la grille ou importées d'un fichier"""
+        if not self.workbook_ready():
+            return
+        
+        dialog = tk.Toplevel(self)
+        dialog.title("Réception de Marchandises")
+        dialog.geometry("760x520")
+        dialog.transient(self)
+        dialog.grab_set()
+        
+        lines = []
+        
+        # En-tête du bon
+        header = ttk.Frame(dialog, padding=10)
+        header.pack(fill=tk.X)
+        ttk.Label(header, text="N° de bon:").grid(row=0, column=0, sticky="e", padx=5, pady=5)
+        entry_document = ttk.Entry(header, width=20)
+        entry_document.grid(row=0, column=1, sticky="w", padx=5, pady=5)
+        ttk.Label(header, text="Date de réception:").grid(row=0, column=2, sticky="e", padx=5, pady=5)
+        entry_date = ttk.Entry(header, width=12)
+        entry_date.insert(0, datetime.today().strftime('%Y-%m-%d'))
+        entry_date.grid(row=0, column=3, sticky="w", padx=5, pady=5)
+        ttk.Label(header, text="Emplacement:").grid(row=1, column=0, sticky="e", padx=5, pady=5)
+        combo_location = ttk.Combobox(header, values=self.locations.names, width=20)
+        combo_location.set(DEFAULT_LOCATION)
+        combo_location.grid(row=1, column=1, sticky="w", padx=5, pady=5)
+        
+        # Saisie d'une ligne
+        line_frame = ttk.LabelFrame(dialog, text="Ligne", padding=10)
+        line_frame.pack(fill=tk.X, padx=10)
+        ttk.Label(line_frame, text="Référence:").grid(row=0, column=0, sticky="e", padx=5)
+        combo_ref = ttk.Combobox(line_frame, values=self.colorants + self.auxiliaires, width=22)
+        combo_ref.grid(row=0, column=1, padx=5)
+        ttk.Label(line_frame, text="Quantité:").grid(row=0, column=2, sticky="e", padx=5)
+        qty_frame = ttk.Frame(line_frame)
+        qty_frame.grid(row=0, column=3, sticky="w", padx=5)
+        entry_qty = ttk.Entry(qty_frame, width=8)
+        entry_qty.pack(side=tk.LEFT)
+        combo_unit = ttk.Combobox(qty_frame, values=[BASE_UNIT], state="readonly", width=5)
+        combo_unit.set(BASE_UNIT)
+        combo_unit.pack(side=tk.LEFT, padx=(5, 0))
+        
+        def update_units(event=None):
+            ref = combo_ref.get().strip()
+            combo_unit['values'] = self.units.units_for(ref)
+            combo_unit.set(self.units.unit_of(ref))
+        combo_ref.bind("<<ComboboxSelected>>", update_units)
+        ttk.Label(line_frame, text="Lot:").grid(row=1, column=0, sticky="e", padx=5, pady=5)
+        entry_lot = ttk.Entry(line_frame, width=22)
+        entry_lot.grid(row=1, column=1, padx=5, pady=5)
+        ttk.Label(line_frame, text="Péremption:").grid(row=1, column=2, sticky="e", padx=5, pady=5)
+        entry_expiry = ttk.Entry(line_frame, width=12)
+        entry_expiry.grid(row=1, column=3, padx=5, pady=5)
+        ttk.Label(line_frame, text="Prix (par unité):").grid(row=2, column=2, sticky="e", padx=5)
+        entry_price = ttk.Entry(line_frame, width=8)
+        entry_price.grid(row=2, column=3, sticky="w", padx=5)
+        
+        # Lignes du bon
+        columns = ("ref", "name", "qty", "lot", "peremption", "prix")
+        tree = ttk.Treeview(dialog, columns=columns, show="headings", height=10)
+        for col, title, width in (("ref", "Référence", 140), ("name", "Nom", 200), ("qty", "Quantité (kg)", 90),
+                                  ("lot", "Lot", 110), ("peremption", "Péremption", 90), ("prix", "Prix (/kg)", 90)):
+            tree.heading(col, text=title)
+            tree.column(col, width=width, anchor="center")
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
+        def show_lines():
+            tree.delete(*tree.get_children())
+            for i, line in enumerate(lines):
+                name = self.colorant_names.get(line['ref']) or self.aux_names.get(line['ref'], "?")
+                price = line.get('prix')
+                tree.insert("", "end", iid=i, values=(line['ref'], name, f"{line['qty']:.2f}",
+                                                       line['lot'], line['peremption'],
+                                                       f"{price:.2f}" if price is not None else ""))
+            dialog.title(f"Réception de Marchandises - {len(lines)} ligne(s)")
+        
+        def add_line():
+            ref, unit = combo_ref.get().strip(), combo_unit.get()
+            try:
+                qty = float(entry_qty.get().replace(",", "."))
+                price = entry_price.get().strip().replace(",", ".")
+                price = float(price) if price else None
+            except ValueError:
+                messagebox.showwarning("Erreur", "Veuillez entrer une quantité et un prix numériques", parent=dialog)
+                return
+            if unit not in self.units.units_for(ref):
+                messagebox.showwarning("Erreur", f"Unité {unit} impossible pour {ref} (densité inconnue)", parent=dialog)
+                return
+            # Le bon est enregistré en kg, le prix ramené au kg
+            per_unit = self.units.to_base(ref, 1.0, unit)
+            line = {'ref': ref, 'qty': qty * per_unit,
+                    'lot': entry_lot.get().strip(), 'peremption': entry_expiry.get().strip(),
+                    'prix': price / per_unit if price is not None else None}
+            errors = check_receipt_lines([line], set(self.stock_initial) | set(self.aux_stock_initial))
+            if errors:
+                messagebox.showwarning("Erreur", errors[0].split(": ", 1)[1], parent=dialog)
+                return
+            lines.append(line)
+            show_lines()
+            entry_qty.delete(0, tk.END)
+            entry_lot.delete(0, tk.END)
+            entry_expiry.delete(0, tk.END)
+            entry_price.delete(0, tk.END)
+        
+        def remove_line():
+            for iid in sorted((int(iid) for iid in tree.selection()), reverse=True):
+                del lines[iid]
+            show_lines()
+        
+        def import_file():
+            path = filedialog.askopenfilename(
+                parent=dialog, title="Importer un bon de réception",
+                filetypes=[("Fichiers Excel ou CSV", "*.xlsx *.csv"), ("Tous les fichiers", "*.*")])
+            if not path:
+                return
+            try:
+                lines.extend(read_receipt_file(path))
+            except Exception as e:
+                messagebox.showerror("Erreur", f"Impossible de lire le fichier:\n{str(e)}", parent=dialog)
+                return
+            show_lines()
+        
+        def save_receipt():
+            if self.save_receipt(entry_document.get().strip(), entry_date.get().strip(), lines,
+                                 location_name(combo_location.get())):
+                dialog.destroy()
+        
+        ttk.Button(line_frame, text="➕ Ajouter la ligne", command=add_line).grid(row=0, column=4, rowspan=3, padx=10)
+        
+        btn_frame = ttk.Frame(dialog, padding=10)
+        btn_frame.pack(fill=tk.X)
+        ttk.Button(btn_frame, text="📂 Importer un fichier...", command=import_file).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="🗑️ Retirer la ligne", command=remove_line).pack(side=tk.LEFT, padx=5)
+        ttk.Button(btn_frame, text="Enregistrer", command=save_receipt, style="Accent.TButton").pack(side=tk.RIGHT, padx=5)
+        ttk.Button(btn_frame, text="Annuler", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
+
+    def show_audit_log(self):
+        """Ouvre le journal des modifications: qui a modifié quoi, quand, avec les valeurs avant et après"""
+        dialog = tk.Toplevel(self)
+        dialog.title("Journal des Modifications")
+        dialog.geometry("1000x520")
+        dialog.transient(self)
+        
+        # Filtres: référence (produit ou commande, vide pour toutes) et période
+        filters = ttk.Frame(dialog, padding=10)
+        filters.pack(fill=tk.X)
+        ttk.Label(filters, text="Référence:").grid(row=0, column=0, sticky="e", padx=5)
+        combo_ref = ttk.Combobox(filters, values=[""] + self.colorants + self.auxiliaires, width=25)
+        combo_ref.set(self.combo_ref.get())
+        combo_ref.grid(row=0, column=1, padx=5)
+        ttk.Label(filters, text="Du:").grid(row=0, column=2, sticky="e", padx=5)
+        entry_start = ttk.Entry(filters, width=12)
+        entry_start.insert(0, (datetime.today() - timedelta(days=30)).strftime('%Y-%m-%d'))
+        entry_start.grid(row=0, column=3, padx=5)
+        ttk.Label(filters, text="Au:").grid(row=0, column=4, sticky="e", padx=5)
+        entry_end = ttk.Entry(filters, width=12)
+        entry_end.insert(0, datetime.today().strftime('%Y-%m-%d'))
+        entry_end.grid(row=0, column=5, padx=5)
+        
+        columns = ("quand", "qui", "ref", "objet", "champ", "avant", "apres")
+        tree = ttk.Treeview(dialog, columns=columns, show="headings", height=18)
+        for col, title, width in (("quand", "Quand", 140), ("qui", "Qui", 130), ("ref", "Référence", 130),
+                                  ("objet", "Objet", 130), ("champ", "Champ", 100), ("avant", "Avant", 170),
+                                  ("apres", "Après", 170)):
+            tree.heading(col, text=title)
+            tree.column(col, width=width, anchor="w")
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        summary_var = tk.StringVar()
+        ttk.Label(dialog, textvariable=summary_var, padding=(10, 0, 10, 10)).pack(anchor=tk.W)
+        
+        def search():
+            start, end = entry_start.get().strip(), entry_end.get().strip()
+            try:
+                for day in (start, end):
+                    if day:
+                        datetime.strptime(day, '%Y-%m-%d')
+            except ValueError:
+                messagebox.showwarning("Erreur", "Format de date invalide. Utilisez AAAA-MM-JJ", parent=dialog)
+                return
+            try:
+                entries = self.audit.query(combo_ref.get().strip() or None, start or None, end or None)
+            except Exception as e:
+                messagebox.showerror("Erreur", f"Impossible de lire le journal:\n{str(e)}", parent=dialog)
+                return
+            tree.delete(*tree.get_children())
+            # Les plus récentes d'abord
+            for entry in reversed(entries[-AUDIT_DISPLAY_LIMIT:]):
+                tree.insert("", "end", values=(entry['quand'].replace("T", " "), entry['qui'], entry['ref'],
+                                               entry['objet'], entry['champ'], audit_text(entry['avant']),
+                                               audit_text(entry['apres'])))
+            shown = min(len(entries), AUDIT_DISPLAY_LIMIT)
+            summary_var.set(f"{len(entries)} modification(s)" + (f", {shown} plus récentes affichées"
+                                                                 if shown < len(entries) else ""))
+        
+        ttk.Button(filters, text="🔍 Rechercher", command=search).grid(row=0, column=6, padx=10)
+        combo_ref.bind("<<ComboboxSelected>>", lambda e: search())
+        search()
+
+    @PROFILER.timed("action:modifier_commande")
     def modifier_commande(self):
         """Modifie la commande sélectionnée"""
-        selected = self.commandes_tree.selection()
-        if not selected:
-            messagebox.showwarning("Erreur", "Veuillez sélectionner une commande")
+        if not self.workbook_ready():
             return
-            
-        item = self.commandes_tree.item(selected[0])
-        values = item['values']
-        ref = values[0]
         
-        # Trouver la commande
-        commande = next((cmd for cmd in self.commandes if cmd['ref'] == ref), None)
+        # Trouver la commande par son identifiant
+        commande = self.selected_commande()
         if not commande:
-            messagebox.showwarning("Erreur", "Commande introuvable")
             return
+        ref = commande['ref']
             
         dialog = tk.Toplevel(self)
         dialog.title("Modifier Commande")
@@ -1051,6 +5553,7 @@ class StockApp(tk.Tk):
         btn_frame = ttk.Frame(dialog, padding=10)
         btn_frame.pack(fill=tk.X)
         
+        @PROFILER.timed("action:modifier_commande:enregistrer")
         def save_cmd():
             code = entry_code.get().strip()
             date_entree = entry_date_entree.get().strip()
@@ -1069,6 +5572,7 @@ class StockApp(tk.Tk):
                 return
                 
             # Mettre à jour la commande
+            old_fields = dict(commande)
             commande['code'] = code
             commande['date_entree'] = date_entree
             commande['date_sortie'] = date_sortie
@@ -1084,41 +5588,57 @@ class StockApp(tk.Tk):
                     commande['delai'] = delai
                 except:
                     commande['delai'] = 0
+            new_fields = dict(commande)
+            self.write_commande(commande)
+            self.audit_commande(commande, old_fields)
+            self.record_commandes(f"Modification de la commande {commande['ref']}",
+                                  lambda: self.update_commande(commande, old_fields),
+                                  lambda: self.update_commande(commande, new_fields))
             
             # Mettre à jour l'affichage
-            self.update_commandes_display()
+            self.update_commandes_stats()
+            self.refresh_tabs("commandes", "indicateurs")
             
             # Sauvegarder dans Excel
-            self.save_commandes_to_excel()
+            if not self.save_commandes_to_excel():
+                return  # Action défaite: le dialogue reste ouvert pour réessayer
             
             dialog.destroy()
         
         ttk.Button(btn_frame, text="Enregistrer", command=save_cmd, style="Accent.TButton").pack(side=tk.RIGHT, padx=5)
         ttk.Button(btn_frame, text="Annuler", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
 
+    @PROFILER.timed("action:marquer_traitee")
     def marquer_traitee(self):
         """Marque la commande sélectionnée comme traitée"""
-        selected = self.commandes_tree.selection()
-        if not selected:
-            messagebox.showwarning("Erreur", "Veuillez sélectionner une commande")
+        if not self.workbook_ready():
             return
-            
-        item = self.commandes_tree.item(selected[0])
-        values = item['values']
-        ref = values[0]
         
-        # Trouver la commande
-        commande = next((cmd for cmd in self.commandes if cmd['ref'] == ref), None)
+        # Trouver la commande par son identifiant
+        commande = self.selected_commande()
         if not commande:
-            messagebox.showwarning("Erreur", "Commande introuvable")
             return
+        ref = commande['ref']
             
         # Vérifier si elle est déjà traitée
         if commande['statut'] and "traitée" in commande['statut'].lower():
             messagebox.showinfo("Info", "Cette commande est déjà marquée comme traitée")
             return
+        
+        # Le code couleur a une recette: ses composants sont consommés pour le poids du lot
+        items = []
+        if commande['code'] in self.recipes:
+            weight = simpledialog.askfloat("Recette", f"Poids du lot (kg) pour le code couleur {commande['code']}:",
+                                           parent=self, minvalue=0.001)
+            if weight is None:
+                return
+            items = self.prepare_recipe(commande['code'], weight, datetime.today().strftime('%Y-%m-%d'),
+                                        str(commande['ref']))
+            if items is None:
+                return
             
         # Mettre à jour la commande
+        old_fields = dict(commande)
         commande['statut'] = "Traitée"
         commande['date_sortie'] = datetime.today().strftime('%Y-%m-%d')
         
@@ -1134,79 +5654,98 @@ class StockApp(tk.Tk):
             commande['delai'] = delai
         except:
             commande['delai'] = 0
+        new_fields = dict(commande)
+        try:
+            self.apply_consumptions(items)
+        except Exception as e:
+            commande.update(old_fields)
+            messagebox.showerror("Erreur", f"Erreur lors de la consommation de la recette:\n{str(e)}")
+            return
+        self.write_commande(commande)
+        self.audit_commande(commande, old_fields)
+        self.record_commandes(f"Commande {ref} traitée",
+                              lambda: (self.update_commande(commande, old_fields), self.apply_consumptions(items, -1)),
+                              lambda: (self.apply_consumptions(items), self.update_commande(commande, new_fields)))
             
         # Mettre à jour l'affichage
-        self.update_commandes_display()
+        self.update_commandes_stats()
+        self.refresh_tabs("commandes", "indicateurs", *(("consommation", "alertes", "rapports") if items else ()))
         
         # Sauvegarder dans Excel
-        self.save_commandes_to_excel()
+        if not self.save_commandes_to_excel():
+            return
         
         messagebox.showinfo("Succès", f"Commande {ref} marquée comme traitée")
-        self.status_var.set(f"Commande {ref} marquée comme traitée")
+        consumed = f" ({len(items)} produit(s) consommé(s) selon la recette)" if items else ""
+        self.status_var.set(f"Commande {ref} marquée comme traitée{consumed}")
 
+    @PROFILER.timed("action:supprimer_commande")
     def supprimer_commande(self):
         """Supprime la commande sélectionnée"""
-        selected = self.commandes_tree.selection()
-        if not selected:
-            messagebox.showwarning("Erreur", "Veuillez sélectionner une commande")
+        if not self.workbook_ready():
             return
-            
-        item = self.commandes_tree.item(selected[0])
-        values = item['values']
-        ref = values[0]
+        
+        commande = self.selected_commande()
+        if not commande:
+            return
+        ref = commande['ref']
         
         # Confirmation
         if not messagebox.askyesno("Confirmation", f"Voulez-vous vraiment supprimer la commande {ref}?"):
             return
             
         # Supprimer la commande
-        self.commandes = [cmd for cmd in self.commandes if cmd['ref'] != ref]
+        # Seule la commande sélectionnée est supprimée (plusieurs commandes peuvent partager une référence)
+        position = self.remove_commande(commande)
+        self.record_commandes(f"Suppression de la commande {ref}",
+                              lambda: self.insert_commande(commande, position),
+                              lambda: self.remove_commande(commande))
         
         # Mettre à jour l'affichage
-        self.update_commandes_display()
+        self.update_commandes_stats()
+        self.refresh_tabs("commandes", "indicateurs")
         
         # Sauvegarder dans Excel
-        self.save_commandes_to_excel()
+        if not self.save_commandes_to_excel():
+            return
         
         messagebox.showinfo("Succès", f"Commande {ref} supprimée")
         self.status_var.set(f"Commande {ref} supprimée")
 
+    def write_commandes_stats(self):
+        """Met à jour les statistiques des commandes dans la feuille "Groupe compta. Stock" """
+        self.set_cell(self.sheet_stats, 10, 2, self.commandes_traitees)  # N° total de cmd traitée
+        self.set_cell(self.sheet_stats, 16, 2, self.total_commandes)    # N total de commandes
+        
+        if self.total_commandes > 0:
+            taux = self.commandes_traitees / self.total_commandes
+            self.set_cell(self.sheet_stats, 13, 2, taux)  # taux des commandes
+
     def save_commandes_to_excel(self):
-        """Sauvegarde les commandes dans le fichier Excel"""
+        """Sauvegarde les commandes dans le fichier Excel (lignes déjà écrites, statistiques à jour).
+        
+        Appelée après une action enregistrée par record_commandes: si l'enregistrement
+        échoue, l'action est défaite. Retourne True si le fichier a été enregistré.
+        """
         try:
-            # Effacer les anciennes données
-            for row in range(2, self.sheet_commandes.max_row + 1):
-                for col in range(1, 9):
-                    self.sheet_commandes.cell(row=row, column=col).value = None
-            
-            # Écrire les nouvelles données
-            for i, cmd in enumerate(self.commandes, start=2):
-                self.sheet_commandes.cell(row=i, column=1, value=cmd['ref'])
-                self.sheet_commandes.cell(row=i, column=2, value=cmd['code'])
-                self.sheet_commandes.cell(row=i, column=3, value=cmd['date_entree'])
-                self.sheet_commandes.cell(row=i, column=4, value=cmd['date_sortie'])
-                self.sheet_commandes.cell(row=i, column=5, value=cmd['delai'])
-                self.sheet_commandes.cell(row=i, column=7, value=cmd['statut'])
-                self.sheet_commandes.cell(row=i, column=8, value=cmd['observation'])
-            
-            # Mettre à jour les statistiques dans la feuille "Groupe compta. Stock"
-            self.sheet_stats['B10'] = self.commandes_traitees  # N° total de cmd traitée
-            self.sheet_stats['B16'] = self.total_commandes    # N total de commandes
-            
-            if self.total_commandes > 0:
-                taux = self.commandes_traitees / self.total_commandes
-                self.sheet_stats['B13'] = taux  # taux des commandes
+            self.write_commandes_stats()
             
             # Sauvegarder le fichier
-            self.wb.save(self.filename)
+            self.save_workbook(rollback=self.command_log.undo)
             
             self.status_var.set("Commandes sauvegardées avec succès")
+            return True
             
         except Exception as e:
             messagebox.showerror("Erreur", f"Erreur lors de la sauvegarde des commandes:\n{str(e)}")
+            return False
 
+    @PROFILER.timed("action:save_consumption")
     def save_consumption(self):
         """Enregistre une nouvelle consommation dans le fichier Excel"""
+        if not self.workbook_ready():
+            return
+        
         product_type = self.product_type.get()
         ref = self.combo_ref.get()
         
@@ -1214,38 +5753,29 @@ class StockApp(tk.Tk):
             messagebox.showwarning("Erreur", "Veuillez sélectionner une référence de produit")
             return
             
-        # Validation de la consommation
+        # Validation de la consommation, saisie dans l'unité choisie et enregistrée en kg
+        unit = self.combo_unit.get()
         try:
-            consommation = float(self.entry_consommation.get())
+            consommation = self.units.to_base(ref, float(self.entry_consommation.get()),
+                                              unit if unit in self.units.units_for(ref) else None)
             if consommation <= 0:
                 raise ValueError
         except:
             messagebox.showwarning("Erreur", "Veuillez entrer une valeur numérique valide (> 0)")
             return
+        show = functools.partial(self.units.format, ref)
             
-        # Vérification du stock suffisant
+        # Vérification du stock suffisant à l'emplacement choisi
+        location = location_name(self.combo_location.get())
         if product_type == "Colorant":
-            current_stock = self.stocks.get(ref, 0.0)
+            current_stock = self.locations.quantity(ref, location, self.stocks.get(ref, 0.0))
         else:
-            # Pour les produits auxiliaires, récupérer le stock depuis Excel
-            current_stock = 0.0
-            try:
-                sheet = self.wb["Produits auxiliaires"]
-                for row in range(2, sheet.max_row + 1):
-                    if str(sheet.cell(row=row, column=1).value) == ref:
-                        current_stock = sheet.cell(row=row, column=6).value or 0.0
-                        try:
-                            current_stock = float(current_stock)
-                        except:
-                            current_stock = 0.0
-                        break
-            except:
-                pass
+            current_stock = self.locations.quantity(ref, location, self.aux_stocks.get(ref, 0.0))
         
-        if consommation > current_stock:
+        if consommation > current_stock + LotStore.EPSILON:
             messagebox.showwarning("Erreur", 
-                               f"Stock insuffisant! Stock actuel: {current_stock:.2f} kg\n"
-                               f"Consommation demandée: {consommation:.2f} kg")
+                               f"Stock insuffisant! Stock actuel ({location}): {show(current_stock)}\n"
+                               f"Consommation demandée: {show(consommation)}")
             return
             
         # Validation de la date
@@ -1256,81 +5786,105 @@ class StockApp(tk.Tk):
             messagebox.showwarning("Erreur", "Format de date invalide. Utilisez AAAA-MM-JJ")
             return
         
+        # Quantité très éloignée des consommations habituelles du produit (erreur de saisie?)
+        anomaly = self.anomalies.check(ref, consommation)
+        if anomaly is not None and not messagebox.askyesno(
+                "Quantité inhabituelle",
+                f"{show(consommation)} pour {ref} est très éloigné des consommations habituelles "
+                f"de ce produit (environ {show(anomaly[1])}).\n\nEnregistrer quand même?"):
+            return
+        
         try:
-            # Ajout dans la feuille Consommation
-            new_row = self.sheet_consommation.max_row + 1
-            self.sheet_consommation.cell(row=new_row, column=1, value=ref)
-            self.sheet_consommation.cell(row=new_row, column=2, value=date_str)
-            self.sheet_consommation.cell(row=new_row, column=3, value=consommation)
-            
-            # Mise à jour du stock réel
-            nouveau_stock = current_stock - consommation
-            
-            if product_type == "Colorant":
-                self.stocks[ref] = nouveau_stock
-                
-                # Trouver la ligne dans Liste des articles2
-                for row in range(2, self.sheet_articles.max_row + 1):
-                    cell_ref = self.sheet_articles.cell(row=row, column=1).value
-                    if cell_ref and str(cell_ref) == ref:
-                        # Mettre à jour le stock réel (colonne F/6)
-                        self.sheet_articles.cell(row=row, column=6).value = nouveau_stock
-                        
-                        # Mise à jour de l'alerte de stock (colonne H/8)
-                        stock_min = self.stock_min.get(ref, 0.0)
-                        alerte = "vrai" if nouveau_stock < stock_min else "faux"
-                        self.sheet_articles.cell(row=row, column=8).value = alerte
-                        break
-            else:
-                # Mise à jour du produit auxiliaire
-                sheet = self.wb["Produits auxiliaires"]
-                for row in range(2, sheet.max_row + 1):
-                    if str(sheet.cell(row=row, column=1).value) == ref:
-                        # Mettre à jour le stock réel (colonne F/6)
-                        sheet.cell(row=row, column=6).value = nouveau_stock
-                        
-                        # Mise à jour de l'alerte de stock (colonne H/8)
-                        try:
-                            stock_min = float(sheet.cell(row=row, column=4).value)
-                        except:
-                            stock_min = 0.0
-                        alerte = "vrai" if nouveau_stock < stock_min else "faux"
-                        sheet.cell(row=row, column=8).value = alerte
-                        break
-            
-            # Sauvegarde du fichier
-            self.wb.save(self.filename)
-            
-            # Ajouter à l'historique
-            self.consumption_history.append({
+            # Ajout dans la feuille Consommation, l'historique et le stock réel
+            # (avant la sauvegarde, qui peut fusionner l'historique d'un autre poste)
+            consumption = {
                 'ref': ref,
                 'date': date_str,
                 'qty': consommation,
-                'id': new_row
-            })
+                'emplacement': location,
+                'id': self.new_id('Consommation'),
+                'row': self.sheet_consommation.max_row + 1
+            }
+            self.insert_consumption(consumption)
+            self.command_log.record(f"Consommation de {show(consommation)} pour {ref}",
+                                    lambda: self.remove_consumption(consumption),
+                                    lambda: self.insert_consumption(consumption))
+            stock_min = (self.stock_min if product_type == "Colorant" else self.aux_stock_min).get(ref, 0.0)
+            
+            # Sauvegarde du fichier
+            self.save_workbook(rollback=self.command_log.undo)
+            
+            # Le stock peut inclure des mouvements fusionnés depuis un autre poste
+            nouveau_stock = (self.stocks if product_type == "Colorant" else self.aux_stocks)[ref]
             
             # Mise à jour de l'interface
-            self.label_stock.config(text=f"{nouveau_stock:.2f} kg")
+            self.label_stock.config(text=self.location_stock_text(ref, nouveau_stock))
             self.entry_consommation.delete(0, tk.END)
-            self.update_history_tree()
-            self.check_stock_alerts()
-            self.update_report_table()
-            self.update_indicators()
+            self.refresh_tabs("consommation", "alertes", "rapports", "indicateurs")
             
             # Afficher une alerte si le stock passe sous le minimum
             if nouveau_stock < stock_min:
                 messagebox.showwarning("Alerte Stock", 
-                                   f"Attention! Le stock de {ref} est tombé à {nouveau_stock:.2f} kg, "
-                                   f"ce qui est en dessous du stock minimal de {stock_min:.2f} kg.")
+                                   f"Attention! Le stock de {ref} est tombé à {show(nouveau_stock)}, "
+                                   f"ce qui est en dessous du stock minimal de {show(stock_min)}.")
             
             messagebox.showinfo("Succès", "Consommation enregistrée avec succès!")
-            self.status_var.set(f"Consommation de {consommation:.2f} kg enregistrée pour {ref}")
+            lots = ", ".join(f"{lot or 'sans n°'} {show(qty)}" for lot, qty in consumption['lots'])
+            self.status_var.set(f"Consommation de {show(consommation)} enregistrée pour {ref}"
+                                + (f" (lots: {lots})" if lots else ""))
             
         except Exception as e:
             messagebox.showerror("Erreur", f"Erreur lors de l'enregistrement:\n{str(e)}")
 
+    @PROFILER.timed("action:save_recipe_consumption")
+    def save_recipe_consumption(self):
+        """Consomme tous les composants de la recette sélectionnée pour le poids de lot saisi"""
+        if not self.workbook_ready():
+            return
+        
+        code = self.combo_recipe.get()
+        if not code:
+            messagebox.showwarning("Erreur", "Veuillez sélectionner un code couleur")
+            return
+        try:
+            weight = float(self.entry_batch_weight.get().replace(",", "."))
+            if weight <= 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showwarning("Erreur", "Veuillez entrer un poids de lot valide (> 0)")
+            return
+        date_str = self.entry_date.get()
+        try:
+            datetime.strptime(date_str, '%Y-%m-%d')
+        except ValueError:
+            messagebox.showwarning("Erreur", "Format de date invalide. Utilisez AAAA-MM-JJ")
+            return
+        
+        items = self.prepare_recipe(code, weight, date_str, location=location_name(self.combo_location.get()))
+        if items is None:
+            return
+        try:
+            # Toutes les lignes sont écrites, puis enregistrées une seule fois
+            self.apply_consumptions(items)
+            self.command_log.record(f"Recette {code} ({weight:.2f} kg)",
+                                    lambda: self.apply_consumptions(items, -1),
+                                    lambda: self.apply_consumptions(items))
+            self.save_workbook(rollback=self.command_log.undo)
+            
+            self.entry_batch_weight.delete(0, tk.END)
+            self.refresh_tabs("consommation", "alertes", "rapports", "indicateurs")
+            total = sum(item['qty'] for item in items)
+            self.status_var.set(f"Recette {code} consommée pour {weight:.2f} kg: "
+                                f"{len(items)} produit(s), {total:.2f} kg")
+        except Exception as e:
+            messagebox.showerror("Erreur", f"Erreur lors de l'enregistrement de la recette:\n{str(e)}")
+
+    @PROFILER.timed("action:update_initial_stock")
     def update_initial_stock(self):
         """Met à jour le stock initial dans Excel"""
+        if not self.workbook_ready():
+            return
+        
         product_type = self.stock_product_type.get()
         ref = self.combo_stock_ref.get()
         
@@ -1338,9 +5892,9 @@ class StockApp(tk.Tk):
             messagebox.showwarning("Erreur", "Veuillez sélectionner une référence de produit")
             return
             
-        # Validation du nouveau stock
+        # Validation du nouveau stock (saisi dans l'unité du produit)
         try:
-            new_stock = float(self.entry_new_stock.get())
+            new_stock = self.units.to_base(ref, float(self.entry_new_stock.get()))
             if new_stock < 0:
                 raise ValueError
         except:
@@ -1348,78 +5902,72 @@ class StockApp(tk.Tk):
             return
             
         try:
-            if product_type == "Colorant":
-                # Trouver la ligne dans Liste des articles2
-                for row in range(2, self.sheet_articles.max_row + 1):
-                    cell_ref = self.sheet_articles.cell(row=row, column=1).value
-                    if cell_ref and str(cell_ref) == ref:
-                        # Mettre à jour le stock initial (colonne C/3)
-                        self.sheet_articles.cell(row=row, column=3).value = new_stock
-                        
-                        # Recalculer le stock réel (F = C - E)
-                        consommation = self.sheet_articles.cell(row=row, column=5).value or 0
-                        try:
-                            consommation = float(consommation)
-                        except (TypeError, ValueError):
-                            consommation = 0.0
-                        
-                        nouveau_stock_reel = new_stock - consommation
-                        self.sheet_articles.cell(row=row, column=6).value = nouveau_stock_reel
-                        
-                        # Mise à jour des données internes
-                        self.stock_initial[ref] = new_stock
-                        self.stocks[ref] = nouveau_stock_reel
-                        
-                        # Mise à jour de l'alerte de stock
-                        stock_min = self.stock_min.get(ref, 0.0)
-                        alerte = "vrai" if nouveau_stock_reel < stock_min else "faux"
-                        self.sheet_articles.cell(row=row, column=8).value = alerte
-                        break
-            else:
-                # Mise à jour du produit auxiliaire
-                sheet = self.wb["Produits auxiliaires"]
-                for row in range(2, sheet.max_row + 1):
-                    if str(sheet.cell(row=row, column=1).value) == ref:
-                        # Mettre à jour le stock initial (colonne C/3)
-                        sheet.cell(row=row, column=3).value = new_stock
-                        
-                        # Recalculer le stock réel (F = C - E)
-                        consommation = sheet.cell(row=row, column=5).value or 0
-                        try:
-                            consommation = float(consommation)
-                        except (TypeError, ValueError):
-                            consommation = 0.0
-                        
-                        nouveau_stock_reel = new_stock - consommation
-                        sheet.cell(row=row, column=6).value = nouveau_stock_reel
-                        
-                        # Mise à jour de l'alerte de stock
-                        try:
-                            stock_min = float(sheet.cell(row=row, column=4).value)
-                        except:
-                            stock_min = 0.0
-                        alerte = "vrai" if nouveau_stock_reel < stock_min else "faux"
-                        sheet.cell(row=row, column=8).value = alerte
-                        break
+            old_stock = self.set_initial_stock(ref, new_stock)
+            self.command_log.record(f"Stock initial de {ref}",
+                                    lambda: self.set_initial_stock(ref, old_stock),
+                                    lambda: self.set_initial_stock(ref, new_stock))
             
             # Sauvegarde du fichier
-            self.wb.save(self.filename)
+            self.save_workbook(rollback=self.command_log.undo)
             
             # Mise à jour de l'interface
-            self.label_current_stock.config(text=f"{new_stock:.2f} kg")
-            self.update_stock_display()
-            self.check_stock_alerts()
-            self.update_report_table()
-            self.update_indicators()
+            self.label_current_stock.config(text=self.units.format(ref, new_stock))
+            self.refresh_tabs("consommation", "alertes", "rapports", "auxiliaires", "indicateurs")
             
             messagebox.showinfo("Succès", "Stock initial mis à jour avec succès!")
-            self.status_var.set(f"Stock initial de {ref} mis à jour: {new_stock:.2f} kg")
+            self.status_var.set(f"Stock initial de {ref} mis à jour: {self.units.format(ref, new_stock)}")
             
         except Exception as e:
             messagebox.showerror("Erreur", f"Erreur lors de la mise à jour du stock:\n{str(e)}")
 
+    @PROFILER.timed("action:transfert")
+    def transfer_stock(self):
+        """Transfère une quantité du produit sélectionné d'un emplacement à un autre (stock total inchangé)"""
+        if not self.workbook_ready():
+            return
+        
+        ref = self.combo_stock_ref.get()
+        source = location_name(self.combo_transfer_from.get())
+        target = location_name(self.combo_transfer_to.get())
+        if not ref:
+            messagebox.showwarning("Erreur", "Veuillez sélectionner une référence de produit")
+            return
+        if source == target:
+            messagebox.showwarning("Erreur", "Les emplacements de départ et d'arrivée doivent être différents")
+            return
+        try:
+            qty = self.units.to_base(ref, float(self.entry_transfer_qty.get()))
+            if qty <= 0:
+                raise ValueError
+        except:
+            messagebox.showwarning("Erreur", "Veuillez entrer une valeur numérique valide (> 0)")
+            return
+        
+        available = self.locations.quantity(ref, source, self.stock_of(ref) or 0.0)
+        if qty > available + LotStore.EPSILON:
+            messagebox.showwarning("Erreur", f"Stock insuffisant à {source}: {self.units.format(ref, available)}")
+            return
+        
+        try:
+            item = {'date': datetime.today().strftime('%Y-%m-%d'), 'ref': ref, 'de': source, 'vers': target,
+                    'qty': qty, 'row': self.transfers_sheet().max_row + 1}
+            self.insert_transfer(item)
+            label = f"Transfert de {self.units.format(ref, qty)} de {ref} vers {target}"
+            self.command_log.record(label, lambda: self.remove_transfer(item), lambda: self.insert_transfer(item))
+            
+            self.save_workbook(rollback=self.command_log.undo)
+            self.entry_transfer_qty.delete(0, tk.END)
+            self.refresh_tabs("stock", "consommation", "alertes")
+            self.status_var.set(f"{label} ({source} → {target})")
+        except Exception as e:
+            messagebox.showerror("Erreur", f"Erreur lors du transfert:\n{str(e)}")
+
+    @PROFILER.timed("action:add_new_product")
     def add_new_product(self):
         """Ajoute un nouveau produit au fichier Excel"""
+        if not self.workbook_ready():
+            return
+        
         product_type = self.new_product_type.get()
         ref = self.entry_new_ref.get().strip()
         name = self.entry_new_name.get().strip()
@@ -1440,75 +5988,25 @@ class StockApp(tk.Tk):
             return
             
         try:
-            if product_type == "Colorant":
-                if ref in self.colorants:
-                    messagebox.showwarning("Erreur", "Cette référence existe déjà")
-                    return
-                    
-                # Trouver la première ligne vide
-                new_row = self.sheet_articles.max_row + 1
-                
-                # Ajouter le nouveau colorant
-                self.sheet_articles.cell(row=new_row, column=1, value=ref)
-                self.sheet_articles.cell(row=new_row, column=2, value=name)
-                self.sheet_articles.cell(row=new_row, column=3, value=init_stock)
-                self.sheet_articles.cell(row=new_row, column=4, value=min_stock)
-                
-                # Ajouter les formules
-                # CONSOMMATION =SUMIF(Consommation!A2:A{self.sheet_consommation.max_row},A{new_row},Consommation!C2:C500)
-                self.sheet_articles.cell(row=new_row, column=5, 
-                                        value=f'=SUMIF(Consommation!A2:A{self.sheet_consommation.max_row},A{new_row},Consommation!C2:C500)')
-                
-                # STOCK REEL =C3-E3
-                self.sheet_articles.cell(row=new_row, column=6, value=f'=C{new_row}-E{new_row}')
-                
-                # ALERTE DE STOCK =IF(D3>=F3,"faux","vrai")
-                self.sheet_articles.cell(row=new_row, column=8, value=f'=IF(D{new_row}>=F{new_row},"faux","vrai")')
-                
-            else:
-                # Produit auxiliaire
-                sheet = self.wb["Produits auxiliaires"]
-                # Vérifier si la référence existe déjà
-                for row in range(2, sheet.max_row + 1):
-                    if str(sheet.cell(row=row, column=1).value) == ref:
-                        messagebox.showwarning("Erreur", "Cette référence existe déjà")
-                        return
-                
-                new_row = sheet.max_row + 1
-                sheet.cell(row=new_row, column=1, value=ref)
-                sheet.cell(row=new_row, column=2, value=name)
-                sheet.cell(row=new_row, column=3, value=init_stock)
-                sheet.cell(row=new_row, column=4, value=min_stock)
-                
-                # Ajouter les formules
-                # CONSOMMATION =SUMIF(Consommation!A2:A{self.sheet_consommation.max_row},A{new_row},Consommation!C2:C500)
-                sheet.cell(row=new_row, column=5, 
-                          value=f'=SUMIF(Consommation!A2:A{self.sheet_consommation.max_row},A{new_row},Consommation!C2:C500)')
-                
-                # STOCK REEL =C3-E3
-                sheet.cell(row=new_row, column=6, value=f'=C{new_row}-E{new_row}')
-                
-                # ALERTE DE STOCK =IF(D3>=F3,"faux","vrai")
-                sheet.cell(row=new_row, column=8, value=f'=IF(D{new_row}>=F{new_row},"faux","vrai")')
+            if ref in (self.colorants if product_type == "Colorant" else self.aux_names):
+                messagebox.showwarning("Erreur", "Cette référence existe déjà")
+                return
             
-            # Sauvegarde du fichier
-            self.wb.save(self.filename)
+            # Ajout en fin de feuille, avec les formules de consommation, stock réel et alerte
+            product = ("" if product_type == "Colorant" else "aux_", ref, name, init_stock, min_stock)
+            new_row = self.insert_product(product)
+            self.command_log.record(f"Produit {ref}",
+                                    lambda: self.remove_product(product, new_row),
+                                    lambda: self.insert_product(product, new_row))
             
-            # Recharger les données
-            self.load_data()
+            # Sauvegarde du fichier
+            self.save_workbook(rollback=self.command_log.undo)
             
-            # Mettre à jour les combobox
-            self.update_product_list()
+            # Mettre à jour la liste et sélectionner le nouveau produit
             self.update_stock_product_list()
-            
-            # Sélectionner le nouveau produit
-            self.combo_ref.set(ref)
             self.combo_stock_ref.set(ref)
-            self.update_stock_display()
             self.update_stock_info()
-            self.check_stock_alerts()
-            self.update_report_table()
-            self.update_indicators()
+            self.refresh_tabs("consommation", "alertes", "rapports", "auxiliaires", "indicateurs")
             
             # Vider les champs
             self.entry_new_ref.delete(0, tk.END)
@@ -1524,8 +6022,7 @@ class StockApp(tk.Tk):
 
     def create_auxiliary_tab(self):
         """Crée l'onglet pour les produits auxiliaires"""
-        tab = ttk.Frame(self.notebook)
-        self.notebook.add(tab, text="🧪 Produits Auxiliaires")
+        tab = self.tabs["auxiliaires"]
         
         # Frame principale avec padding
         main_frame = ttk.Frame(tab, padding=15)
@@ -1609,8 +6106,7 @@ class StockApp(tk.Tk):
 
     def create_indicators_tab(self):
         """Crée l'onglet pour les indicateurs"""
-        tab = ttk.Frame(self.notebook)
-        self.notebook.add(tab, text="📈 Indicateurs")
+        tab = self.tabs["indicateurs"]
         
         # Frame principale avec padding
         main_frame = ttk.Frame(tab, padding=15)
@@ -1695,34 +6191,46 @@ class StockApp(tk.Tk):
         # Bouton d'export
         btn_frame = ttk.Frame(right_frame, padding=5)
         btn_frame.pack(fill=tk.X, padx=5, pady=5)
+        
+        # Tendances d'un produit: consommation et niveau de stock
+        trend_frame = ttk.LabelFrame(main_frame, text="📉 Tendances par Produit")
+        trend_frame.pack(fill=tk.BOTH, expand=True, pady=(15, 0))
+        
+        controls = ttk.Frame(trend_frame, padding=5)
+        controls.pack(fill=tk.X)
+        ttk.Label(controls, text="Produit:").pack(side=tk.LEFT, padx=5)
+        self.combo_trend_ref = ttk.Combobox(controls, state="readonly", width=30)
+        self.combo_trend_ref.pack(side=tk.LEFT, padx=5)
+        self.combo_trend_ref.bind("<<ComboboxSelected>>", lambda e: self.update_trend_charts())
+        ttk.Label(controls, text="Regroupement:").pack(side=tk.LEFT, padx=5)
+        self.combo_trend_period = ttk.Combobox(controls, values=list(TREND_PERIODS), state="readonly", width=10)
+        self.combo_trend_period.current(1)
+        self.combo_trend_period.pack(side=tk.LEFT, padx=5)
+        self.combo_trend_period.bind("<<ComboboxSelected>>", lambda e: self.update_trend_charts())
+        
+        charts = ttk.Frame(trend_frame, padding=5)
+        charts.pack(fill=tk.BOTH, expand=True)
+        self.consumption_chart = tk.Canvas(charts, height=200, bg="#ffffff", highlightthickness=0)
+        self.consumption_chart.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(0, 5))
+        self.stock_chart = tk.Canvas(charts, height=200, bg="#ffffff", highlightthickness=0)
+        self.stock_chart.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=(5, 0))
+        for canvas in (self.consumption_chart, self.stock_chart):
+            canvas.bind("<Configure>", lambda e: self.update_trend_charts())
 
+    @PROFILER.timed("update_indicators")
     def update_indicators(self):
         """Met à jour les indicateurs de performance"""
-        # Calculer la consommation totale par produit
-        consumption_totals = {}
-        for item in self.consumption_history:
-            ref = item['ref']
-            consumption_totals[ref] = consumption_totals.get(ref, 0) + item['qty']
-        
-        # Ajouter les noms et types de produits
+        # Ajouter les noms et types de produits aux totaux de consommation
         products_with_info = []
-        for ref, total in consumption_totals.items():
+        for ref, total in self.consumption_totals.items():
             # Déterminer le type de produit
-            product_type = "Colorant" if ref in self.colorants else "Produit auxiliaire"
+            product_type = "Colorant" if ref in self.colorant_names else "Produit auxiliaire"
             
             # Trouver le nom du produit
             if product_type == "Colorant":
                 name = self.colorant_names.get(ref, ref)
             else:
-                name = ref  # Par défaut
-                try:
-                    sheet = self.wb["Produits auxiliaires"]
-                    for row in range(2, sheet.max_row + 1):
-                        if str(sheet.cell(row=row, column=1).value) == ref:
-                            name = sheet.cell(row=row, column=2).value or ref
-                            break
-                except:
-                    pass
+                name = self.aux_names.get(ref, ref)
             
             products_with_info.append({
                 'ref': ref,
@@ -1737,19 +6245,22 @@ class StockApp(tk.Tk):
         # Mettre à jour le top 10
         for item in self.top_cons_tree.get_children():
             self.top_cons_tree.delete(item)
+        classes = self.refresh_classes()
             
         for rank, product in enumerate(sorted_consumption[:10], 1):
-            priority = "Élevée" if rank <= 3 else "Moyenne" if rank <= 7 else "Basse"
+            # Priorité selon la classe ABC, précisée par la régularité de la demande (XYZ)
+            abc = classes.abc.get(product['ref'], "C")
+            priority = f"{ABC_PRIORITY[abc]} ({classes.get(product['ref'])})"
             self.top_cons_tree.insert("", "end", values=(
                 rank, 
                 product['name'], 
-                f"{product['total']:.2f} kg", 
+                self.units.format(product['ref'], product['total']), 
                 priority,
                 product['type']
             ))
             
             # Colorer les priorités élevées
-            if rank <= 3:
+            if abc == "A":
                 self.top_cons_tree.item(self.top_cons_tree.get_children()[-1], tags=("high",))
         
         # Configurer le style pour les priorités
@@ -1760,10 +6271,84 @@ class StockApp(tk.Tk):
         self.traitees_kpi.config(text=str(self.commandes_traitees))
         self.taux_kpi.config(text=f"{self.taux_commandes:.1f}%")
         
+        self.update_trend_charts()
+        
         self.status_var.set("Indicateurs mis à jour")
 
+    def update_trend_charts(self):
+        """Redessine les courbes de consommation et de stock du produit choisi"""
+        self.combo_trend_ref['values'] = self.colorants + self.auxiliaires
+        ref = self.combo_trend_ref.get()
+        if self.stock_of(ref) is None:
+            # Par défaut: le produit le plus consommé
+            ranked = sorted(self.consumption_totals, key=self.consumption_totals.get, reverse=True)
+            ref = next((r for r in ranked if self.stock_of(r) is not None), "")
+            self.combo_trend_ref.set(ref)
+        
+        period = TREND_PERIODS.get(self.combo_trend_period.get(), "semaine")
+        consumption = self.consumption_days.series(ref, period) if ref else []
+        stock = self.stock_trend(ref, period) if ref else []
+        # Séries en kg: seules les bornes affichées sont converties dans l'unité du produit
+        unit, factor = self.units.unit_of(ref), self.units.from_base(ref, 1.0)
+        self.draw_trend_chart(self.consumption_chart, consumption, f"Consommation {ref} ({unit})", "#4267B2", factor)
+        self.draw_trend_chart(self.stock_chart, stock, f"Stock {ref} ({unit})", "#4CAF50", factor)
+
+    def stock_trend(self, ref, period):
+        """Stock en fin de période, reconstitué à rebours depuis le stock actuel par les
+        consommations et les réceptions (les corrections du stock initial ne sont pas datées)"""
+        consumed = dict(self.consumption_days.series(ref, period))
+        received = dict(self.reception_days.series(ref, period))
+        stock = self.stock_of(ref) or 0.0
+        points = []
+        for bucket in sorted(set(consumed) | set(received), reverse=True):
+            points.append((bucket, stock))
+            stock += consumed.get(bucket, 0.0) - received.get(bucket, 0.0)
+        points.reverse()
+        return points
+
+    def draw_trend_chart(self, canvas, series, title, color, factor=1.0):
+        """Trace une série [(date, valeur)] sur un Canvas, réduite par LTTB à un point par pixel de large
+        (bornes de l'axe affichées multipliées par `factor`)"""
+        canvas.delete("all")
+        width = max(canvas.winfo_width(), 200)
+        height = max(canvas.winfo_height(), 120)
+        left, right, top, bottom = 60, 15, 25, 25
+        canvas.create_text(left, 12, text=title, anchor="w", font=("Segoe UI", 9, "bold"))
+        if not series:
+            canvas.create_text(width / 2, height / 2, text="Aucune donnée", fill="#888888")
+            return
+        
+        points = lttb([(datetime.fromisoformat(day).toordinal(), value) for day, value in series],
+                      width - left - right)
+        x0, x1 = points[0][0], points[-1][0]
+        y0 = min(0.0, min(y for _, y in points))
+        y1 = max(y for _, y in points)
+        scale_x = (width - left - right) / ((x1 - x0) or 1)
+        scale_y = (height - top - bottom) / ((y1 - y0) or 1)
+        coords = []
+        for x, y in points:
+            coords.extend((left + (x - x0) * scale_x, height - bottom - (y - y0) * scale_y))
+        
+        # Axes et bornes
+        canvas.create_line(left, top, left, height - bottom, fill="#999999")
+        canvas.create_line(left, height - bottom, width - right, height - bottom, fill="#999999")
+        canvas.create_text(left - 5, top, text=f"{y1 * factor:.1f}", anchor="e", font=("Segoe UI", 8))
+        canvas.create_text(left - 5, height - bottom, text=f"{y0 * factor:.1f}", anchor="e", font=("Segoe UI", 8))
+        canvas.create_text(left, height - bottom + 12, text=series[0][0], anchor="w", font=("Segoe UI", 8))
+        canvas.create_text(width - right, height - bottom + 12, text=series[-1][0], anchor="e", font=("Segoe UI", 8))
+        
+        if len(coords) >= 4:
+            canvas.create_line(*coords, fill=color, width=2)
+        else:
+            x, y = coords
+            canvas.create_oval(x - 3, y - 3, x + 3, y + 3, fill=color, outline=color)
+
+    @PROFILER.timed("action:edit_consumption")
     def edit_consumption(self):
         """Modifie une consommation sélectionnée"""
+        if not self.workbook_ready():
+            return
+        
         selected = self.history_tree.selection()
         if not selected:
             messagebox.showwarning("Erreur", "Veuillez sélectionner une consommation à modifier")
@@ -1771,10 +6356,8 @@ class StockApp(tk.Tk):
             
         item = self.history_tree.item(selected[0])
         values = item['values']
-        row_id = values[5]  # ID de la ligne dans Excel
-        
-        # Trouver la consommation
-        consumption = next((c for c in self.consumption_history if c['id'] == row_id), None)
+        # Trouver la consommation par son identifiant permanent
+        consumption = self.consumption_index.get(to_id(values[5]))
         if not consumption:
             messagebox.showwarning("Erreur", "Consommation introuvable")
             return
@@ -1807,44 +6390,40 @@ class StockApp(tk.Tk):
         date_entry.grid(row=2, column=1, sticky="w", padx=5, pady=5)
         
         # Quantité
-        ttk.Label(form_frame, text="Quantité (kg):", font=("Segoe UI", 10)).grid(row=3, column=0, sticky="e", padx=5, pady=5)
+        unit = self.units.unit_of(consumption['ref'])
+        ttk.Label(form_frame, text=f"Quantité ({unit}):", font=("Segoe UI", 10)).grid(row=3, column=0, sticky="e", padx=5, pady=5)
         qty_entry = ttk.Entry(form_frame, width=15)
-        qty_entry.insert(0, str(consumption['qty']))
+        qty_text = f"{self.units.from_base(consumption['ref'], consumption['qty']):g}"
+        qty_entry.insert(0, qty_text)
         qty_entry.grid(row=3, column=1, sticky="w", padx=5, pady=5)
         
         # Boutons
         btn_frame = ttk.Frame(dialog, padding=10)
         btn_frame.pack(fill=tk.X)
         
+        @PROFILER.timed("action:edit_consumption:enregistrer")
         def save_changes():
             # Validation des données
             try:
                 new_date = date_entry.get()
                 datetime.strptime(new_date, '%Y-%m-%d')
-                new_qty = float(qty_entry.get())
+                # Quantité inchangée: la valeur en kg est gardée telle quelle (pas d'arrondi de conversion)
+                new_qty = (consumption['qty'] if qty_entry.get() == qty_text
+                           else self.units.to_base(consumption['ref'], float(qty_entry.get())))
                 if new_qty <= 0:
                     raise ValueError
             except:
                 messagebox.showwarning("Erreur", "Veuillez entrer des données valides")
                 return
                 
-            # Mettre à jour la consommation
-            consumption['date'] = new_date
-            consumption['qty'] = new_qty
-            
-            # Mettre à jour Excel
+            # Mettre à jour la consommation, la feuille et le stock (écart de quantité)
             try:
-                self.sheet_consommation.cell(row=row_id, column=2, value=new_date)
-                self.sheet_consommation.cell(row=row_id, column=3, value=new_qty)
-                self.wb.save(self.filename)
-                
-                # Recalculer les stocks
-                self.load_data()
-                self.update_stock_display()
-                self.update_history_tree()
-                self.update_report_table()
-                self.update_indicators()
-                self.check_stock_alerts()
+                old_date, old_qty = self.change_consumption(consumption, new_date, new_qty)
+                self.command_log.record(f"Modification de la consommation du {new_date} pour {consumption['ref']}",
+                                        lambda: self.change_consumption(consumption, old_date, old_qty),
+                                        lambda: self.change_consumption(consumption, new_date, new_qty))
+                self.save_workbook(rollback=self.command_log.undo)
+                self.refresh_tabs("consommation", "stock", "commandes", "alertes", "rapports", "auxiliaires", "indicateurs")
                 
                 messagebox.showinfo("Succès", "Consommation modifiée avec succès")
                 self.status_var.set(f"Consommation du {new_date} pour {consumption['ref']} modifiée")
@@ -1855,8 +6434,12 @@ class StockApp(tk.Tk):
         ttk.Button(btn_frame, text="Enregistrer", command=save_changes, style="Accent.TButton").pack(side=tk.RIGHT, padx=5)
         ttk.Button(btn_frame, text="Annuler", command=dialog.destroy).pack(side=tk.RIGHT, padx=5)
 
+    @PROFILER.timed("action:delete_consumption")
     def delete_consumption(self):
         """Supprime une consommation sélectionnée"""
+        if not self.workbook_ready():
+            return
+        
         selected = self.history_tree.selection()
         if not selected:
             messagebox.showwarning("Erreur", "Veuillez sélectionner une consommation à supprimer")
@@ -1864,39 +6447,41 @@ class StockApp(tk.Tk):
             
         item = self.history_tree.item(selected[0])
         values = item['values']
-        row_id = values[5]  # ID de la ligne dans Excel
         
         # Confirmation
         if not messagebox.askyesno("Confirmation", 
                                   f"Voulez-vous vraiment supprimer cette consommation?\n"
                                   f"Référence: {values[1]}\n"
                                   f"Date: {values[0]}\n"
-                                  f"Quantité: {values[3]} kg"):
+                                  f"Quantité: {values[3]}"):
             return
             
-        try:
-            # Supprimer la ligne dans Excel
-            self.sheet_consommation.delete_rows(row_id)
-            self.wb.save(self.filename)
+        consumption = self.consumption_index.get(to_id(values[5]))
+        if not consumption:
+            messagebox.showwarning("Erreur", "Consommation introuvable")
+            return
             
-            # Mettre à jour les données
-            self.consumption_history = [c for c in self.consumption_history if c['id'] != row_id]
+        try:
+            # La ligne est vidée, pas supprimée: les autres consommations gardent leur ligne
+            self.remove_consumption(consumption)
+            self.command_log.record(f"Suppression de la consommation du {values[0]} pour {values[1]}",
+                                    lambda: self.insert_consumption(consumption),
+                                    lambda: self.remove_consumption(consumption))
             
-            # Recalculer les stocks
-            self.load_data()
-            self.update_stock_display()
-            self.update_history_tree()
-            self.update_report_table()
-            self.update_indicators()
-            self.check_stock_alerts()
+            self.save_workbook(rollback=self.command_log.undo)
+            self.refresh_tabs("consommation", "stock", "commandes", "alertes", "rapports", "auxiliaires", "indicateurs")
             
             messagebox.showinfo("Succès", "Consommation supprimée avec succès")
             self.status_var.set(f"Consommation du {values[0]} pour {values[1]} supprimée")
         except Exception as e:
             messagebox.showerror("Erreur", f"Erreur lors de la suppression:\n{str(e)}")
 
+    @PROFILER.timed("action:add_auxiliary_product")
     def add_auxiliary_product(self):
         """Ajoute un nouveau produit auxiliaire"""
+        if not self.workbook_ready():
+            return
+        
         product_id = self.entry_aux_id.get().strip()
         name = self.entry_aux_name.get().strip()
         stock = self.entry_aux_stock.get().strip()
@@ -1915,23 +6500,18 @@ class StockApp(tk.Tk):
             return
             
         try:
-            sheet = self.wb["Produits auxiliaires"]
-            
             # Vérifier si l'ID existe déjà
-            for row in range(2, sheet.max_row + 1):
-                if str(sheet.cell(row=row, column=1).value) == product_id:
-                    messagebox.showwarning("Erreur", "Cet ID de produit existe déjà")
-                    return
+            if product_id in self.aux_names:
+                messagebox.showwarning("Erreur", "Cet ID de produit existe déjà")
+                return
             
-            new_row = sheet.max_row + 1
-            sheet.cell(row=new_row, column=1, value=product_id)
-            sheet.cell(row=new_row, column=2, value=name)
-            sheet.cell(row=new_row, column=3, value=stock)
-            sheet.cell(row=new_row, column=4, value=min_stock)
-            sheet.cell(row=new_row, column=6, value=f"=C{new_row}-E{new_row}")
-            sheet.cell(row=new_row, column=8, value=f'=IF(D{new_row}>=F{new_row},"faux","vrai")')
+            product = ("aux_", product_id, name, stock, min_stock)
+            new_row = self.insert_product(product)
+            self.command_log.record(f"Produit {product_id}",
+                                    lambda: self.remove_product(product, new_row),
+                                    lambda: self.insert_product(product, new_row))
             
-            self.wb.save(self.filename)
+            self.save_workbook(rollback=self.command_log.undo)
             
             # Vider les champs
             self.entry_aux_id.delete(0, tk.END)
@@ -1940,80 +6520,293 @@ class StockApp(tk.Tk):
             self.entry_aux_min.delete(0, tk.END)
             
             messagebox.showinfo("Succès", "Produit auxiliaire ajouté avec succès")
-            self.load_auxiliary_data()
-            self.update_product_list()
-            self.update_stock_product_list()
-            self.update_report_table()
-            self.update_indicators()
+            self.refresh_tabs("auxiliaires", "consommation", "stock", "alertes", "rapports", "indicateurs")
         except Exception as e:
             messagebox.showerror("Erreur", f"Erreur lors de l'ajout:\n{str(e)}")
 
+    @PROFILER.timed("load_auxiliary_data")
     def load_auxiliary_data(self):
         """Charge les produits auxiliaires"""
+        # Effacer l'arbre
+        for item in self.aux_tree.get_children():
+            self.aux_tree.delete(item)
+        
+        for product_id in self.auxiliaires:
+            name = self.aux_names.get(product_id, product_id)
+            stock = self.aux_stock_initial.get(product_id, 0.0)
+            min_stock = self.aux_stock_min.get(product_id, 0.0)
+            
+            self.aux_tree.insert("", "end", values=(
+                product_id, name, self.units.format(product_id, stock), self.units.format(product_id, min_stock)
+            ))
+
+    def create_diagnostics_tab(self):
+        """Crée l'onglet de diagnostic des performances"""
+        tab = self.tabs["diagnostics"]
+        
+        # Frame principale avec padding
+        main_frame = ttk.Frame(tab, padding=15)
+        main_frame.pack(fill=tk.BOTH, expand=True)
+        
+        # Barre d'outils
+        toolbar_frame = ttk.Frame(main_frame)
+        toolbar_frame.pack(fill=tk.X, pady=(0, 10))
+        
+        ttk.Button(toolbar_frame, text="🔄 Actualiser", command=self.update_diagnostics).pack(side=tk.LEFT, padx=2)
+        ttk.Button(toolbar_frame, text="Exporter JSON", command=lambda: self.export_diagnostics("json")).pack(side=tk.LEFT, padx=2)
+        ttk.Button(toolbar_frame, text="Exporter CSV", command=lambda: self.export_diagnostics("csv")).pack(side=tk.LEFT, padx=2)
+        ttk.Button(toolbar_frame, text="🗑️ Vider", command=self.clear_diagnostics).pack(side=tk.LEFT, padx=2)
+        
+        # Résumé par opération
+        summary_group = ttk.LabelFrame(main_frame, text="Résumé par opération")
+        summary_group.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
+        
+        columns = ("name", "calls", "total", "mean", "max")
+        self.diag_summary_tree = ttk.Treeview(summary_group, columns=columns, show="headings", height=10)
+        
+        self.diag_summary_tree.heading("name", text="Opération")
+        self.diag_summary_tree.heading("calls", text="Appels")
+        self.diag_summary_tree.heading("total", text="Total (ms)")
+        self.diag_summary_tree.heading("mean", text="Moyenne (ms)")
+        self.diag_summary_tree.heading("max", text="Max (ms)")
+        
+        self.diag_summary_tree.column("name", width=300, anchor="w")
+        self.diag_summary_tree.column("calls", width=80, anchor="e")
+        self.diag_summary_tree.column("total", width=100, anchor="e")
+        self.diag_summary_tree.column("mean", width=100, anchor="e")
+        self.diag_summary_tree.column("max", width=100, anchor="e")
+        
+        scrollbar = ttk.Scrollbar(summary_group, orient="vertical", command=self.diag_summary_tree.yview)
+        self.diag_summary_tree.configure(yscrollcommand=scrollbar.set)
+        self.diag_summary_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        # Dernières mesures
+        records_group = ttk.LabelFrame(main_frame, text="Dernières mesures")
+        records_group.pack(fill=tk.BOTH, expand=True)
+        
+        columns = ("start", "name", "duration", "thread")
+        self.diag_records_tree = ttk.Treeview(records_group, columns=columns, show="headings")
+        
+        self.diag_records_tree.heading("start", text="Heure")
+        self.diag_records_tree.heading("name", text="Opération")
+        self.diag_records_tree.heading("duration", text="Durée (ms)")
+        self.diag_records_tree.heading("thread", text="Thread")
+        
+        self.diag_records_tree.column("start", width=120, anchor="center")
+        self.diag_records_tree.column("name", width=300, anchor="w")
+        self.diag_records_tree.column("duration", width=100, anchor="e")
+        self.diag_records_tree.column("thread", width=150, anchor="w")
+        
+        scrollbar = ttk.Scrollbar(records_group, orient="vertical", command=self.diag_records_tree.yview)
+        self.diag_records_tree.configure(yscrollcommand=scrollbar.set)
+        self.diag_records_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+    def update_diagnostics(self):
+        """Met à jour le résumé et les dernières mesures"""
+        for item in self.diag_summary_tree.get_children():
+            self.diag_summary_tree.delete(item)
+        for name, count, total, mean, worst in PROFILER.summary():
+            self.diag_summary_tree.insert("", "end", values=(
+                name, count, f"{total * 1000:.1f}", f"{mean * 1000:.2f}", f"{worst * 1000:.2f}"
+            ))
+        
+        # Les 200 mesures les plus récentes en premier
+        for item in self.diag_records_tree.get_children():
+            self.diag_records_tree.delete(item)
+        for started, name, duration, thread in reversed(PROFILER.snapshot()[-200:]):
+            self.diag_records_tree.insert("", "end", values=(
+                datetime.fromtimestamp(started).strftime('%H:%M:%S.%f')[:-3],
+                name, f"{duration * 1000:.2f}", thread
+            ))
+
+    def poll_diagnostics(self):
+        """Actualise périodiquement l'onglet de diagnostic lorsqu'il est affiché"""
+        if "diagnostics" in self.tabs_built and self.current_tab() == "diagnostics":
+            self.update_diagnostics()
+        self.after(2000, self.poll_diagnostics)
+
+    def toggle_diagnostics_tab(self, event=None):
+        """Affiche ou masque l'onglet de diagnostic"""
+        tab = self.tabs["diagnostics"]
+        if self.notebook.tab(tab, "state") == "hidden":
+            self.notebook.add(tab)
+            self.notebook.select(tab)
+        else:
+            self.notebook.hide(tab)
+
+    def clear_diagnostics(self):
+        """Vide le tampon des mesures"""
+        PROFILER.clear()
+        self.update_diagnostics()
+
+    def export_diagnostics(self, fmt):
+        """Exporte les mesures au format JSON ou CSV"""
+        filepath = filedialog.asksaveasfilename(
+            defaultextension=f".{fmt}",
+            filetypes=[(f"Fichiers {fmt.upper()}", f"*.{fmt}"), ("Tous les fichiers", "*.*")],
+            title="Exporter les mesures"
+        )
+        if not filepath:
+            return
+        
         try:
-            # Effacer l'arbre
-            for item in self.aux_tree.get_children():
-                self.aux_tree.delete(item)
-                
-            sheet = self.wb["Produits auxiliaires"]
-            for row in range(2, sheet.max_row + 1):
-                product_id = sheet.cell(row=row, column=1).value
-                if product_id:
-                    name = sheet.cell(row=row, column=2).value or ""
-                    
-                    try:
-                        stock = float(sheet.cell(row=row, column=3).value) if sheet.cell(row=row, column=3).value is not None else 0.0
-                    except:
-                        stock = 0.0
-                    
-                    try:
-                        min_stock = float(sheet.cell(row=row, column=4).value) if sheet.cell(row=row, column=4).value is not None else 0.0
-                    except:
-                        min_stock = 0.0
-                    
-                    self.aux_tree.insert("", "end", values=(
-                        product_id, name, f"{stock:.2f}", f"{min_stock:.2f}"
-                    ))
+            if fmt == "json":
+                PROFILER.dump_json(filepath)
+            else:
+                PROFILER.dump_csv(filepath)
+            self.status_var.set(f"Mesures exportées dans {filepath}")
         except Exception as e:
-            messagebox.showerror("Erreur", f"Erreur de chargement:\n{str(e)}")
+            messagebox.showerror("Erreur d'Export", f"Erreur lors de l'exportation:\n{str(e)}")
+
+    def product_info(self, ref):
+        """Retourne (nom, type) d'une référence produit"""
+        if ref in self.colorant_names:
+            return self.colorant_names[ref], "Colorant"
+        return self.aux_names.get(ref, ref), "Produit auxiliaire"
+
+    def build_export_sections(self):
+        """Prépare les sections de l'export à partir du modèle, avec des valeurs typées.
+        
+        Les listes sont copiées sur le thread Tk; les lignes sont produites à la
+        demande par le thread d'export.
+        """
+        # Rapport de stock
+        report = []
+        classes = self.refresh_classes()
+        valuation = self.valuation
+        for refs, names, initial, reel, minimum, product_type in (
+            (self.colorants, self.colorant_names, self.stock_initial, self.stocks, self.stock_min, "Colorant"),
+            (self.auxiliaires, self.aux_names, self.aux_stock_initial, self.aux_stocks, self.aux_stock_min, "Produit auxiliaire"),
+        ):
+            for ref in refs:
+                stock_reel = reel.get(ref, 0.0)
+                stock_min = minimum.get(ref, 0.0)
+                report.append((
+                    ref, names.get(ref, ref), initial.get(ref, 0.0), stock_reel, stock_min,
+                    "CRITIQUE" if stock_reel < stock_min else "OK", product_type, classes.get(ref),
+                    valuation.unit_cost(ref), valuation.value(ref, stock_reel)
+                ))
+        
+        # Stock par emplacement: la ventilation de chaque produit (magasin principal en premier)
+        by_location = [(row[0], row[1], location, qty)
+                       for row in report for location, qty in self.locations.breakdown(row[0], row[3])]
+        
+        history = list(self.consumption_history)
+        commandes = list(self.commandes)
+        totals = sorted(self.consumption_totals.items(), key=lambda x: x[1], reverse=True)
+        period_costs = sorted(valuation.periods.items())
+        commande_costs = sorted(valuation.commandes.items(), key=lambda x: x[1], reverse=True)
+        
+        def history_rows():
+            for item in history:
+                name, product_type = self.product_info(item['ref'])
+                yield to_date(item['date']), item['ref'], name, item['qty'], product_type
+        
+        def commandes_rows():
+            for cmd in commandes:
+                yield (cmd['ref'], cmd['code'], to_date(cmd['date_entree']), to_date(cmd['date_sortie']),
+                       cmd['delai'], cmd['statut'], cmd['observation'])
+        
+        def totals_rows():
+            for ref, total in totals:
+                name, product_type = self.product_info(ref)
+                yield ref, name, product_type, total
+        
+        return [
+            ("stock", "Rapport de Stock",
+             ["Référence", "Nom", "Stock Initial", "Stock Réel", "Stock Minimal", "Statut", "Type", "Classe ABC/XYZ",
+              "Coût Moyen (/kg)", "Valeur du Stock"],
+             iter(report), len(report)),
+            ("historique", "Historique Consommations",
+             ["Date", "Référence", "Nom", "Quantité (kg)", "Type"],
+             history_rows(), len(history)),
+            ("commandes", "Commandes",
+             ["Référence", "Code Couleur", "Date Entrée", "Date Sortie", "Délai (jours)", "Statut", "Observation"],
+             commandes_rows(), len(commandes)),
+            ("agregats", "Consommation par Produit",
+             ["Référence", "Nom", "Type", "Consommation Totale (kg)"],
+             totals_rows(), len(totals)),
+            ("couts_mois", "Coût par Mois", ["Mois", "Coût des Consommations"],
+             iter(period_costs), len(period_costs)),
+            ("couts_commandes", "Coût par Commande", ["Commande", "Coût des Consommations"],
+             iter(commande_costs), len(commande_costs)),
+            ("emplacements", "Stock par Emplacement", ["Référence", "Nom", "Emplacement", "Stock Réel"],
+             iter(by_location), len(by_location)),
+        ]
+
+    def run_background_task(self, label, func, on_done):
+        """Exécute func(progress) dans le pool de threads, avec sa progression dans la barre d'état.
+        
+        on_done(future) est appelé sur le thread Tk à la fin de la tâche.
+        """
+        updates = queue.Queue()
+        future = self.executor.submit(func, lambda done, total: updates.put((done, total)))
+        
+        self.progress_bar.configure(value=0)
+        self.progress_bar.pack(side=tk.BOTTOM, anchor=tk.E, padx=10)
+        self.status_var.set(f"{label}...")
+        
+        def poll():
+            latest = None
+            try:
+                while True:
+                    latest = updates.get_nowait()
+            except queue.Empty:
+                pass
+            if latest:
+                done, total = latest
+                self.progress_bar.configure(maximum=max(total, 1), value=done)
+                done_txt, total_txt = (f"{n:,}".replace(",", " ") for n in (done, total))
+                self.status_var.set(f"{label}: {done_txt} / {total_txt} lignes")
+            
+            if future.done():
+                self.progress_bar.pack_forget()
+                on_done(future)
+            else:
+                self.after(100, poll)
+        
+        self.after(100, poll)
+        return future
 
+    @PROFILER.timed("action:export_to_excel")
     def export_to_excel(self):
-        """Exporte le rapport actuel vers un nouveau fichier Excel"""
-        try:
-            # Demander le nom du fichier
-            filepath = filedialog.asksaveasfilename(
-                defaultextension=".xlsx",
-                filetypes=[("Fichiers Excel", "*.xlsx"), ("Tous les fichiers", "*.*")],
-                title="Enregistrer le rapport"
-            )
-            
-            if not filepath:
+        """Exporte le rapport, l'historique, les commandes et les agrégats vers un fichier Excel ou CSV"""
+        if self.export_future is not None and not self.export_future.done():
+            messagebox.showwarning("Export", "Un export est déjà en cours")
+            return
+        
+        # Demander le nom du fichier
+        filepath = filedialog.asksaveasfilename(
+            defaultextension=".xlsx",
+            filetypes=[("Fichiers Excel", "*.xlsx"), ("Fichiers CSV", "*.csv"), ("Tous les fichiers", "*.*")],
+            title="Enregistrer le rapport"
+        )
+        
+        if not filepath:
+            return
+        
+        sections = self.build_export_sections()
+        
+        def on_done(future):
+            error = future.exception()
+            if error is not None:
+                messagebox.showerror("Erreur d'Export", f"Erreur lors de l'exportation:\n{str(error)}")
+                self.status_var.set("Échec de l'export")
                 return
-                
-            # Créer un nouveau classeur
-            export_wb = openpyxl.Workbook()
-            sheet = export_wb.active
-            sheet.title = "Rapport de Stock"
-            
-            # En-têtes
-            headers = ["Référence", "Nom", "Stock Initial", "Stock Réel", "Stock Minimal", "Statut", "Type"]
-            sheet.append(headers)
-            
-            # Données
-            for item in self.report_tree.get_children():
-                values = self.report_tree.item(item)['values']
-                sheet.append(values)
-            
-            # Sauvegarder
-            export_wb.save(filepath)
             
+            self.status_var.set(f"Export terminé: {future.result()} lignes")
             messagebox.showinfo("Export Réussi", 
                                f"Le rapport a été exporté avec succès dans:\n{filepath}")
-            
-        except Exception as e:
-            messagebox.showerror("Erreur d'Export", f"Erreur lors de l'exportation:\n{str(e)}")
+        
+        self.export_future = self.run_background_task(
+            "Export en cours", lambda progress: export_sections(filepath, sections, progress), on_done
+        )
 
 
 if __name__ == "__main__":
+    if "--profile" in sys.argv:
+        PROFILER.enabled = True
     app = StockApp()
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,600 @@
+"""Banc d'essai reproductible de StockMaster Pro.
+
+Génère un classeur synthétique ayant exactement la structure créée par
+l'application (build_template_workbook), puis chronomètre les opérations
+principales sans affichage: les widgets Tk sont remplacés par des bouchons.
+
+Exemples:
+    python benchmark.py --taille moyen --output resultats.json
+    python benchmark.py --taille moyen --baseline resultats.json
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+
+# Tailles prédéfinies: (colorants, auxiliaires, consommations, commandes)
+PRESETS = {
+    "petit": (150, 20, 2000, 200),
+    "moyen": (500, 50, 20000, 2000),
+    "grand": (2000, 200, 200000, 20000),
+}
+
+STATUTS = ["En Attente", "Traitée", "Annulée"]
+
+
+# ---------------------------------------------------------------------------
+# Bouchons Tk: juste assez de comportement pour piloter StockApp sans écran
+# ---------------------------------------------------------------------------
+
+_ids = itertools.count(1)
+
+
+class _Var:
+    def __init__(self, master=None, value=""):
+        self._value = value
+
+    def get(self):
+        return self._value
+
+    def set(self, value):
+        self._value = value
+
+
+class _Widget:
+    created = []  # Boutons créés, pour retrouver les commandes des dialogues
+
+    def __init__(self, master=None, *args, **kw):
+        self.master = master
+        self._cfg = dict(kw)
+        self._bindings = {}
+        if "command" in kw:
+            _Widget.created.append(self)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return lambda *a, **k: None
+
+    def __setitem__(self, key, value):
+        self._cfg[key] = value
+
+    def __getitem__(self, key):
+        return self._cfg.get(key, "")
+
+    def config(self, *args, **kw):
+        self._cfg.update(kw)
+
+    configure = config
+
+    def cget(self, key):
+        return self._cfg.get(key, "")
+
+    def bind(self, event, func=None, add=None):
+        self._bindings[event] = func
+
+    def winfo_width(self):
+        return 800
+
+    def winfo_height(self):
+        return 300
+
+
+class _Entry(_Widget):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._text = ""
+
+    def get(self):
+        return self._text
+
+    def insert(self, index, text):
+        self._text += str(text)
+
+    def delete(self, first, last=None):
+        self._text = ""
+
+
+class _Combobox(_Entry):
+    def current(self, index=None):
+        values = list(self._cfg.get("values", ()) or ())
+        if index is None:
+            return values.index(self._text) if self._text in values else -1
+        if values:
+            self._text = str(values[index])
+
+    def set(self, value):
+        self._text = str(value)
+
+
+class _Treeview(_Widget):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._items = {}
+        self._order = []
+        self._selection = ()
+
+    def insert(self, parent, index, iid=None, values=(), tags=(), **kw):
+        iid = str(iid) if iid is not None else f"I{next(_ids)}"
+        self._items[iid] = {"values": list(values), "tags": tags, "text": kw.get("text", "")}
+        if index == "end":
+            self._order.append(iid)
+        else:
+            self._order.insert(int(index), iid)
+        return iid
+
+    def get_children(self, item=""):
+        return tuple(self._order)
+
+    def delete(self, *items):
+        for iid in items:
+            self._items.pop(iid, None)
+        if len(items) == len(self._order):
+            self._order = []
+        else:
+            dropped = set(items)
+            self._order = [iid for iid in self._order if iid not in dropped]
+
+    def item(self, iid, option=None, **kw):
+        if kw:
+            self._items[iid].update(kw)
+            return None
+        data = self._items[iid]
+        return data if option is None else data.get(option)
+
+    def exists(self, iid):
+        return iid in self._items
+
+    def move(self, iid, parent, index):
+        self._order.remove(iid)
+        self._order.insert(len(self._order) if index == "end" else int(index), iid)
+
+    def index(self, iid):
+        return self._order.index(iid)
+
+    def selection(self):
+        return self._selection
+
+    def selection_set(self, *items):
+        if len(items) == 1 and isinstance(items[0], (list, tuple)):
+            items = items[0]
+        self._selection = tuple(items)
+
+
+class _Listbox(_Widget):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._lines = []
+
+    def insert(self, index, text):
+        self._lines.append(text)
+
+    def delete(self, first, last=None):
+        self._lines = []
+
+    def size(self):
+        return len(self._lines)
+
+
+class _Notebook(_Widget):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._tabs = []
+        self._options = {}
+        self._selected = None
+
+    def add(self, child, **kw):
+        if child not in self._tabs:
+            self._tabs.append(child)
+        options = self._options.setdefault(id(child), {})
+        options.pop("state", None)  # add() réaffiche un onglet masqué
+        options.update(kw)
+        if self._selected is None:
+            self._selected = child
+
+    def tabs(self):
+        return tuple(self._tabs)
+
+    def tab(self, tab, option=None, **kw):
+        if kw:
+            self._options[id(tab)].update(kw)
+            return None
+        options = self._options[id(tab)]
+        return options if option is None else options.get(option, "normal")
+
+    def hide(self, tab):
+        self._options[id(tab)]["state"] = "hidden"
+
+    def select(self, tab=None):
+        if tab is None:
+            return self._selected
+        self._selected = tab
+        handler = self._bindings.get("<<NotebookTabChanged>>")
+        if handler:
+            handler(None)
+
+
+class _Canvas(_Widget):
+    def _draw(self, *args, **kw):
+        return next(_ids)
+
+    create_line = create_text = create_rectangle = create_oval = create_polygon = _draw
+
+
+class _Tk(_Widget):
+    def __init__(self, *args, **kw):
+        super().__init__(None)
+        self._pending = []
+
+    def after(self, ms, func=None, *args):
+        if func is None:
+            return None
+        token = f"after#{next(_ids)}"
+        self._pending.append((token, func, args))
+        return token
+
+    def after_idle(self, func, *args):
+        return self.after(0, func, *args)
+
+    def after_cancel(self, token):
+        self._pending = [p for p in self._pending if p[0] != token]
+
+    def run_pending(self):
+        """Exécute une fois les rappels after() en attente"""
+        pending, self._pending = self._pending, []
+        for _, func, args in pending:
+            func(*args)
+
+
+class _Toplevel(_Tk):
+    pass
+
+
+def install_tk_stubs():
+    """Remplace tkinter par des bouchons; à appeler avant d'importer app"""
+    tk = types.ModuleType("tkinter")
+    ttk = types.ModuleType("tkinter.ttk")
+    messagebox = types.ModuleType("tkinter.messagebox")
+    filedialog = types.ModuleType("tkinter.filedialog")
+    simpledialog = types.ModuleType("tkinter.simpledialog")
+
+    for name in ("BOTH", "X", "Y", "LEFT", "RIGHT", "TOP", "BOTTOM", "W", "E", "N", "S",
+                 "SUNKEN", "HORIZONTAL", "VERTICAL", "DISABLED", "NORMAL", "WORD", "NW", "CENTER"):
+        setattr(tk, name, name.lower())
+    tk.END = "end"
+    tk.TclError = RuntimeError
+    tk.Tk, tk.Toplevel = _Tk, _Toplevel
+    tk.StringVar = tk.IntVar = tk.DoubleVar = tk.BooleanVar = _Var
+    tk.Listbox, tk.Canvas = _Listbox, _Canvas
+    tk.Frame = tk.Label = tk.Button = tk.Menu = tk.Scrollbar = tk.Text = _Widget
+    for name in ("Frame", "Label", "LabelFrame", "Button", "Scrollbar", "Style", "Progressbar",
+                 "Separator", "Checkbutton", "Radiobutton", "Spinbox", "Scale"):
+        setattr(ttk, name, _Widget)
+    ttk.Entry, ttk.Combobox = _Entry, _Combobox
+    ttk.Treeview, ttk.Notebook = _Treeview, _Notebook
+
+    messagebox.showinfo = messagebox.showwarning = messagebox.showerror = lambda *a, **k: None
+    messagebox.askyesno = messagebox.askokcancel = lambda *a, **k: True
+    filedialog.answer = ""
+    filedialog.asksaveasfilename = filedialog.askopenfilename = lambda *a, **k: filedialog.answer
+    simpledialog.answer = None
+    simpledialog.askfloat = simpledialog.askstring = lambda *a, **k: simpledialog.answer
+
+    tk.ttk, tk.messagebox, tk.filedialog, tk.simpledialog = ttk, messagebox, filedialog, simpledialog
+    sys.modules.update({
+        "tkinter": tk, "tkinter.ttk": ttk, "tkinter.messagebox": messagebox,
+        "tkinter.filedialog": filedialog, "tkinter.simpledialog": simpledialog,
+    })
+    return tk
+
+
+# ---------------------------------------------------------------------------
+# Classeur synthétique
+# ---------------------------------------------------------------------------
+
+def generate_workbook(path, colorants, auxiliaires, consommations, commandes, seed=42):
+    """Génère un classeur synthétique reproductible (même graine = même fichier)"""
+    import app
+
+    rng = random.Random(seed)
+    wb = app.build_template_workbook()
+    start = datetime(2024, 1, 1)
+
+    articles = wb["Liste des articles2"]
+    colorant_refs = [f"COL{i:05d}" for i in range(colorants)]
+    for ref in colorant_refs:
+        stock = round(rng.uniform(50, 500), 2)
+        minimum = round(rng.uniform(5, 80), 2)
+        reel = round(stock - rng.uniform(0, 40), 2)
+        articles.append([ref, f"COLORANT {ref}", stock, minimum, 0, reel, None,
+                         "vrai" if reel < minimum else "faux"])
+
+    aux_sheet = wb["Produits auxiliaires"]
+    aux_refs = [f"AUX{i:04d}" for i in range(auxiliaires)]
+    for ref in aux_refs:
+        stock = round(rng.uniform(100, 1000), 2)
+        minimum = round(rng.uniform(10, 150), 2)
+        reel = round(stock - rng.uniform(0, 80), 2)
+        aux_sheet.append([ref, f"AUXILIAIRE {ref}", stock, minimum, 0, reel, None,
+                          "vrai" if reel < minimum else "faux"])
+
+    conso = wb["Consommation"]
+    refs = colorant_refs + aux_refs
+    for i in range(consommations):
+        day = start + timedelta(days=i * 365 // max(consommations, 1))
+        conso.append([rng.choice(refs), day.strftime('%Y-%m-%d'), round(rng.uniform(0.1, 5.0), 2)])
+
+    cmd_sheet = wb["commandes"]
+    for i in range(commandes):
+        entree = start + timedelta(days=rng.randrange(365))
+        statut = rng.choice(STATUTS)
+        if statut == "Traitée":
+            delai = rng.randrange(0, 10)
+            sortie = entree + timedelta(days=delai)
+        else:
+            delai, sortie = None, None
+        cmd_sheet.append([f"CMD{i:06d}", rng.randrange(1000, 9999), entree, sortie, delai, None, statut, None])
+
+    wb.save(path)
+
+
+# ---------------------------------------------------------------------------
+# Scénarios
+# ---------------------------------------------------------------------------
+
+def wait_for_load(app_instance, timeout=600):
+    """Traite les rappels after() jusqu'à la fin du chargement en arrière-plan"""
+    deadline = time.perf_counter() + timeout
+    while app_instance.wb is None:
+        if time.perf_counter() > deadline:
+            raise TimeoutError("chargement trop long")
+        time.sleep(0.001)
+        app_instance.run_pending()
+
+
+def press(text):
+    """Déclenche le dernier bouton créé portant ce libellé (dialogues)"""
+    for widget in reversed(_Widget.created):
+        if widget.cget("text") == text:
+            return widget.cget("command")()
+    raise LookupError(text)
+
+
+def timed(func, repeat):
+    """Retourne les durées (ms) de `repeat` exécutions de func"""
+    durations = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - t0) * 1000)
+    return durations
+
+
+def run_benchmarks(workbook, repeat, workdir):
+    import app
+
+    results = {}
+    target = os.path.join(workdir, "suivi_consommation.xlsx")
+
+    def fresh_app():
+        shutil.copy(workbook, target)
+        return app.StockApp()
+
+    # Lecteur xlsx rapide contre openpyxl en lecture seule, sur les mêmes octets
+    with open(workbook, "rb") as f:
+        data = f.read()
+
+    def openpyxl_reader():
+        return app.openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+
+    for label, reader in (("openpyxl", openpyxl_reader), ("rapide", lambda: app.XlsxReader(data))):
+        results[f"lecture catalogue ({label})"] = timed(lambda: app.read_catalog(reader()), repeat)
+        results[f"lecture historique ({label})"] = timed(lambda: app.read_consumption_history(reader()), repeat)
+
+    # Démarrage à froid: fenêtre puis chargement complet, sur une copie neuve du fichier
+    window, cold = [], []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        instance = fresh_app()
+        window.append((time.perf_counter() - t0) * 1000)
+        wait_for_load(instance)
+        cold.append((time.perf_counter() - t0) * 1000)
+    results["demarrage (fenetre)"] = window
+    results["chargement a froid"] = cold
+
+    instance = fresh_app()
+    wait_for_load(instance)
+    for key in instance.tabs:
+        instance.notebook.select(instance.tabs[key])
+    instance.notebook.select(instance.tabs["consommation"])
+
+    results["chargement a chaud"] = timed(instance.load_data, repeat)
+
+    ref = max(instance.stocks, key=instance.stocks.get)
+
+    def save_consumption():
+        instance.product_type.set("Colorant")
+        instance.combo_ref.set(ref)
+        instance.entry_consommation.delete(0, "end")
+        instance.entry_consommation.insert(0, "0.01")
+        instance.save_consumption()
+    results["saisie consommation"] = timed(save_consumption, repeat)
+
+    def select_last_consumption():
+        children = instance.history_tree.get_children()
+        instance.history_tree.selection_set(children[0])
+
+    def edit_consumption():
+        select_last_consumption()
+        instance.edit_consumption()
+        press("Enregistrer")
+    results["modification consommation"] = timed(edit_consumption, repeat)
+
+    def delete_consumption():
+        select_last_consumption()
+        instance.delete_consumption()
+    results["suppression consommation"] = timed(delete_consumption, repeat)
+
+    def undo_redo():
+        instance.undo()
+        instance.redo()
+    results["annuler / retablir"] = timed(undo_redo, repeat)
+
+    # Deux postes sur le même fichier: chaque saisie doit fusionner celle de l'autre poste
+    other = app.StockApp()
+    wait_for_load(other)
+    merged = []
+    for _ in range(repeat):
+        other.product_type.set("Colorant")
+        other.combo_ref.set(ref)
+        other.entry_consommation.delete(0, "end")
+        other.entry_consommation.insert(0, "0.01")
+        other.save_consumption()
+        t0 = time.perf_counter()
+        save_consumption()
+        merged.append((time.perf_counter() - t0) * 1000)
+    results["saisie avec fusion"] = merged
+
+    results["rafraichissement rapport"] = timed(instance.update_report_table, repeat)
+    results["verification alertes"] = timed(instance.check_stock_alerts, repeat)
+    results["rafraichissement indicateurs"] = timed(instance.update_indicators, repeat)
+    results["rafraichissement commandes"] = timed(instance.update_commandes_display, repeat)
+
+    def sort_commandes():
+        for column in app.COMMANDE_SORT_COLUMNS:
+            instance.sort_commandes(column)
+    results["tri commandes"] = timed(sort_commandes, repeat)
+
+    def export(extension):
+        def run():
+            sys.modules["tkinter.filedialog"].answer = os.path.join(workdir, f"export{extension}")
+            instance.export_to_excel()
+            while not instance.export_future.done():
+                time.sleep(0.001)
+            instance.run_pending()
+        return run
+    results["export xlsx"] = timed(export(".xlsx"), repeat)
+    results["export csv"] = timed(export(".csv"), repeat)
+
+    return results
+
+
+def summarize(results):
+    return {
+        name: {
+            "median_ms": statistics.median(durations),
+            "min_ms": min(durations),
+            "max_ms": max(durations),
+            "runs": len(durations),
+        }
+        for name, durations in results.items()
+    }
+
+
+def git_commit():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(summary, baseline=None):
+    header = f"{'Scénario':<32}{'Médiane (ms)':>14}{'Min (ms)':>12}"
+    if baseline:
+        header += f"{'Référence':>14}{'Écart':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, stats in summary.items():
+        line = f"{name:<32}{stats['median_ms']:>14.1f}{stats['min_ms']:>12.1f}"
+        if baseline:
+            ref = baseline.get(name)
+            if ref and ref["median_ms"] > 0:
+                delta = (stats["median_ms"] / ref["median_ms"] - 1) * 100
+                line += f"{ref['median_ms']:>14.1f}{delta:>+9.1f}%"
+            else:
+                line += f"{'-':>14}{'-':>10}"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banc d'essai de StockMaster Pro")
+    parser.add_argument("--taille", choices=sorted(PRESETS), default="petit",
+                        help="taille prédéfinie du classeur synthétique")
+    parser.add_argument("--colorants", type=int)
+    parser.add_argument("--auxiliaires", type=int)
+    parser.add_argument("--consommations", type=int)
+    parser.add_argument("--commandes", type=int)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workbook", help="conserver le classeur généré à cet emplacement")
+    parser.add_argument("--output", help="fichier JSON des résultats")
+    parser.add_argument("--baseline", help="résultats JSON d'un commit de référence à comparer")
+    args = parser.parse_args(argv)
+
+    colorants, auxiliaires, consommations, commandes = PRESETS[args.taille]
+    params = {
+        "colorants": args.colorants if args.colorants is not None else colorants,
+        "auxiliaires": args.auxiliaires if args.auxiliaires is not None else auxiliaires,
+        "consommations": args.consommations if args.consommations is not None else consommations,
+        "commandes": args.commandes if args.commandes is not None else commandes,
+        "seed": args.seed,
+        "repeat": args.repeat,
+    }
+
+    install_tk_stubs()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    workdir = tempfile.mkdtemp(prefix="stockmaster-bench-")
+    cwd = os.getcwd()
+    try:
+        workbook = os.path.abspath(args.workbook) if args.workbook else os.path.join(workdir, "synthetique.xlsx")
+        generate_workbook(workbook, params["colorants"], params["auxiliaires"],
+                          params["consommations"], params["commandes"], seed=args.seed)
+        os.chdir(workdir)
+        results = run_benchmarks(workbook, args.repeat, workdir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    import openpyxl
+    report = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "openpyxl": openpyxl.__version__,
+        "params": params,
+        "results": summarize(results),
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            reference = json.load(f)
+        if reference.get("params") != params:
+            print("Attention: paramètres différents de la référence", reference.get("params"))
+        baseline = reference["results"]
+
+    print(f"StockMaster Pro - commit {report['commit']} - {params}")
+    print_table(report["results"], baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
+
+
+if __name__ == "__main__":
+    main()
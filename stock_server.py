@@ -0,0 +1,489 @@
+"""Serveur de stock sans interface de StockMaster Pro.
+
+Le serveur héberge le modèle (stocks, historique, commandes) et le classeur
+Excel; les postes clients lui envoient des requêtes au lieu d'ouvrir chacun
+le fichier. Protocole: une ligne JSON par requête et par réponse.
+
+    -> {"id": 1, "op": "consommation", "ref": "R1", "date": "2025-06-01", "qty": 2.5}
+    <- {"id": 1, "ok": true, "resultat": {"stock": 22.5, "alerte": false}}
+    <- {"id": 2, "ok": false, "erreur": "Référence inconnue: R9"}
+
+Les écritures sont appliquées en mémoire puis enregistrées par lots.
+
+Exemple:
+    python stock_server.py --fichier suivi_consommation.xlsx --port 8765
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import time
+from datetime import datetime
+
+from app import (COMMANDE_COLUMNS, COMMANDE_LINK_COLUMN, DEFAULT_LOCATION, ID_COLUMN, LOCATION_COLUMN, LOT_COLUMN,
+                 PROFILER, AuditLog, LotStore, WorkbookLock, audit_path, check_recipe_stock, encode_draws, is_formula,
+                 iter_workbook_stages, location_name, read_external_changes, to_date, to_float, to_id,
+                 workbook_parts, write_workbook_file)
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+# Enregistrement du classeur au plus tard après BATCH_DELAY secondes ou BATCH_SIZE écritures
+BATCH_DELAY = 2.0
+BATCH_SIZE = 200
+
+
+class StockService:
+    """Modèle de données partagé et opérations exposées aux clients"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        for stage, data in iter_workbook_stages(filename):
+            data.pop('new_ids', None)  # Nombre d'identifiants attribués au chargement: utile à l'interface seulement
+            for name, value in data.items():
+                setattr(self, name, value)
+
+        self.sheet_articles = self.wb['Liste des articles2']
+        self.sheet_consommation = self.wb['Consommation']
+        self.sheet_commandes = self.wb['commandes']
+        self.sheet_stats = self.wb['Groupe compta. Stock']
+
+        # Numéro de ligne des produits, pour des écritures sans parcours de feuille
+        self.product_rows = {}
+        for kind, sheet in self.product_sheets().items():
+            for row, (ref,) in enumerate(sheet.iter_rows(min_row=2, max_col=1, values_only=True), start=2):
+                if ref:
+                    self.product_rows[kind, str(ref)] = row
+
+        self.version = 0
+        self.pending = 0
+        self.commandes_dirty = False
+        # Journal des modifications, écrit avec le classeur (hors de la boucle asyncio)
+        self.audit = AuditLog(audit_path(filename))
+
+    def product_sheets(self):
+        sheets = {"colorant": self.sheet_articles}
+        if "Produits auxiliaires" in self.wb.sheetnames:
+            sheets["auxiliaire"] = self.wb["Produits auxiliaires"]
+        return sheets
+
+    def product(self, ref):
+        """Retourne (type, stock initial, stock min, stock réel) d'un produit"""
+        if ref in self.stocks:
+            return "colorant", self.stock_initial, self.stock_min, self.stocks
+        if ref in self.aux_stocks:
+            return "auxiliaire", self.aux_stock_initial, self.aux_stock_min, self.aux_stocks
+        raise ValueError(f"Référence inconnue: {ref}")
+
+    def set_cell(self, sheet, row, col, value):
+        """Écrit une cellule et invalide les formules qui en dépendent"""
+        sheet.cell(row=row, column=col).value = value
+        self.evaluator.invalidate(sheet.title, row, col)
+
+    def write_stock(self, kind, ref, stock_min, stock):
+        """Écrit le stock réel et l'alerte d'un produit dans sa feuille (sauf cellules à formule).
+        
+        Retourne le stock à afficher: celui de la formule si la cellule en porte une.
+        """
+        sheet = self.product_sheets()[kind]
+        row = self.product_rows[kind, ref]
+        if ref in self.formula_stocks:
+            return to_float(self.evaluator.value(sheet.title, row, 6))
+        self.set_cell(sheet, row, 6, stock)
+        if not is_formula(sheet.cell(row=row, column=8).value):
+            self.set_cell(sheet, row, 8, "vrai" if stock < stock_min else "faux")
+        return stock
+
+    def new_id(self, sheet_name):
+        """Prochain identifiant permanent d'une feuille (Consommation, commandes)"""
+        value = self.next_ids[sheet_name]
+        self.next_ids[sheet_name] += 1
+        return value
+
+    def touch(self, count=1):
+        self.version += 1
+        self.pending += count
+
+    # -- Lectures ------------------------------------------------------------
+
+    def op_etat(self):
+        return {"version": self.version, "en_attente": self.pending, "fichier": self.filename}
+
+    def op_catalogue(self):
+        """Produits sous forme compacte: [ref, nom, stock initial, stock min, stock réel]"""
+        return {
+            "colorants": [[ref, self.colorant_names.get(ref, ref), self.stock_initial[ref],
+                           self.stock_min[ref], self.stocks[ref]] for ref in self.colorants],
+            "auxiliaires": [[ref, self.aux_names.get(ref, ref), self.aux_stock_initial[ref],
+                             self.aux_stock_min[ref], self.aux_stocks[ref]] for ref in self.auxiliaires],
+        }
+
+    def op_stock(self, ref):
+        _, initial, minimum, stocks = self.product(ref)
+        return [initial[ref], minimum[ref], stocks[ref]]
+
+    def op_historique(self, ref=None, depuis=0):
+        """Consommations [ref, date, quantité, identifiant], éventuellement filtrées"""
+        items = self.consumption_history[depuis:]
+        return [[h['ref'], h['date'], h['qty'], h['id']] for h in items if ref is None or h['ref'] == ref]
+
+    def op_totaux(self):
+        return self.consumption_totals
+
+    def op_valeur(self):
+        """Valorisation au coût moyen pondéré: {ref: [CMP, valeur]}, total, coûts par mois et par commande"""
+        products = {}
+        for ref in self.colorants + self.auxiliaires:
+            stock = self.product(ref)[3][ref]
+            products[ref] = [self.valuation.unit_cost(ref), self.valuation.value(ref, stock)]
+        return {"produits": products, "total": sum(value for _, value in products.values()),
+                "mois": self.valuation.periods, "commandes": self.valuation.commandes}
+
+    def op_emplacements(self, ref=None):
+        """Stock par emplacement: {ref: {emplacement: quantité}} (d'un seul produit si `ref` est donné)"""
+        refs = [ref] if ref is not None else self.colorants + self.auxiliaires
+        return {r: dict(self.locations.breakdown(r, self.product(r)[3][r])) for r in refs}
+
+    def op_commandes(self):
+        """Commandes [ref, code, entrée, sortie, délai, statut, observation, identifiant]"""
+        return [[cmd['ref'], cmd['code'], str(to_date(cmd['date_entree']) or ""),
+                 str(to_date(cmd['date_sortie']) or ""), cmd['delai'], cmd['statut'], cmd['observation'],
+                 cmd['id']]
+                for cmd in self.commandes]
+
+    # -- Écritures -----------------------------------------------------------
+
+    def op_consommation(self, ref, date, qty, emplacement=None):
+        qty = float(qty)
+        if qty <= 0:
+            raise ValueError("La quantité doit être positive")
+        datetime.strptime(date, '%Y-%m-%d')
+        stocks = self.product(ref)[3]
+        emplacement = location_name(emplacement)
+        available = self.locations.quantity(ref, emplacement, stocks[ref])
+        if qty > available + LotStore.EPSILON:
+            raise ValueError(f"Stock insuffisant! Stock actuel ({emplacement}): {available:.2f} kg")
+        return self.consume(ref, date, qty, emplacement=emplacement)
+
+    def consume(self, ref, date, qty, commande=None, emplacement=DEFAULT_LOCATION):
+        """Écrit une consommation déjà contrôlée: ligne, lots, coût, emplacement, totaux et stock réel"""
+        kind, _, minimum, stocks = self.product(ref)
+        item = {'ref': ref, 'date': date, 'qty': qty, 'lots': self.lots.draw(ref, qty), 'commande': commande,
+                'emplacement': emplacement, 'id': self.new_id('Consommation'),
+                'row': self.sheet_consommation.max_row + 1}
+        for col, value in ((1, ref), (2, date), (3, qty), (ID_COLUMN, item['id']),
+                           (LOT_COLUMN, encode_draws(item['lots'])), (COMMANDE_LINK_COLUMN, commande),
+                           (LOCATION_COLUMN, emplacement if emplacement != DEFAULT_LOCATION else None)):
+            self.set_cell(self.sheet_consommation, item['row'], col, value)
+        self.consumption_history.append(item)
+        self.consumption_index[item['id']] = item
+        self.audit.record(ref, f"Consommation {item['id']}", "ajout", None, {'date': date, 'quantité': qty})
+        self.consumption_totals[ref] = self.consumption_totals.get(ref, 0.0) + qty
+        self.valuation.consume(item)
+        self.locations.consume(item)
+
+        stocks[ref] = self.write_stock(kind, ref, minimum.get(ref, 0.0), stocks[ref] - qty)
+        self.touch()
+        return {"stock": stocks[ref], "alerte": stocks[ref] < minimum.get(ref, 0.0)}
+
+    def op_stock_initial(self, ref, valeur):
+        valeur = float(valeur)
+        if valeur < 0:
+            raise ValueError("Le stock initial doit être positif")
+        kind, initial, minimum, stocks = self.product(ref)
+
+        # Stock réel = stock initial - consommation cumulée
+        if initial[ref] != valeur:
+            self.audit.record(ref, "Produit", "stock initial", initial[ref], valeur)
+        initial[ref] = valeur
+        sheet = self.product_sheets()[kind]
+        self.set_cell(sheet, self.product_rows[kind, ref], 3, valeur)
+        stocks[ref] = self.write_stock(kind, ref, minimum.get(ref, 0.0),
+                                       valeur - self.consumption_totals.get(ref, 0.0))
+        self.touch()
+        return {"stock": stocks[ref]}
+
+    def op_ajouter_commande(self, ref, code="", date_entree=None, statut="En Attente", observation=""):
+        date_entree = date_entree or datetime.today().strftime('%Y-%m-%d')
+        datetime.strptime(date_entree, '%Y-%m-%d')
+        commande = {'ref': ref, 'code': code, 'date_entree': date_entree, 'date_sortie': "",
+                    'delai': "", 'statut': statut, 'observation': observation, 'id': self.new_id('commandes'),
+                    'row': self.sheet_commandes.max_row + 1}
+        if "traitée" in statut.lower():
+            self.close_commande(commande)
+        self.commandes.append(commande)
+        self.commande_index[commande['id']] = commande
+        self.write_commande(commande)
+        self.audit.record(ref, f"Commande {commande['id']}", "ajout", None, {'code': code, 'statut': commande['statut']})
+        self.commandes_dirty = True
+        self.touch()
+        return len(self.commandes)
+
+    def op_recette(self, code, poids, date=None, commande=None, emplacement=None):
+        """Consomme tous les composants de la recette d'un code couleur pour un lot de `poids` kg,
+        prélevés à `emplacement` (magasin principal par défaut), éventuellement pour la commande `commande`"""
+        poids = float(poids)
+        if poids <= 0:
+            raise ValueError("Le poids du lot doit être positif")
+        date = date or datetime.today().strftime('%Y-%m-%d')
+        datetime.strptime(date, '%Y-%m-%d')
+        needs = self.recipes.explode(code, poids)
+        if not needs:
+            raise ValueError(f"Aucune recette pour le code couleur {code}")
+        emplacement = location_name(emplacement)
+        errors = check_recipe_stock(needs, lambda ref: self.stock_of(ref, emplacement), self.units.format)
+        if errors:
+            raise ValueError(f"Stock insuffisant ({emplacement}): " + "; ".join(errors))
+        return {ref: self.consume(ref, date, qty, commande, emplacement) for ref, qty in needs}
+
+    def stock_of(self, ref, emplacement=None):
+        """Stock réel d'un produit, à un emplacement si `emplacement` est donné (None si la référence est inconnue)"""
+        try:
+            stock = self.product(ref)[3][ref]
+        except ValueError:
+            return None
+        return stock if emplacement is None else self.locations.quantity(ref, emplacement, stock)
+
+    def op_marquer_traitee(self, ref=None, identifiant=None, poids=None, emplacement=None):
+        """Marque une commande traitée; avec `poids`, la recette de son code couleur est consommée (à `emplacement`)"""
+        commande = self.find_commande(ref, identifiant)
+        if commande['statut'] and "traitée" in commande['statut'].lower():
+            return False
+        if poids is not None and commande['code'] in self.recipes:
+            self.op_recette(commande['code'], poids, commande=str(commande['ref']), emplacement=emplacement)
+        old_fields = dict(commande)
+        commande['statut'] = "Traitée"
+        self.close_commande(commande)
+        for _, key in COMMANDE_COLUMNS:
+            if old_fields.get(key) != commande.get(key):
+                self.audit.record(commande['ref'], f"Commande {commande['id']}", key, old_fields.get(key), commande[key])
+        self.write_commande(commande)
+        self.commandes_dirty = True
+        self.touch()
+        return True
+
+    def op_supprimer_commande(self, ref=None, identifiant=None):
+        """Supprime la commande `identifiant`, ou à défaut toutes celles de la référence `ref`"""
+        commande = self.find_commande(ref, identifiant)
+        removed = [commande] if identifiant is not None else [cmd for cmd in self.commandes if cmd['ref'] == ref]
+        for cmd in removed:
+            self.commande_index.pop(cmd['id'], None)
+            self.audit.record(cmd['ref'], f"Commande {cmd['id']}", "suppression",
+                              {'code': cmd['code'], 'statut': cmd['statut']}, None)
+            # Ligne vidée, identifiant conservé: il ne sera pas réattribué
+            for col, _ in COMMANDE_COLUMNS:
+                if col != ID_COLUMN:
+                    self.set_cell(self.sheet_commandes, cmd['row'], col, None)
+        self.commandes = [cmd for cmd in self.commandes if cmd['id'] not in {c['id'] for c in removed}]
+        self.commandes_dirty = True
+        self.touch()
+        return len(self.commandes)
+
+    def find_commande(self, ref=None, identifiant=None):
+        """Commande d'identifiant donné (recherche directe), sinon première commande de la référence"""
+        if identifiant is not None:
+            commande = self.commande_index.get(to_id(identifiant))
+        else:
+            commande = next((cmd for cmd in self.commandes if cmd['ref'] == ref), None)
+        if commande is None:
+            raise ValueError(f"Commande introuvable: {identifiant if identifiant is not None else ref}")
+        return commande
+
+    def write_commande(self, commande):
+        """Écrit une commande à sa ligne de la feuille commandes"""
+        for col, key in COMMANDE_COLUMNS:
+            self.set_cell(self.sheet_commandes, commande['row'], col, commande[key])
+
+    @staticmethod
+    def close_commande(commande):
+        """Date de sortie du jour et délai en jours depuis l'entrée"""
+        commande['date_sortie'] = datetime.today().strftime('%Y-%m-%d')
+        date_entree = to_date(commande['date_entree'])
+        commande['delai'] = (datetime.today().date() - date_entree).days if date_entree else 0
+
+    # -- Enregistrement ------------------------------------------------------
+
+    def prepare_save(self):
+        """Reporte sur les feuilles ce qui n'est écrit qu'au moment de l'enregistrement (statistiques des commandes)"""
+        if not self.commandes_dirty:
+            return
+        traitees = sum(1 for cmd in self.commandes if cmd['statut'] and "traitée" in cmd['statut'].lower())
+        self.set_cell(self.sheet_stats, 10, 2, traitees)
+        self.set_cell(self.sheet_stats, 16, 2, len(self.commandes))
+        if self.commandes:
+            self.set_cell(self.sheet_stats, 13, 2, traitees / len(self.commandes))
+        self.commandes_dirty = False
+
+    def save(self):
+        """Enregistre le classeur (exécuté hors de la boucle asyncio).
+        
+        Le serveur ne fusionne pas: si le fichier a été modifié ailleurs depuis
+        sa dernière lecture (poste de bureau, Excel), l'enregistrement est refusé
+        plutôt que d'écraser ces modifications, et les écritures restent en attente.
+        """
+        with PROFILER.measure("serveur:enregistrement"):
+            with WorkbookLock(self.filename):
+                changes = read_external_changes(self.filename, self.file_state, self.sheet_parts)
+                if changes and changes['sheets']:
+                    raise RuntimeError("Classeur modifié hors du serveur (" + ", ".join(sorted(changes['sheets']))
+                                       + "): enregistrement refusé, redémarrer le serveur pour le relire")
+                self.file_state, data = write_workbook_file(self.wb, self.filename)
+            self.sheet_parts = workbook_parts(data)
+        try:
+            self.audit.flush()
+        except Exception:
+            pass  # Journal indisponible (verrou, disque): les entrées restent en attente pour le prochain lot
+
+
+READ_OPS = {"etat", "catalogue", "stock", "historique", "totaux", "valeur", "emplacements", "commandes"}
+WRITE_OPS = {"consommation", "recette", "stock_initial", "ajouter_commande", "marquer_traitee", "supprimer_commande"}
+
+
+class StockServer:
+    """Serveur asyncio: plusieurs clients, écritures sérialisées et enregistrées par lots"""
+
+    def __init__(self, service, host=HOST, port=PORT, batch_delay=BATCH_DELAY, batch_size=BATCH_SIZE):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.write_lock = asyncio.Lock()
+        self.flush_handle = None
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.flush()
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self.dispatch(line)
+                writer.write(json.dumps(response, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, line):
+        """Exécute une requête et retourne la réponse"""
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.pop("id", None)
+            op = request.pop("op")
+
+            if op == "enregistrer":
+                await self.flush()
+                result = self.service.op_etat()
+            elif op in READ_OPS:
+                result = getattr(self.service, "op_" + op)(**request)
+            elif op in WRITE_OPS:
+                async with self.write_lock:
+                    with PROFILER.measure(f"serveur:{op}"):
+                        result = getattr(self.service, "op_" + op)(**request)
+                self.schedule_flush()
+            else:
+                raise ValueError(f"Opération inconnue: {op}")
+            return {"id": request_id, "ok": True, "resultat": result}
+        except Exception as e:
+            return {"id": request_id, "ok": False, "erreur": str(e)}
+
+    def schedule_flush(self):
+        """Regroupe les écritures: enregistrement différé ou immédiat si le lot est plein"""
+        if self.service.pending >= self.batch_size:
+            asyncio.ensure_future(self.flush())
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.batch_delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        """Enregistre le classeur si des écritures sont en attente"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        async with self.write_lock:
+            if not self.service.pending:
+                return
+            self.service.prepare_save()
+            # Le verrou bloque les écritures pendant l'enregistrement; les lectures restent servies
+            await asyncio.get_running_loop().run_in_executor(None, self.service.save)
+            self.service.pending = 0
+
+
+class StockClient:
+    """Client synchrone du serveur de stock (à utiliser hors du thread Tk)"""
+
+    def __init__(self, host=HOST, port=PORT, timeout=10):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.stream = self.sock.makefile("rwb")
+        self.next_id = 0
+
+    def call(self, op, **args):
+        """Envoie une requête et retourne son résultat; lève ValueError en cas de refus"""
+        self.next_id += 1
+        self.stream.write(json.dumps(dict(args, id=self.next_id, op=op)).encode("utf-8") + b"\n")
+        self.stream.flush()
+        response = json.loads(self.stream.readline())
+        if not response["ok"]:
+            raise ValueError(response["erreur"])
+        return response["resultat"]
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+async def run_server(filename, host, port):
+    t0 = time.perf_counter()
+    service = StockService(filename)
+    server = await StockServer(service, host, port).start()
+    print(f"Serveur de stock prêt sur {host}:{server.port} "
+          f"({len(service.colorants)} colorants, {len(service.consumption_history)} consommations, "
+          f"chargé en {time.perf_counter() - t0:.1f} s)")
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serveur de stock de StockMaster Pro")
+    parser.add_argument("--fichier", default="suivi_consommation.xlsx")
+    parser.add_argument("--hote", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.fichier):
+        parser.error(f"Fichier Excel introuvable: {args.fichier}")
+    try:
+        asyncio.run(run_server(args.fichier, args.hote, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()